@@ -1,7 +1,13 @@
 ALEMBIC_CONFIG = '/app/alembic.ini'
+# config versions kept to send deltas to devices that were offline for a while
+CONFIG_VERSION_HISTORY = 20
 DB_URL = 'sqlite:////app/storage/was.db'
 DIR_ASSET = '/app/storage/asset'
 DIR_OTA = '/app/storage/ota'
+# HA domains that support turn_on and turn_off, used for multinet commands and the fast path
+HA_ONOFF_DOMAINS = ['fan', 'input_boolean', 'light', 'switch']
+# ESP-SR multinet command limit
+MULTINET_MAX_COMMANDS = 400
 URL_WILLOW_RELEASES = 'https://worker.heywillow.org/api/release?format=was'
 URL_WILLOW_CONFIG = 'https://worker.heywillow.org/api/config'
 URL_WILLOW_TZ = 'https://worker.heywillow.org/api/asset?type=tz'
@@ -1,10 +1,27 @@
+import asyncio
+import copy
+import json
+import time
+
+from concurrent.futures import ThreadPoolExecutor
 from logging import getLogger
 
+from sqlalchemy import event, or_
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.exc import IntegrityError
-from sqlmodel import Session, create_engine, select
-
-from app.db.models import WillowClientTable, WillowConfigNamespaceType, WillowConfigTable, WillowConfigType
+from sqlmodel import Session, create_engine, delete, select
+
+from app.db.models import (
+    WillowClientTable,
+    WillowConfigNamespaceType,
+    WillowConfigTable,
+    WillowConfigType,
+    WillowConfigVersionTable,
+    WillowNotificationState,
+    WillowNotificationTable,
+)
 from app.internal.config import WillowConfig, WillowNvsConfig, WillowNvsWas, WillowNvsWifi
+from app.internal.metrics import DB_CALL_DURATION, DB_WAIT
 from app.settings import get_settings
 
 
@@ -12,11 +29,128 @@ log = getLogger("WAS")
 
 settings = get_settings()
 
-connect_args = {}
+engine_args = {}
 if settings.db_url.find("sqlite://") != -1:
-    connect_args["check_same_thread"] = False
+    engine_args["connect_args"] = {"check_same_thread": False}
+else:
+    engine_args.update(
+        max_overflow=settings.db_max_overflow,
+        # detect connections closed by the server, e.g. after a PostgreSQL restart
+        pool_pre_ping=True,
+        pool_recycle=settings.db_pool_recycle,
+        pool_size=settings.db_pool_size,
+        pool_timeout=settings.db_pool_timeout,
+    )
+
+engine = create_engine(settings.db_url, echo=False, **engine_args)
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    # readers don't block the writer, and commits don't fsync the database file
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    # wait for locks held by other connections instead of failing immediately
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+
+if engine.dialect.name == "sqlite":
+    event.listen(engine, "connect", set_sqlite_pragmas)
+
+
+class DbExecutor:
+    """Run synchronous database functions on a bounded pool of worker threads
+
+    Keeps SQLite lock waits and slow queries off the event loop.
+    With no more workers than pooled connections, calls never wait for a connection inside SQLAlchemy,
+    the time spent waiting for a free worker is the pool wait.
+    """
+
+    def __init__(self, workers):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="was-db")
+        self.pending = 0
+        self.workers = workers
+
+    async def run(self, fn, *args, **kwargs):
+        started = []
+
+        def call():
+            started.append(time.perf_counter())
+            return fn(*args, **kwargs)
+
+        submitted = time.perf_counter()
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, call)
+        finally:
+            self.pending -= 1
+            if started:
+                DB_WAIT.observe(started[0] - submitted)
+                DB_CALL_DURATION.observe(time.perf_counter() - started[0], fn.__name__)
+
+    def stats(self):
+        return {
+            'pending': self.pending,
+            'pool': engine.pool.status(),
+            'workers': self.workers,
+        }
+
+
+workers = settings.db_workers
+if engine.dialect.name != "sqlite":
+    workers = min(workers, settings.db_pool_size + settings.db_max_overflow)
+db_executor = DbExecutor(workers)
+
+
+async def run_db(fn, *args, **kwargs):
+    """ Call a database function from async code without blocking the event loop """
+    return await db_executor.run(fn, *args, **kwargs)
+
+
+class ConfigCache:
+    """Process-wide cache of the config and NVS, as dict and as pre-serialized message
+
+    Devices request the config on every boot, after a power cut that's the whole fleet at once.
+    Entries are filled on the first read and replaced by the save functions (write-through).
+    Callers get a copy of the dict, the message is a str and can be shared.
+    """
 
-engine = create_engine(settings.db_url, echo=False, connect_args=connect_args)
+    def __init__(self):
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, config_type, load):
+        entry = self.entries.get(config_type)
+        if entry is None:
+            self.misses += 1
+            return self.set(config_type, load())
+        self.hits += 1
+        return entry
+
+    def set(self, config_type, data):
+        # same format as build_msg
+        msg = json.dumps({config_type.value: data}, sort_keys=True)
+        entry = self.entries[config_type] = (data, msg)
+        return entry
+
+    def invalidate(self, config_type=None):
+        if config_type is None:
+            self.entries.clear()
+        else:
+            self.entries.pop(config_type, None)
+
+    def stats(self):
+        return {
+            'entries': [config_type.value for config_type in self.entries],
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+config_cache = ConfigCache()
 
 
 def convert_str_or_none(input):
@@ -34,6 +168,30 @@ def convert_str_or_none(input):
 
 
 def get_config_db():
+    data, _ = config_cache.get(WillowConfigType.config, load_config_db)
+    return copy.deepcopy(data)
+
+
+def get_config_msg():
+    """ Get the config as {"config": ...} message for devices """
+    _, msg = config_cache.get(WillowConfigType.config, load_config_db)
+    return msg
+
+
+def get_config_versions_db():
+    """ Get saved config versions, oldest first """
+    versions = []
+    with Session(engine) as session:
+        stmt = select(WillowConfigVersionTable).order_by(WillowConfigVersionTable.version)
+        records = session.exec(stmt)
+
+        for record in records:
+            versions.append(record.model_dump())
+
+    return versions
+
+
+def load_config_db():
     config = WillowConfig()
 
     with Session(engine) as session:
@@ -49,6 +207,38 @@ def get_config_db():
     return config.model_dump(exclude_none=True)
 
 
+def upsert(session, table, rows, index_elements, update_columns, skip_unchanged=False):
+    """ Insert rows, updating update_columns of rows that conflict on index_elements
+
+    Uses INSERT ... ON CONFLICT DO UPDATE, supported by both SQLite and PostgreSQL.
+    With skip_unchanged, conflicting rows where update_columns already have the new values are not written.
+    """
+    if engine.dialect.name == "postgresql":
+        insert = postgresql.insert
+    else:
+        insert = sqlite.insert
+
+    if len(rows) == 0:
+        return
+
+    # compiled once and executed with executemany
+    stmt = insert(table)
+    where = None
+    if skip_unchanged:
+        # IS DISTINCT FROM on PostgreSQL, IS NOT on SQLite, both treat NULL as a value
+        columns = stmt.table.c
+        where = or_(*[columns[column].is_distinct_from(stmt.excluded[column]) for column in update_columns])
+    if len(update_columns) == 0:
+        stmt = stmt.on_conflict_do_nothing(index_elements=index_elements)
+    else:
+        stmt = stmt.on_conflict_do_update(
+            index_elements=index_elements,
+            set_={column: stmt.excluded[column] for column in update_columns},
+            where=where,
+        )
+    session.execute(stmt, rows)
+
+
 def get_devices_db():
     devices = []
     with Session(engine) as session:
@@ -61,7 +251,39 @@ def get_devices_db():
     return devices
 
 
+def get_notifications_db():
+    """ Get pending and active notifications
+
+    Done and expired notifications are only kept until the next call, usually the next start.
+    """
+    notifications = []
+    with Session(engine) as session:
+        session.exec(delete(WillowNotificationTable).where(
+            WillowNotificationTable.state.in_([WillowNotificationState.done, WillowNotificationState.expired])
+        ))
+        session.commit()
+
+        stmt = select(WillowNotificationTable).order_by(WillowNotificationTable.notification_id)
+        records = session.exec(stmt)
+
+        for record in records:
+            notifications.append(record.model_dump())
+
+    return notifications
+
+
 def get_nvs_db():
+    data, _ = config_cache.get(WillowConfigType.nvs, load_nvs_db)
+    return copy.deepcopy(data)
+
+
+def get_nvs_msg():
+    """ Get the NVS as {"nvs": ...} message for devices """
+    _, msg = config_cache.get(WillowConfigType.nvs, load_nvs_db)
+    return msg
+
+
+def load_nvs_db():
     config = WillowNvsConfig()
     config_was = WillowNvsWas()
     config_wifi = WillowNvsWifi()
@@ -106,6 +328,8 @@ def migrate_user_config(config):
             log.warning(e)
             session.rollback()
 
+    config_cache.invalidate(WillowConfigType.config)
+
 
 def migrate_user_client_config(clients):
     log.debug(f"clients: {clients}")
@@ -160,125 +384,143 @@ def migrate_user_nvs(config):
             log.warning(e)
             session.rollback()
 
+    config_cache.invalidate(WillowConfigType.nvs)
+
 
 def save_client_config_to_db(clients):
     log.debug(f"save_client_config_to_db: {clients}")
 
+    rows = [
+        {'label': client["label"], 'mac_addr': client["mac_addr"], 'zone': client.get("zone")}
+        for client in clients
+    ]
     with Session(engine) as session:
-        for client in iter(clients):
-            stmt = select(WillowClientTable).where(WillowClientTable.mac_addr == client["mac_addr"])
-            record = session.exec(stmt).first()
+        try:
+            upsert(
+                session,
+                WillowClientTable,
+                rows,
+                index_elements=["mac_addr"],
+                update_columns=["label", "zone"],
+                skip_unchanged=True,
+            )
+            session.commit()
+        except IntegrityError as e:
+            log.warning(e)
+            session.rollback()
 
-            if record is None:
-                record = WillowClientTable(
-                    label=client["label"],
-                    mac_addr=client["mac_addr"]
-                )
 
-            else:
-                if record.label == client["label"] and record.mac_addr == client["mac_addr"]:
-                    continue
-                record.label = client["label"]
-                record.mac_addr = client["mac_addr"]
+def save_client_to_db(client):
+    """ Insert or update a single client
 
-            session.add(record)
+    Only label and zone present in client are updated, e.g. the zone is kept when only the label is sent.
+    """
+    log.debug(f"save_client_to_db: {client}")
+
+    columns = [column for column in ["label", "zone"] if column in client]
+    row = {column: client[column] for column in columns}
+    row["mac_addr"] = client["mac_addr"]
 
+    with Session(engine) as session:
         try:
+            upsert(
+                session,
+                WillowClientTable,
+                [row],
+                index_elements=["mac_addr"],
+                update_columns=columns,
+                skip_unchanged=True,
+            )
             session.commit()
         except IntegrityError as e:
             log.warning(e)
             session.rollback()
 
 
-def save_config_to_db(config):
-    config = WillowConfig.parse_obj(config)
-    log.debug(f"save_config_to_db: {config}")
+def save_notifications_to_db(notifications):
+    """ Save a batch of notification state changes in a single transaction """
+    log.debug(f"save_notifications_to_db: {len(notifications)} notifications")
 
     with Session(engine) as session:
-        for name, value in iter(config):
-            stmt = select(WillowConfigTable).where(
-                WillowConfigTable.config_type == WillowConfigType.config,
-                WillowConfigTable.config_name == name,
-            )
-            record = session.exec(stmt).first()
-
-            if record is None:
-                record = WillowConfigTable(
-                    config_type=WillowConfigType.config,
-                    config_name=name,
-                    config_value=convert_str_or_none(value)
-                )
-
-            else:
-                if record.config_value == convert_str_or_none(value):
-                    continue
+        upsert(
+            session,
+            WillowNotificationTable,
+            notifications,
+            index_elements=["notification_id", "mac_addr"],
+            update_columns=["data", "state"],
+        )
+        session.commit()
 
-                record.config_value = convert_str_or_none(value)
 
-            session.add(record)
+def save_config_to_db(config):
+    config = WillowConfig.parse_obj(config)
+    log.debug(f"save_config_to_db: {config}")
 
+    rows = [
+        {
+            'config_type': WillowConfigType.config,
+            'config_name': name,
+            'config_value': convert_str_or_none(value),
+        }
+        for name, value in iter(config)
+    ]
+    with Session(engine) as session:
         try:
+            upsert(
+                session,
+                WillowConfigTable,
+                rows,
+                index_elements=["config_type", "config_name"],
+                update_columns=["config_value"],
+                skip_unchanged=True,
+            )
             session.commit()
-            session.refresh(record)
         except IntegrityError as e:
             log.warning(e)
             session.rollback()
+            return
 
+    config_cache.set(WillowConfigType.config, config.model_dump(exclude_none=True))
 
-def save_nvs_to_db(config):
-    config = WillowNvsConfig.parse_obj(config)
-    log.debug(f"save_nvs_to_db: {config}")
+
+def save_config_version_to_db(version, hash, data, keep):
+    """ Save a config version, and delete versions older than the last keep versions """
+    log.debug(f"save_config_version_to_db: {version} {hash}")
 
     with Session(engine) as session:
-        for name, value in iter(config.WAS):
-            stmt = select(WillowConfigTable).where(
-                WillowConfigTable.config_type == WillowConfigType.nvs,
-                WillowConfigTable.config_name == name,
-                WillowConfigTable.config_namespace == WillowConfigNamespaceType.WAS,
-            )
-            record = session.exec(stmt).first()
-
-            if record is None:
-                record = WillowConfigTable(
-                    config_type=WillowConfigType.nvs,
-                    config_name=name,
-                    config_namespace=WillowConfigNamespaceType.WAS,
-                    config_value=str(value),
-                )
-
-            else:
-                if record.config_value == str(value):
-                    continue
-                record.config_value = str(value)
-
-            session.add(record)
-
-        for name, value in iter(config.WIFI):
-            stmt = select(WillowConfigTable).where(
-                WillowConfigTable.config_type == WillowConfigType.nvs,
-                WillowConfigTable.config_name == name,
-                WillowConfigTable.config_namespace == WillowConfigNamespaceType.WIFI,
-            )
-            record = session.exec(stmt).first()
+        session.add(WillowConfigVersionTable(version=version, hash=hash, data=data))
+        session.exec(delete(WillowConfigVersionTable).where(WillowConfigVersionTable.version <= version - keep))
+        session.commit()
 
-            if record is None:
-                record = WillowConfigTable(
-                    config_type=WillowConfigType.nvs,
-                    config_name=name,
-                    config_namespace=WillowConfigNamespaceType.WIFI,
-                    config_value=str(value),
-                )
 
-            else:
-                if record.config_value == str(value):
-                    continue
-                record.config_value = str(value)
+def save_nvs_to_db(config):
+    config = WillowNvsConfig.parse_obj(config)
+    log.debug(f"save_nvs_to_db: {config}")
 
-            session.add(record)
+    rows = []
+    for namespace, values in [(WillowConfigNamespaceType.WAS, config.WAS), (WillowConfigNamespaceType.WIFI, config.WIFI)]:
+        for name, value in iter(values):
+            rows.append({
+                'config_type': WillowConfigType.nvs,
+                'config_name': name,
+                'config_namespace': namespace,
+                'config_value': str(value),
+            })
 
+    with Session(engine) as session:
         try:
+            upsert(
+                session,
+                WillowConfigTable,
+                rows,
+                index_elements=["config_type", "config_name"],
+                update_columns=["config_value"],
+                skip_unchanged=True,
+            )
             session.commit()
-            session.refresh(record)
         except IntegrityError as e:
             log.warning(e)
             session.rollback()
+            return
+
+    config_cache.set(WillowConfigType.nvs, config.model_dump(exclude_none=True))
@@ -1,6 +1,7 @@
 from enum import Enum
 from typing import Optional
 
+from sqlalchemy import BigInteger, Column
 from sqlmodel import Field, SQLModel, UniqueConstraint
 
 
@@ -9,6 +10,13 @@ class WillowConfigNamespaceType(str, Enum):
     WIFI = "WIFI"
 
 
+class WillowNotificationState(str, Enum):
+    pending = "pending"
+    active = "active"
+    done = "done"
+    expired = "expired"
+
+
 class WillowConfigType(str, Enum):
     config = "config"
     multinet = "multinet"
@@ -29,6 +37,19 @@ class WillowConfigTable(SQLModel, table=True):
     config_value: Optional[str] = None
 
 
+class WillowConfigVersionTable(SQLModel, table=True):
+    # work around probably SQLModel bug during select
+    # AttributeError: 'ConfigTable' object has no attribute '__pydantic_extra__'. Did you mean: '__pydantic_private__'?
+    __pydantic_extra__ = None
+    __tablename__ = "willow_config_versions"
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    version: int = Field(unique=True)
+    hash: str
+    # full config as JSON, needed to calculate deltas from this version
+    data: str
+
+
 class WillowClientTable(SQLModel, table=True):
     # work around probably SQLModel bug during select
     # AttributeError: 'ConfigTable' object has no attribute '__pydantic_extra__'. Did you mean: '__pydantic_private__'?
@@ -38,3 +59,20 @@ class WillowClientTable(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     mac_addr: str = Field(unique=True)
     label: str
+    # devices in the same zone take part in the same wake arbitration
+    zone: Optional[str] = None
+
+
+class WillowNotificationTable(SQLModel, table=True):
+    # work around probably SQLModel bug during select
+    # AttributeError: 'ConfigTable' object has no attribute '__pydantic_extra__'. Did you mean: '__pydantic_private__'?
+    __pydantic_extra__ = None
+    __table_args__ = (UniqueConstraint("notification_id", "mac_addr"), )
+    __tablename__ = "willow_notifications"
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    # notification IDs are timestamps in ms, too big for a 32-bit integer
+    notification_id: int = Field(sa_column=Column(BigInteger, nullable=False))
+    mac_addr: str
+    data: str
+    state: WillowNotificationState
@@ -7,6 +7,15 @@ class Client(BaseModel):
     mac_addr: str = "unknown"
     notification_active: int = 0
     ua: str = None
+    # last config version and its hash acknowledged by the device, None for devices that don't support config versions
+    config_hash: str = None
+    config_version: int = None
+    missed_deadlines: int = 0
+    slow: bool = False
+
+    def set_config_version(self, version, hash=None):
+        self.config_hash = hash
+        self.config_version = version
 
     def set_hostname(self, hostname):
         self.hostname = hostname
@@ -22,3 +31,10 @@ class Client(BaseModel):
 
     def set_notification_active(self, id):
         self.notification_active = id
+
+    def record_deadline(self, met):
+        if met:
+            self.missed_deadlines = 0
+        else:
+            self.missed_deadlines += 1
+        self.slow = self.missed_deadlines > 0
@@ -1,4 +1,7 @@
+import asyncio
 import logging
+import random
+import time
 
 from pydantic import BaseModel
 
@@ -26,6 +29,19 @@ class CommandEndpointRuntimeException(Exception):
         super().__init__(self.msg)
 
 
+class CommandEndpointTimeoutException(CommandEndpointRuntimeException):
+    """"Raised when the command endpoint did not respond in time
+
+    Attributes:
+        msg -- error message
+        delivered -- the endpoint acknowledged the command, only the response is missing
+    """
+
+    def __init__(self, msg="Command Endpoint did not respond in time", delivered=False):
+        self.delivered = delivered
+        super().__init__(msg)
+
+
 class CommandEndpointResult(BaseModel):
     ok: bool = False
     speech: str = "Error!"
@@ -45,3 +61,83 @@ class CommandEndpointResponse(BaseModel):
 class CommandEndpoint():
     name = "WAS CommandEndpoint"
     log = logging.getLogger("WAS")
+
+    # set by init_command_endpoint, see CircuitBreaker
+    breaker = None
+
+    # endpoints with a persistent connection set this while they can accept commands, see init_link
+    link_up = None
+
+    # reconnect delay grows exponentially from backoff_min up to backoff_max, with full jitter
+    backoff_min = 1.0
+    backoff_max = 60.0
+
+    def init_link(self):
+        """ Link state bookkeeping for endpoints with a persistent connection, kept up by keep_connected """
+        self.connected = False
+        self.disconnects = 0
+        self.last_error = None
+        self.link_since = time.time()
+        self.link_state = "connecting"
+        self.link_up = asyncio.Event()
+        self.reconnect_attempt = 0
+        self.reconnects = 0
+
+    def set_link_state(self, state):
+        if state != self.link_state:
+            self.log.debug(f"{self.name}: link state {self.link_state} -> {state}")
+            self.link_state = state
+            self.link_since = time.time()
+            if state == "connected":
+                self.reconnect_attempt = 0
+                self.link_up.set()
+            else:
+                self.link_up.clear()
+
+    def link_lost(self):
+        if self.connected:
+            self.disconnects += 1
+        self.connected = False
+        self.set_link_state("disconnected")
+
+    async def keep_connected(self, session):
+        """ Run session, which returns or raises when the connection is gone, and reconnect with backoff forever """
+        while True:
+            self.set_link_state("connecting")
+            try:
+                await session()
+            except Exception as e:
+                self.log.info(f"{self.name}: exception occurred: {e}")
+                self.last_error = str(e)
+            self.link_lost()
+
+            delay = random.uniform(0, min(self.backoff_max, self.backoff_min * 2 ** self.reconnect_attempt))
+            self.reconnect_attempt += 1
+            self.reconnects += 1
+            self.log.info(f"{self.name}: reconnecting in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    async def wait_connected(self, timeout):
+        """ Wait until the endpoint can accept commands, returns False when it didn't within timeout seconds """
+        if self.link_up is None:
+            return True
+        try:
+            await asyncio.wait_for(self.link_up.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    async def probe(self, timeout):
+        """ Check whether the endpoint is reachable again, used while the circuit breaker is open """
+        return await self.wait_connected(timeout)
+
+    def outstanding(self):
+        """ Number of commands sent and not answered yet, they are drained before the endpoint is replaced """
+        return 0
+
+    def responder(self, response):
+        """ Name of the endpoint that answered with response, as returned by send """
+        return self.name
+
+    def status(self):
+        return {'name': self.name}
@@ -0,0 +1,103 @@
+import asyncio
+import time
+
+from enum import Enum
+from logging import getLogger
+
+
+log = getLogger("WAS")
+
+
+class BreakerState(str, Enum):
+    closed = "closed"
+    half_open = "half_open"
+    open = "open"
+
+
+class CircuitBreaker:
+    """Stop sending commands to an endpoint that keeps failing
+
+    After failure_threshold consecutive failures or timeouts the breaker opens, and commands are
+    answered immediately instead of waiting for the endpoint. While open, probe is called every
+    reset_timeout seconds in the background. When it succeeds the breaker goes half open, and lets
+    a single command through: success closes the breaker, failure opens it again.
+    """
+
+    def __init__(self, probe, failure_threshold=3, reset_timeout=10.0, probe_timeout=5.0):
+        self.failure_threshold = failure_threshold
+        self.probe = probe
+        self.probe_timeout = probe_timeout
+        self.reset_timeout = reset_timeout
+
+        self.failures = 0
+        self.probes = 0
+        self.rejected = 0
+        self.since = time.time()
+        self.state = BreakerState.closed
+        self.task = None
+        self.transitions = {}
+        self.trial = False
+
+    def set_state(self, state):
+        transition = f"{self.state.value}->{state.value}"
+        self.transitions[transition] = self.transitions.get(transition, 0) + 1
+        log.warning(f"command endpoint circuit breaker {transition}")
+        self.state = state
+        self.since = time.time()
+
+    def allow(self):
+        if self.state == BreakerState.closed:
+            return True
+        if self.state == BreakerState.half_open and not self.trial:
+            self.trial = True
+            return True
+        self.rejected += 1
+        return False
+
+    def success(self):
+        self.failures = 0
+        self.trial = False
+        if self.state != BreakerState.closed:
+            self.stop()
+            self.set_state(BreakerState.closed)
+
+    def failure(self):
+        self.failures += 1
+        self.trial = False
+        if self.state == BreakerState.half_open:
+            self.trip()
+        elif self.state == BreakerState.closed and self.failures >= self.failure_threshold:
+            self.trip()
+
+    def trip(self):
+        self.set_state(BreakerState.open)
+        self.stop()
+        self.task = asyncio.get_event_loop().create_task(self.run_probe())
+
+    async def run_probe(self):
+        while True:
+            await asyncio.sleep(self.reset_timeout)
+            self.probes += 1
+            try:
+                ok = await self.probe(self.probe_timeout)
+            except Exception as e:
+                log.debug(f"command endpoint probe failed: {e}")
+                ok = False
+            if ok:
+                self.set_state(BreakerState.half_open)
+                return
+
+    def stats(self):
+        return {
+            'state': self.state.value,
+            'since': self.since,
+            'failures': self.failures,
+            'probes': self.probes,
+            'rejected': self.rejected,
+            'transitions': self.transitions,
+        }
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
@@ -0,0 +1,79 @@
+from logging import getLogger
+from typing import NamedTuple
+
+from app.const import HA_ONOFF_DOMAINS
+from app.internal.multinet import MultinetCompiler
+from app.internal.was import normalize_phrase
+
+
+log = getLogger("WAS")
+
+
+class FastPathMatch(NamedTuple):
+    domain: str
+    entity_id: str
+    name: str
+    service: str
+
+
+class FastPathMatcher:
+    """Exact match of TURN ON/OFF <entity> commands against the Home Assistant entity index
+
+    Phrases are compiled with get_ha_commands_for_entity, the same phrasing used for multinet,
+    for both the friendly name and the object ID of every entity in domains. They come from the
+    memo of the MultinetCompiler, so a rebuild only compiles phrases for new or renamed entities.
+    Phrases that match more than one entity are left to the assist pipeline, and only entities
+    that are exposed to Assist in Home Assistant are matched.
+    """
+
+    domains = HA_ONOFF_DOMAINS
+    services = ["turn_on", "turn_off"]
+
+    def __init__(self, compiler=None):
+        self.compiler = compiler if compiler is not None else MultinetCompiler()
+        self.entities = 0
+        self.phrases = {}
+
+    def build(self, states, exposed=None):
+        """ Compile phrases for states, only for entity IDs in exposed unless it is None """
+        entities = 0
+        entity_ids = set()
+        phrases = {}
+        ambiguous = set()
+
+        for state in states:
+            entity_id = state["entity_id"]
+            domain, object_id = entity_id.split(".", 1)
+            if domain not in self.domains:
+                continue
+            entity_ids.add(entity_id)
+            if exposed is not None and entity_id not in exposed:
+                continue
+
+            entities += 1
+            name = state.get("attributes", {}).get("friendly_name") or object_id.replace("_", " ")
+            commands = self.compiler.get_commands(state) + self.compiler.get_alias_commands(state)
+            # get_ha_commands_for_entity returns ON before OFF, or nothing if the phrase is too long
+            for i, phrase in enumerate(commands):
+                match = phrases.get(phrase)
+                if match is not None and match.entity_id != entity_id:
+                    ambiguous.add(phrase)
+                phrases[phrase] = FastPathMatch(domain, entity_id, name, self.services[i % 2])
+
+        for phrase in ambiguous:
+            phrases.pop(phrase)
+        self.compiler.forget(entity_ids)
+
+        self.entities = entities
+        self.phrases = phrases
+        log.info(f"fast path: compiled {len(phrases)} phrases for {entities} entities")
+
+    def match(self, text):
+        if not self.phrases:
+            return None
+
+        phrase = normalize_phrase(text)
+        match = self.phrases.get(phrase)
+        if match is None and " THE " in phrase:
+            match = self.phrases.get(phrase.replace(" THE ", " ", 1))
+        return match
@@ -0,0 +1,88 @@
+from logging import getLogger
+
+
+log = getLogger("WAS")
+
+
+class HomeAssistantIndex:
+    """In-memory index of Home Assistant entities and Willow devices
+
+    Seeded from get_states and config/device_registry/list after connecting, then kept up to date
+    from state_changed events. Only the entity ID, state and friendly name are kept per entity.
+
+    version is incremented whenever an entity is added, removed or renamed, so consumers that
+    compile something from the entity names (fast path matcher, multinet) know when to rebuild.
+    """
+
+    def __init__(self):
+        self.devices = {}
+        self.entities = {}
+        self.events = 0
+        self.seeded = False
+        self.version = 0
+        self._sorted = None
+
+    @staticmethod
+    def trim(state):
+        return {
+            'entity_id': state["entity_id"],
+            'state': state.get("state"),
+            'attributes': {'friendly_name': state.get("attributes", {}).get("friendly_name")},
+        }
+
+    def changed(self):
+        self.version += 1
+        self._sorted = None
+
+    def seed_devices(self, devices):
+        self.devices = {
+            ident[1]: item["id"]
+            for item in devices
+            for ident in item.get("identifiers", [])
+            if ident[0] == "willow"
+        }
+        log.debug(f"received willow devices: {self.devices}")
+
+    def seed_states(self, states):
+        self.entities = {state["entity_id"]: self.trim(state) for state in states}
+        self.seeded = True
+        self.changed()
+        log.info(f"indexed {len(self.entities)} Home Assistant entities")
+
+    def update_state(self, data):
+        """ Apply a state_changed event, returns True when the set of entity names changed """
+        self.events += 1
+        entity_id = data["entity_id"]
+        new_state = data.get("new_state")
+
+        if new_state is None:
+            if self.entities.pop(entity_id, None) is None:
+                return False
+            self.changed()
+            return True
+
+        entity = self.trim(new_state)
+        old = self.entities.get(entity_id)
+        if old is not None and old["attributes"]["friendly_name"] == entity["attributes"]["friendly_name"]:
+            # update in place, the cached sorted list refers to the same dict
+            old["state"] = entity["state"]
+            return False
+
+        self.entities[entity_id] = entity
+        self.changed()
+        return True
+
+    def get_entities(self):
+        """ Entities sorted by entity ID, the sorted list is cached until an entity is added, removed or renamed """
+        if self._sorted is None:
+            self._sorted = [self.entities[entity_id] for entity_id in sorted(self.entities)]
+        return self._sorted
+
+    def stats(self):
+        return {
+            'devices': len(self.devices),
+            'entities': len(self.entities),
+            'events': self.events,
+            'seeded': self.seeded,
+            'version': self.version,
+        }
@@ -1,22 +1,38 @@
 import asyncio
 import json
-import requests
 import time
 import websockets
+
+from collections import deque
+
+from app.internal.multinet import MultinetCompiler
+from app.internal.stats import percentile
+
 from . import (
     CommandEndpoint,
     CommandEndpointResponse,
     CommandEndpointResult,
     CommandEndpointRuntimeException,
+    CommandEndpointTimeoutException,
 )
+from .fast_path import FastPathMatcher
+from .ha_index import HomeAssistantIndex
+from .pending import PendingRequests
 
 
 class HomeAssistantWebSocketEndpoint(CommandEndpoint):
     name = "WAS Home Assistant WebSocket Endpoint"
 
-    connmap = {}
+    # deadline for a pipeline run, from sending the request until intent-end
+    timeout = 15.0
+
+    # commands received while the connection is down, sent after auth_ok
+    buffer_size = 16
 
-    def __init__(self, app, host, port, tls, token):
+    # entity renames come in bursts (e.g. HA restart), coalesce them into one fast path and multinet rebuild
+    rebuild_delay = 1.0
+
+    def __init__(self, app, host, port, tls, token, fast_path=False, multinet=False):
 
         self.app = app
         self.host = host
@@ -25,9 +41,32 @@ class HomeAssistantWebSocketEndpoint(CommandEndpoint):
         self.tls = tls
         self.url = self.construct_url(ws=True)
 
-        self.ha_willow_devices = {}
+        self.entity_registry_subscription_id = None
+        # entity IDs exposed to Assist, the fast path doesn't match anything until we know them
+        self.exposed = None
+        self.exposed_request_id = None
         self.ha_willow_devices_request_id = None
+        self.index = HomeAssistantIndex()
+        self.registry_subscription_id = None
+        self.states_subscription_id = None
         self.haws = None
+        self.pending = PendingRequests(timeout=self.timeout)
+
+        # simple on/off commands matched locally and sent as call_service, skipping the assist pipeline
+        # the matcher and multinet share the memoized commands per entity
+        compiler = MultinetCompiler()
+        self.matcher = FastPathMatcher(compiler) if fast_path else None
+        self.multinet = compiler if multinet else None
+        self.rebuild = None
+        self.states_request_id = None
+        self.fast_path_hits = 0
+        self.fast_path_misses = 0
+        self.latency = {
+            'fast_path': deque(maxlen=100),
+            'pipeline': deque(maxlen=100),
+        }
+
+        self.init_link()
 
         loop = asyncio.get_event_loop()
         self.task = loop.create_task(self.connect())
@@ -42,39 +81,131 @@ class HomeAssistantWebSocketEndpoint(CommandEndpoint):
         return f"{ha_url_scheme}{self.host}:{self.port}"
 
     async def connect(self):
+        await self.keep_connected(self.session)
+
+    async def session(self):
+        # deflate compression is enabled by default, making tcpdump difficult
+        async with websockets.connect(f"{self.url}/api/websocket", compression=None) as self.haws:
+            self.set_link_state("authenticating")
+            while True:
+                msg = await self.haws.recv()
+                await self.cb_msg(msg)
+
+    def link_lost(self):
+        super().link_lost()
+        self.haws = None
+
+        # HA accepted these requests, but we'll never get the result, and might not know whether it was executed
+        for id in [id for id, request in self.pending.requests.items() if request.acked]:
+            self.pending.fail(id, CommandEndpointRuntimeException("Home Assistant connection lost"))
+
+        # requests HA did not accept yet are re-issued after reconnecting
+        for request in self.pending.requests.values():
+            request.sent = False
+        if len(self.pending) > 0:
+            self.log.info(f"{self.name}: {len(self.pending)} requests will be re-issued after reconnecting")
+
+    def buffered(self):
+        return sum(1 for request in self.pending.requests.values() if not request.sent)
+
+    async def reissue(self):
+        # send() buffers while we're not connected, including while we're flushing the buffer here
         while True:
+            unsent = [id for id, request in self.pending.requests.items() if not request.sent]
+            if len(unsent) == 0:
+                break
+
+            for id in unsent:
+                if id not in self.pending:
+                    # timed out in the meantime
+                    continue
+                # pipeline IDs must increase for every message on a connection, so get a new one
+                request = self.pending.rekey(id, self.next_id())
+                request.payload["id"] = request.id
+                request.sent = True
+                self.log.debug(f"re-issuing request to HA WS: {request.payload}")
+                await self.haws.send(json.dumps(request.payload))
+
+    async def fetch_devices(self):
+        self.ha_willow_devices_request_id = self.next_id()
+        msg = {
+            "type": "config/device_registry/list",
+            "id": self.ha_willow_devices_request_id
+        }
+        self.log.debug(f"fetching devices: {msg}")
+        await self.haws.send(json.dumps(msg))
+
+    async def fetch_states(self):
+        self.states_request_id = self.next_id()
+        msg = {
+            "type": "get_states",
+            "id": self.states_request_id,
+        }
+        self.log.debug(f"fetching states: {msg}")
+        await self.haws.send(json.dumps(msg))
+
+    async def fetch_exposed(self):
+        self.exposed_request_id = self.next_id()
+        msg = {
+            "type": "homeassistant/expose_entity/list",
+            "id": self.exposed_request_id,
+        }
+        self.log.debug(f"fetching exposed entities: {msg}")
+        await self.haws.send(json.dumps(msg))
+
+    def seed_exposed(self, result):
+        self.exposed = {
+            entity_id for entity_id, assistants in result["exposed_entities"].items() if assistants.get("conversation")
+        }
+        self.log.debug(f"{len(self.exposed)} entities exposed to Assist")
+        if self.matcher is not None and self.index.seeded:
+            self.matcher.build(self.index.get_entities(), self.exposed)
+
+    async def subscribe(self, event_type):
+        id = self.next_id()
+        msg = {
+            "type": "subscribe_events",
+            "event_type": event_type,
+            "id": id,
+        }
+        self.log.debug(f"subscribing to {event_type}: {msg}")
+        await self.haws.send(json.dumps(msg))
+        return id
+
+    def cb_state_changed(self, data):
+        if self.index.update_state(data) and self.rebuild is None:
+            self.rebuild = asyncio.get_event_loop().call_later(self.rebuild_delay, self.index_updated)
+
+    def index_updated(self):
+        if self.rebuild is not None:
+            self.rebuild.cancel()
+            self.rebuild = None
+        if self.matcher is not None and self.exposed is not None:
+            self.matcher.build(self.index.get_entities(), self.exposed)
+        if self.multinet is not None:
             try:
-                # deflate compression is enabled by default, making tcpdump difficult
-                async with websockets.connect(f"{self.url}/api/websocket", compression=None) as self.haws:
-                    while True:
-                        msg = await self.haws.recv()
-                        await self.cb_msg(msg)
+                self.multinet.update(self.index.get_entities())
             except Exception as e:
-                self.log.info(f"{self.name}: exception occurred: {e}")
-                await asyncio.sleep(1)
+                self.log.error(f"failed to update multinet commands: {e}")
 
     async def cb_msg(self, msg):
-        self.log.debug(f"haws_cb: {self.app} {msg}")
+        # lazy formatting, with the state_changed subscription this runs for every state change in HA
+        self.log.debug("haws_cb: %s %s", self.app, msg)
         msg = json.loads(msg)
         if "type" in msg:
             if msg["type"] == "event":
-                if msg["event"]["type"] == "intent-end":
+                if msg["id"] == self.states_subscription_id:
+                    self.cb_state_changed(msg["event"]["data"])
+                elif msg["id"] == self.registry_subscription_id:
+                    await self.fetch_devices()
+                elif msg["id"] == self.entity_registry_subscription_id:
+                    # exposing an entity to Assist updates its entity registry options
+                    if self.matcher is not None and self.exposed_request_id is None:
+                        await self.fetch_exposed()
+                elif msg["event"]["type"] in ["intent-end", "error"]:
                     id = int(msg["id"])
-                    ws = self.connmap[id]
-                    out = CommandEndpointResult()
-                    response_type = msg["event"]["data"]["intent_output"]["response"]["response_type"]
-                    if response_type == "action_done":
-                        out.ok = True
-                    response = msg["event"]["data"]["intent_output"]["response"]
-                    # Not all intents return speech (e.g. HassNeverMind)
-                    if 'plain' in response["speech"]:
-                        out.speech = response["speech"]["plain"]["speech"]
-                    else:
-                        out.speech = ""
-                    command_endpoint_response = CommandEndpointResponse(result=out)
-                    self.log.debug(f"sending {command_endpoint_response} to {ws}")
-                    asyncio.ensure_future(ws.send_text(command_endpoint_response.model_dump_json()))
-                    self.connmap.pop(id)
+                    if self.pending.resolve(id, msg) is None:
+                        self.log.debug(f"received {msg['event']['type']} for unknown request {id}")
             elif msg["type"] == "auth_required":
                 auth_msg = {
                     "type": "auth",
@@ -83,35 +214,117 @@ class HomeAssistantWebSocketEndpoint(CommandEndpoint):
                 self.log.debug(f"authenticating HA WebSocket connection: {auth_msg}")
                 await self.haws.send(json.dumps(auth_msg))
             elif msg["type"] == "auth_ok":
-                self.ha_willow_devices_request_id = self.next_id()
-                msg = {
-                    "type": "config/device_registry/list",
-                    "id": self.ha_willow_devices_request_id
-                }
-                self.log.debug(f"fetching devices: {msg}")
-                await self.haws.send(json.dumps(msg))
+                # subscribe before fetching, HA answers in order so the seed is never older than an event
+                # the entity index is only needed to compile the fast path and multinet,
+                # without them we don't want to parse every state change in HA
+                index = self.matcher is not None or self.multinet is not None
+                self.registry_subscription_id = await self.subscribe("device_registry_updated")
+                if self.matcher is not None:
+                    self.entity_registry_subscription_id = await self.subscribe("entity_registry_updated")
+                if index:
+                    self.states_subscription_id = await self.subscribe("state_changed")
+                await self.fetch_devices()
+                if self.matcher is not None:
+                    await self.fetch_exposed()
+                if index:
+                    await self.fetch_states()
+                await self.reissue()
+                self.connected = True
+                self.set_link_state("connected")
+                self.log.info(f"{self.name}: connected")
+            elif msg["type"] == "result" and msg["id"] == self.exposed_request_id:
+                self.exposed_request_id = None
+                if msg["success"]:
+                    self.seed_exposed(msg["result"])
+                else:
+                    error = msg.get("error", {}).get("message", "unknown error")
+                    self.log.warning(f"{self.name}: failed to fetch exposed entities, fast path disabled: {error}")
+            elif msg["type"] == "result" and msg["id"] in self.pending:
+                if msg["success"] and self.pending.get(msg["id"]).payload["type"] == "call_service":
+                    self.pending.resolve(msg["id"], msg)
+                elif msg["success"]:
+                    # HA started the pipeline, the response follows in an intent-end event
+                    self.pending.get(msg["id"]).acked = True
+                else:
+                    error = msg.get("error", {}).get("message", "unknown error")
+                    self.pending.fail(msg["id"], CommandEndpointRuntimeException(error))
             elif msg["type"] == "result" and msg["success"]:
                 if msg["id"] == self.ha_willow_devices_request_id:
-                    devices = msg["result"]
-                    self.ha_willow_devices = {
-                        ident[1]: item["id"]
-                        for item in devices
-                        for ident in item.get("identifiers", [])
-                        if ident[0] == "willow"
-                    }
-                    self.log.debug(f"received willow devics: {self.ha_willow_devices}")
+                    self.index.seed_devices(msg["result"])
+                elif msg["id"] == self.states_request_id:
+                    self.index.seed_states(msg["result"])
+                    self.index_updated()
+
+    def outstanding(self):
+        return len(self.pending)
 
     def parse_response(self, response):
-        return None
+        out = CommandEndpointResult()
+        if response["type"] == "fast_path":
+            out.ok = True
+            out.speech = response["speech"]
+            return CommandEndpointResponse(result=out).model_dump_json()
+
+        event = response["event"]
+        if event["type"] == "error":
+            out.speech = f"Home Assistant error: {event['data']['message']}"
+        else:
+            response = event["data"]["intent_output"]["response"]
+            if response["response_type"] == "action_done":
+                out.ok = True
+            # Not all intents return speech (e.g. HassNeverMind)
+            if 'plain' in response["speech"]:
+                out.speech = response["speech"]["plain"]["speech"]
+            else:
+                out.speech = ""
+        command_endpoint_response = CommandEndpointResponse(result=out)
+        return command_endpoint_response.model_dump_json()
 
     def next_id(self):
         return int(time.monotonic_ns())
 
-    def send(self, jsondata, ws, client=None):
+    def record_latency(self, path, start):
+        self.latency[path].append((time.monotonic() - start) * 1000)
+
+    async def call_service(self, match):
         id = self.next_id()
+        out = {
+            'domain': match.domain,
+            'id': id,
+            'service': match.service,
+            'target': {'entity_id': match.entity_id},
+            'type': 'call_service',
+        }
+        request = self.pending.add(id, None, out)
+        request.sent = True
+
+        self.log.debug(f"sending to HA WS: {out}")
+        await self.haws.send(json.dumps(out))
+        await request.future
 
-        if id not in self.connmap:
-            self.connmap[id] = ws
+        state = "on" if match.service == "turn_on" else "off"
+        return {'type': 'fast_path', 'speech': f"Turned {state} {match.name}"}
+
+    async def send(self, jsondata, ws, client=None):
+        start = time.monotonic()
+
+        if self.matcher is not None and self.connected:
+            match = self.matcher.match(jsondata.get("text", ""))
+            if match is None:
+                self.fast_path_misses += 1
+            else:
+                self.fast_path_hits += 1
+                try:
+                    response = await self.call_service(match)
+                    self.record_latency('fast_path', start)
+                    return response
+                except CommandEndpointTimeoutException:
+                    raise
+                except Exception as e:
+                    # e.g. the entity is unavailable, let the pipeline explain it
+                    self.log.info(f"{self.name}: fast path failed, falling back to pipeline: {e}")
+
+        id = self.next_id()
 
         if "language" in jsondata:
             jsondata.pop("language")
@@ -124,13 +337,70 @@ class HomeAssistantWebSocketEndpoint(CommandEndpoint):
             'type': 'assist_pipeline/run',
         }
 
-        if client.mac_addr in self.ha_willow_devices:
+        if client.mac_addr in self.index.devices:
             self.log.info("HA has a registered device for this willow satellite")
-            out["device_id"] = self.ha_willow_devices[client.mac_addr]
+            out["device_id"] = self.index.devices[client.mac_addr]
 
-        self.log.debug(f"sending to HA WS: {out}")
-        asyncio.ensure_future(self.haws.send(json.dumps(out)))
+        if not self.connected:
+            if self.buffered() >= self.buffer_size:
+                raise CommandEndpointRuntimeException(f"{self.name} not connected and command buffer full")
+            self.log.info(f"{self.name} not connected, buffering command")
+            request = self.pending.add(id, ws, out)
+        else:
+            request = self.pending.add(id, ws, out)
+            request.sent = True
+
+            self.log.debug(f"sending to HA WS: {out}")
+            try:
+                await self.haws.send(json.dumps(out))
+            except Exception as e:
+                # the connection is going down, HA didn't get the request so it is re-issued after reconnecting
+                self.log.info(f"{self.name}: failed to send request, buffering command: {e}")
+                request.sent = False
+
+        try:
+            response = await request.future
+        except asyncio.CancelledError:
+            # another endpoint answered first, don't keep the request around until it times out
+            self.pending.pop(request.id)
+            raise
+        self.record_latency('pipeline', start)
+        return response
+
+    def status(self):
+        return {
+            'name': self.name,
+            'link': {
+                'state': self.link_state,
+                'since': self.link_since,
+                'disconnects': self.disconnects,
+                'reconnects': self.reconnects,
+                'last_error': self.last_error,
+                'buffered': self.buffered(),
+            },
+            'requests': self.pending.stats(),
+            'index': self.index.stats(),
+            'multinet': self.multinet.stats() if self.multinet is not None else None,
+            'latency': {
+                path: {
+                    'count': len(latency),
+                    'p50_ms': percentile(latency, 50),
+                    'p95_ms': percentile(latency, 95),
+                }
+                for path, latency in self.latency.items()
+            },
+            'fast_path': {
+                'enabled': self.matcher is not None,
+                'entities': self.matcher.entities if self.matcher is not None else 0,
+                'exposed': len(self.exposed) if self.exposed is not None else None,
+                'phrases': len(self.matcher.phrases) if self.matcher is not None else 0,
+                'hits': self.fast_path_hits,
+                'misses': self.fast_path_misses,
+            },
+        }
 
     def stop(self):
         self.log.info(f"stopping {self.name}")
         self.task.cancel()
+        if self.rebuild is not None:
+            self.rebuild.cancel()
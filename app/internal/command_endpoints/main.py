@@ -1,68 +1,178 @@
+import asyncio
+
 from logging import getLogger
 
 from app.db.main import get_config_db
+from app.internal.command_endpoints.breaker import CircuitBreaker
 from app.internal.command_endpoints.ha_ws import (
     HomeAssistantWebSocketEndpoint,
 )
 from app.internal.command_endpoints.mqtt import MqttConfig, MqttEndpoint
 from app.internal.command_endpoints.openhab import OpenhabEndpoint
 from app.internal.command_endpoints.rest import RestEndpoint
+from app.internal.command_endpoints.router import RoutedEndpoint, RoutingPolicy
+from app.settings import get_settings
 
 
 log = getLogger("WAS")
 
 
-def init_command_endpoint(app):
+# config keys that affect the command endpoint, other changes don't need a reload
+ENDPOINT_CONFIG_KEYS = ["command_endpoint", "command_endpoint_fallback", "command_endpoint_routing", "was_mode"]
+ENDPOINT_CONFIG_PREFIXES = ("hass_", "mqtt_", "openhab_", "rest_")
+
+# how long to wait for a new endpoint to connect before replacing the running one anyway
+ENDPOINT_SWAP_TIMEOUT = 10.0
+
+
+def get_endpoint_config(user_config):
+    return {
+        k: v for k, v in user_config.items()
+        if k in ENDPOINT_CONFIG_KEYS or k.startswith(ENDPOINT_CONFIG_PREFIXES)
+    }
+
+
+def stop_command_endpoint(endpoint):
     # call command_endpoint.stop() to avoid leaking asyncio task
     try:
-        app.command_endpoint.stop()
+        if endpoint.breaker is not None:
+            endpoint.breaker.stop()
+        endpoint.stop()
     except Exception:
         pass
 
+
+async def drain_command_endpoint(endpoint):
+    # let requests already sent to the old endpoint complete, they fail if it is stopped
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + endpoint.timeout
+    while endpoint.outstanding() > 0 and loop.time() < deadline:
+        await asyncio.sleep(0.1)
+    stop_command_endpoint(endpoint)
+
+
+async def swap_command_endpoint(app, endpoint):
+    if not await endpoint.wait_connected(ENDPOINT_SWAP_TIMEOUT):
+        log.warning(f"{endpoint.name} not connected after {ENDPOINT_SWAP_TIMEOUT}s, replacing running endpoint anyway")
+
+    old, app.command_endpoint = app.command_endpoint, endpoint
+    app.command_endpoint_next = None
+    log.info(f"switched command endpoint to {endpoint.name}")
+    await drain_command_endpoint(old)
+
+
+def init_command_endpoint(app):
     user_config = get_config_db()
+    endpoint_config = get_endpoint_config(user_config)
+
+    if endpoint_config == getattr(app, "command_endpoint_config", None):
+        log.debug("command endpoint configuration unchanged, not reloading")
+        return
+
+    # a previous reload might still be waiting for its endpoint to connect
+    if getattr(app, "command_endpoint_next", None) is not None:
+        app.command_endpoint_reload.cancel()
+        stop_command_endpoint(app.command_endpoint_next)
+        app.command_endpoint_next = None
+
+    endpoint = create_command_endpoint(app, user_config)
+    app.command_endpoint_config = endpoint_config
+    if endpoint is not None:
+        settings = get_settings()
+        endpoint.breaker = CircuitBreaker(
+            endpoint.probe,
+            failure_threshold=settings.command_endpoint_failure_threshold,
+            reset_timeout=settings.command_endpoint_reset_timeout,
+        )
+
+    if endpoint is None or app.command_endpoint is None:
+        stop_command_endpoint(app.command_endpoint)
+        app.command_endpoint = endpoint
+        return
+
+    # keep the running endpoint until the new one is connected, so commands don't fail during a reload
+    app.command_endpoint_next = endpoint
+    app.command_endpoint_reload = asyncio.get_event_loop().create_task(swap_command_endpoint(app, endpoint))
+
+
+def create_command_endpoint(app, user_config):
+    if "was_mode" not in user_config or not user_config["was_mode"]:
+        return None
+
+    log.info("WAS Endpoint mode enabled")
+    names = [user_config.get("command_endpoint")]
+    fallback = user_config.get("command_endpoint_fallback")
+    if fallback:
+        names.extend(name.strip() for name in fallback.split(","))
+
+    endpoints = []
+    for name in names:
+        endpoint = create_endpoint(app, name, user_config)
+        if endpoint is None:
+            log.warning(f"unknown command endpoint {name}, ignoring it")
+            continue
+        endpoints.append(endpoint)
+
+    if len(endpoints) == 0:
+        return None
+    if len(endpoints) == 1:
+        return endpoints[0]
+
+    policy = user_config.get("command_endpoint_routing", RoutingPolicy.failover)
+    log.info(f"routing commands to {', '.join(e.name for e in endpoints)} with policy {policy}")
+    return RoutedEndpoint(endpoints, policy=policy)
+
+
+def create_endpoint(app, name, user_config):
+    endpoint = None
+
+    if name == "Home Assistant":
+
+        host = user_config["hass_host"]
+        port = user_config["hass_port"]
+        tls = user_config["hass_tls"]
+        token = user_config["hass_token"]
 
-    if "was_mode" in user_config and user_config["was_mode"]:
-        log.info("WAS Endpoint mode enabled")
+        fast_path = get_settings().ha_fast_path
+        multinet = get_settings().ha_multinet
 
-        if user_config["command_endpoint"] == "Home Assistant":
+        endpoint = HomeAssistantWebSocketEndpoint(app, host, port, tls, token, fast_path=fast_path, multinet=multinet)
 
-            host = user_config["hass_host"]
-            port = user_config["hass_port"]
-            tls = user_config["hass_tls"]
-            token = user_config["hass_token"]
+    elif name == "MQTT":
+        mqtt_config = MqttConfig()
+        mqtt_config.set_auth_type(user_config["mqtt_auth_type"])
+        mqtt_config.set_hostname(user_config["mqtt_host"])
+        mqtt_config.set_port(user_config["mqtt_port"])
+        mqtt_config.set_tls(user_config["mqtt_tls"])
+        mqtt_config.set_topic(user_config["mqtt_topic"])
 
-            app.command_endpoint = HomeAssistantWebSocketEndpoint(app, host, port, tls, token)
+        if 'mqtt_password' in user_config:
+            mqtt_config.set_password(user_config['mqtt_password'])
 
-        elif user_config["command_endpoint"] == "MQTT":
-            mqtt_config = MqttConfig()
-            mqtt_config.set_auth_type(user_config["mqtt_auth_type"])
-            mqtt_config.set_hostname(user_config["mqtt_host"])
-            mqtt_config.set_port(user_config["mqtt_port"])
-            mqtt_config.set_tls(user_config["mqtt_tls"])
-            mqtt_config.set_topic(user_config["mqtt_topic"])
+        if 'mqtt_username' in user_config:
+            mqtt_config.set_username(user_config['mqtt_username'])
 
-            if 'mqtt_password' in user_config:
-                mqtt_config.set_password(user_config['mqtt_password'])
+        if 'mqtt_wait_response' in user_config:
+            mqtt_config.set_wait_response(user_config['mqtt_wait_response'])
 
-            if 'mqtt_username' in user_config:
-                mqtt_config.set_username(user_config['mqtt_username'])
+        endpoint = MqttEndpoint(mqtt_config)
 
-            app.command_endpoint = MqttEndpoint(mqtt_config)
+    elif name == "openHAB":
+        endpoint = OpenhabEndpoint(user_config["openhab_url"], user_config["openhab_token"])
 
-        elif user_config["command_endpoint"] == "openHAB":
-            app.command_endpoint = OpenhabEndpoint(user_config["openhab_url"], user_config["openhab_token"])
+    elif name == "REST":
+        endpoint = RestEndpoint(user_config["rest_url"])
 
-        elif user_config["command_endpoint"] == "REST":
-            app.command_endpoint = RestEndpoint(user_config["rest_url"])
+        if hasattr(user_config, "rest_auth_type"):
+            endpoint.config.set_auth_type(user_config["rest_auth_type"])
 
-            if hasattr(user_config, "rest_auth_type"):
-                app.command_endpoint.config.set_auth_type(user_config["rest_auth_type"])
+        if "rest_auth_header" in user_config:
+            endpoint.config.set_auth_header(user_config["rest_auth_header"])
 
-            if "rest_auth_header" in user_config:
-                app.command_endpoint.config.set_auth_header(user_config["rest_auth_header"])
+        if "rest_auth_pass" in user_config:
+            endpoint.config.set_auth_pass(user_config["rest_auth_pass"])
 
-            if "rest_auth_pass" in user_config:
-                app.command_endpoint.config.set_auth_pass(user_config["rest_auth_pass"])
+        if "rest_auth_user" in user_config:
+            endpoint.config.set_auth_user(user_config["rest_auth_user"])
 
-            if "rest_auth_user" in user_config:
-                app.command_endpoint.config.set_auth_user(user_config["rest_auth_user"])
+    return endpoint
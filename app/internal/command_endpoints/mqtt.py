@@ -1,14 +1,18 @@
 import asyncio
 import json
 import logging
+import uuid
+
 import paho.mqtt.client as mqtt
 from . import (
     CommandEndpoint,
     CommandEndpointConfigException,
     CommandEndpointResponse,
     CommandEndpointResult,
-    CommandEndpointRuntimeException
+    CommandEndpointRuntimeException,
+    CommandEndpointTimeoutException,
 )
+from .pending import PendingRequests
 from enum import Enum
 
 
@@ -25,6 +29,8 @@ class MqttConfig:
     tls: bool = True
     topic: str = None
     username: str = None
+    # wait for a reply on <topic>/response, consumers like Node-RED flows or HA automations usually don't send one
+    wait_response: bool = False
 
     log = logging.getLogger("WAS")
 
@@ -50,6 +56,9 @@ class MqttConfig:
     def set_username(self, username=None):
         self.username = username
 
+    def set_wait_response(self, wait_response=False):
+        self.wait_response = wait_response
+
     def validate(self):
         if self.auth_type == MqttAuthType.USERPW:
             if self.password is None:
@@ -61,62 +70,213 @@ class MqttConfig:
 class MqttEndpoint(CommandEndpoint):
     name = "MQTT"
 
+    # deadline for a command, from publishing it until the PUBACK, or the reply on the response topic
+    timeout = 15.0
+
+    # commands are published with QoS 1, at most max_inflight of them can wait for a PUBACK at once
+    qos = 1
+    max_inflight = 16
+
+    keepalive = 60
+
     def __init__(self, config):
         self.config = config
         self.config.validate()
-        self.connected = False
         self.mqtt_client = None
+        self.response_topic = f"{self.config.topic}/response"
+
+        self.pending = PendingRequests(timeout=self.timeout)
+        self.inflight = asyncio.Semaphore(self.max_inflight)
+        # publish futures by MID, resolved when the broker acknowledged the message
+        self.publishing = {}
+        self.queue_full = 0
+
+        self.disconnected = asyncio.Event()
+        self.init_link()
+
+        self.loop = asyncio.get_event_loop()
+        self.task = self.loop.create_task(self.connect())
 
-        loop = asyncio.get_event_loop()
-        self.task = loop.create_task(self.connect())
+    def create_client(self):
+        mqtt_client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+        mqtt_client.on_connect = self.cb_connect
+        mqtt_client.on_disconnect = self.cb_disconnect
+        mqtt_client.on_message = self.cb_message
+        mqtt_client.on_publish = self.cb_publish
+        # run the network I/O on the asyncio loop instead of a paho thread
+        mqtt_client.on_socket_open = self.cb_socket_open
+        mqtt_client.on_socket_close = self.cb_socket_close
+        mqtt_client.on_socket_register_write = self.cb_socket_register_write
+        mqtt_client.on_socket_unregister_write = self.cb_socket_unregister_write
+        mqtt_client.max_inflight_messages_set(self.max_inflight)
+        mqtt_client.max_queued_messages_set(self.max_inflight)
+        if self.config.username is not None and self.config.password is not None:
+            mqtt_client.username_pw_set(self.config.username, self.config.password)
+        if self.config.tls:
+            mqtt_client.tls_set()
+        return mqtt_client
 
     async def connect(self):
+        self.mqtt_client = self.create_client()
+        await self.keep_connected(self.session)
+
+    async def session(self):
+        self.disconnected.clear()
+        # DNS lookup, TCP connect and TLS handshake block, keep them off the loop
+        await asyncio.to_thread(self.mqtt_client.connect, self.config.hostname, self.config.port, self.keepalive)
+        # keepalive pings and timeouts, the socket callbacks handle the rest
+        while not self.disconnected.is_set():
+            self.mqtt_client.loop_misc()
+            try:
+                await asyncio.wait_for(self.disconnected.wait(), 1)
+            except asyncio.TimeoutError:
+                pass
+
+    def call_on_loop(self, callback, *args):
+        # paho calls the socket callbacks from connect() in a worker thread, or from loop_read/loop_write/loop_misc
+        # on the loop, where the socket is closed right after the callback returns
         try:
-            self.mqtt_client = mqtt.Client()
-            self.mqtt_client.on_connect = self.cb_connect
-            self.mqtt_client.on_disconnect = self.cb_disconnect
-            self.mqtt_client.on_msg = self.cb_msg
-            if self.config.username is not None and self.config.password is not None:
-                self.mqtt_client.username_pw_set(self.config.username, self.config.password)
-            if self.config.tls:
-                self.mqtt_client.tls_set()
-            self.mqtt_client.connect_async(self.config.hostname, self.config.port, 60)
-            self.mqtt_client.loop_start()
-        except Exception as e:
-            self.log.info(f"{self.name}: exception occurred: {e}")
-            await asyncio.sleep(1)
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            callback(*args)
+        else:
+            self.loop.call_soon_threadsafe(callback, *args)
+
+    def cb_socket_open(self, client, userdata, sock):
+        self.call_on_loop(self.loop.add_reader, sock, client.loop_read)
+
+    def cb_socket_close(self, client, userdata, sock):
+        self.call_on_loop(self.loop.remove_reader, sock)
+
+    def cb_socket_register_write(self, client, userdata, sock):
+        self.call_on_loop(self.loop.add_writer, sock, client.loop_write)
+
+    def cb_socket_unregister_write(self, client, userdata, sock):
+        self.call_on_loop(self.loop.remove_writer, sock)
 
-    def cb_connect(self, client, userdata, flags, rc):
+    def cb_connect(self, client, userdata, flags, reason_code, properties):
+        if reason_code.is_failure:
+            self.log.info(f"{self.name}: connection refused: {reason_code}")
+            self.last_error = str(reason_code)
+            return
         self.connected = True
-        self.log.info("MQTT connected")
-        client.subscribe(self.config.topic)
+        self.set_link_state("connected")
+        self.log.info(f"{self.name}: connected")
+        if self.config.wait_response:
+            client.subscribe(self.response_topic, qos=self.qos)
 
-    def cb_disconnect(self, client, userdata, rc):
-        self.connected = False
-        self.log.info("MQTT disconnected")
+    def cb_disconnect(self, client, userdata, flags, reason_code, properties):
+        self.link_lost()
+        self.log.info(f"{self.name}: disconnected: {reason_code}")
+        self.disconnected.set()
 
-    def cb_msg(self, client, userdata, msg):
-        self.log.info(f"cb_msg: topic={msg.topic} payload={msg.payload}")
+    def cb_publish(self, client, userdata, mid, reason_code, properties):
+        future = self.publishing.pop(mid, None)
+        if future is not None and not future.done():
+            future.set_result(reason_code)
+
+    def cb_message(self, client, userdata, msg):
+        self.log.debug(f"cb_message: topic={msg.topic} payload={msg.payload}")
+        try:
+            response = json.loads(msg.payload)
+            id = response["id"]
+        except Exception as e:
+            self.log.warning(f"{self.name}: ignoring invalid response on {msg.topic}: {e}")
+            return
+        if self.pending.resolve(id, response) is None:
+            self.log.debug(f"received response for unknown request {id}")
 
     def parse_response(self, response):
         res = CommandEndpointResult()
-        if response.ok:
+        if response.get("ok", False):
             res.ok = True
-            if len(res.speech) > 0:
-                res.speech = response.text
-            else:
-                res.speech = "Success!"
+            res.speech = "Success!"
+        if response.get("speech"):
+            res.speech = response["speech"]
 
         command_endpoint_response = CommandEndpointResponse(result=res)
         return command_endpoint_response.model_dump_json()
 
-    def send(self, data=None, jsondata=None, ws=None, client=None):
+    async def publish(self, payload):
+        """ Publish payload to the command topic and wait for the PUBACK """
+        # wait for a free inflight slot, a stalled broker stops us here instead of growing the queue
+        async with self.inflight:
+            info = self.mqtt_client.publish(self.config.topic, payload=payload, qos=self.qos)
+            if info.rc == mqtt.MQTT_ERR_QUEUE_SIZE:
+                self.queue_full += 1
+                raise CommandEndpointRuntimeException(f"{self.name} publish queue full")
+            if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                raise CommandEndpointRuntimeException(f"{self.name} publish failed: {mqtt.error_string(info.rc)}")
+
+            future = self.loop.create_future()
+            self.publishing[info.mid] = future
+            try:
+                await future
+            finally:
+                self.publishing.pop(info.mid, None)
+
+    async def publish_request(self, id, payload):
+        try:
+            await self.publish(json.dumps(payload))
+            request = self.pending.get(id)
+            if request is not None:
+                request.acked = True
+        except CommandEndpointRuntimeException as e:
+            self.pending.fail(id, e)
+
+    async def send(self, data=None, jsondata=None, ws=None, client=None):
         if not self.connected:
             raise CommandEndpointRuntimeException(f"{self.name} not connected")
+
+        if not self.config.wait_response:
+            # the command is done once the broker has it, there is no response to pass on
+            payload = json.dumps(jsondata) if jsondata is not None else data
+            try:
+                await asyncio.wait_for(self.publish(payload), self.timeout)
+            except asyncio.TimeoutError:
+                raise CommandEndpointTimeoutException(f"{self.name} publish not acknowledged within {self.timeout}s")
+            return None
+
+        id = uuid.uuid4().hex
+        payload = dict(jsondata if jsondata is not None else {"text": data})
+        payload["id"] = id
+        payload["response_topic"] = self.response_topic
+
+        request = self.pending.add(id, ws, payload)
+        request.sent = True
+        self.log.debug(f"publishing to {self.config.topic}: {payload}")
+        publish = self.loop.create_task(self.publish_request(id, payload))
         try:
-            if jsondata is not None:
-                self.mqtt_client.publish(self.config.topic, payload=json.dumps(jsondata))
-            else:
-                self.mqtt_client.publish(self.config.topic, payload=data)
-        except Exception as e:
-            raise CommandEndpointRuntimeException(e)
+            return await request.future
+        finally:
+            publish.cancel()
+
+    def outstanding(self):
+        # requests waiting for a response, and commands waiting for their PUBACK
+        return len(self.pending) + len(self.publishing)
+
+    def status(self):
+        return {
+            'name': self.name,
+            'link': {
+                'state': self.link_state,
+                'since': self.link_since,
+                'disconnects': self.disconnects,
+                'reconnects': self.reconnects,
+                'last_error': self.last_error,
+            },
+            'publish': {
+                'inflight': len(self.publishing),
+                'max_inflight': self.max_inflight,
+                'queue_full': self.queue_full,
+            },
+            'requests': self.pending.stats(),
+        }
+
+    def stop(self):
+        self.log.info(f"stopping {self.name}")
+        self.task.cancel()
+        if self.mqtt_client is not None:
+            self.mqtt_client.disconnect()
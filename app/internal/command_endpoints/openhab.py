@@ -5,8 +5,8 @@ class OpenhabEndpoint(RestEndpoint):
     name = "WAS openHAB Endpoint"
 
     def __init__(self, url, token):
+        super().__init__(f"{url}/rest/voice/interpreters")
         self.config = RestConfig(auth_type=RestAuthType.BASIC, auth_user=token)
-        self.url = f"{url}/rest/voice/interpreters"
 
-    def send(self, jsondata=None, ws=None, client=None):
-        return super().send(data=jsondata["text"])
+    async def send(self, jsondata=None, ws=None, client=None):
+        return await super().send(data=jsondata["text"])
@@ -0,0 +1,111 @@
+import asyncio
+import time
+
+from collections import OrderedDict, deque
+
+from app.internal.stats import percentile
+
+from . import CommandEndpointRuntimeException, CommandEndpointTimeoutException
+
+
+class PendingRequest:
+    def __init__(self, id, ws, payload):
+        self.acked = False
+        self.future = asyncio.get_event_loop().create_future()
+        self.id = id
+        self.payload = payload
+        self.sent = False
+        self.start = time.monotonic()
+        self.timer = None
+        self.ws = ws
+
+
+class PendingRequests:
+    """Bounded registry of requests waiting for a response from a command endpoint
+
+    Every request has a future that resolves to the response, or fails with
+    CommandEndpointTimeoutException when no response arrived within timeout seconds.
+    When the registry is full, the oldest request is failed to make room.
+    """
+
+    def __init__(self, maxsize=256, timeout=15.0, history=100):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.requests = OrderedDict()
+        self.rtt = deque(maxlen=history)
+        self.completed = 0
+        self.evicted = 0
+        self.failed = 0
+        self.timed_out = 0
+
+    def __contains__(self, id):
+        return id in self.requests
+
+    def __len__(self):
+        return len(self.requests)
+
+    def add(self, id, ws, payload=None):
+        while len(self.requests) >= self.maxsize:
+            oldest = next(iter(self.requests))
+            self.evicted += 1
+            self.fail(oldest, CommandEndpointRuntimeException("too many pending requests"))
+
+        request = PendingRequest(id, ws, payload)
+        request.timer = asyncio.get_event_loop().call_later(self.timeout, self.expire, id)
+        self.requests[id] = request
+        return request
+
+    def get(self, id):
+        return self.requests.get(id)
+
+    def pop(self, id):
+        request = self.requests.pop(id, None)
+        if request is not None:
+            request.timer.cancel()
+        return request
+
+    def rekey(self, id, new_id):
+        request = self.requests.pop(id)
+        request.id = new_id
+        self.requests[new_id] = request
+        return request
+
+    def resolve(self, id, result):
+        request = self.pop(id)
+        if request is None:
+            return None
+
+        self.completed += 1
+        self.rtt.append((time.monotonic() - request.start) * 1000)
+        if not request.future.done():
+            request.future.set_result(result)
+        return request
+
+    def fail(self, id, exception):
+        request = self.pop(id)
+        if request is None:
+            return None
+
+        self.failed += 1
+        if not request.future.done():
+            request.future.set_exception(exception)
+        return request
+
+    def expire(self, id):
+        request = self.requests.get(id)
+        if request is None:
+            return
+        self.timed_out += 1
+        self.fail(id, CommandEndpointTimeoutException(f"no response within {self.timeout}s", delivered=request.acked))
+
+    def stats(self):
+        return {
+            'pending': len(self.requests),
+            'completed': self.completed,
+            'failed': self.failed,
+            'timed_out': self.timed_out,
+            'evicted': self.evicted,
+            'rtt_p50_ms': percentile(self.rtt, 50),
+            'rtt_p95_ms': percentile(self.rtt, 95),
+            'rtt_max_ms': max(self.rtt) if self.rtt else None,
+        }
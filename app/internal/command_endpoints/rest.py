@@ -1,15 +1,19 @@
-import json
+import asyncio
+import httpx
 import logging
 from . import (
     CommandEndpoint,
     CommandEndpointConfigException,
     CommandEndpointResponse,
     CommandEndpointResult,
-    CommandEndpointRuntimeException
+    CommandEndpointRuntimeException,
+    CommandEndpointTimeoutException,
 )
 from enum import Enum
-from requests import request
-from requests.auth import HTTPBasicAuth
+
+
+# keep a reference to client close tasks so they aren't garbage collected, the endpoint goes away once stopped
+close_tasks = set()
 
 
 class RestAuthType(Enum):
@@ -52,13 +56,34 @@ class RestConfig():
 class RestEndpoint(CommandEndpoint):
     name = "REST"
 
+    # deadline for the whole request, including connect and reading the response
+    timeout = 30.0
+
     def __init__(self, url):
         self.config = RestConfig()
+        # requests waiting for a response, the client is only closed once they're done
+        self.requests = 0
         self.url = url
+        # pooled keep-alive connections, shared by all requests to this endpoint
+        self.client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=32, max_keepalive_connections=8),
+            timeout=httpx.Timeout(self.timeout, connect=1.0),
+        )
+
+    async def probe(self, timeout):
+        # any HTTP response means the endpoint is reachable, even if it doesn't allow HEAD
+        try:
+            await self.client.head(self.url, timeout=timeout)
+        except httpx.TransportError:
+            return False
+        return True
+
+    def outstanding(self):
+        return self.requests
 
     def parse_response(self, response):
         res = CommandEndpointResult()
-        if response.ok:
+        if response.is_success:
             res.ok = True
             if len(res.speech) > 0:
                 res.speech = response.text
@@ -68,7 +93,8 @@ class RestEndpoint(CommandEndpoint):
         command_endpoint_response = CommandEndpointResponse(result=res)
         return command_endpoint_response.model_dump_json()
 
-    def send(self, data=None, jsondata=None, ws=None, client=None):
+    async def send(self, data=None, jsondata=None, ws=None, client=None):
+        self.requests += 1
         try:
             basic = None
             headers = {}
@@ -79,7 +105,7 @@ class RestEndpoint(CommandEndpoint):
                 headers['Content-Type'] = 'text/plain'
 
             if self.config.auth_type == RestAuthType.BASIC:
-                basic = HTTPBasicAuth(self.config.auth_user, self.config.auth_pass)
+                basic = httpx.BasicAuth(self.config.auth_user, self.config.auth_pass)
             elif self.config.auth_type == RestAuthType.HEADER:
                 headers['Authorization'] = self.config.auth_header
             elif self.config.auth_type == RestAuthType.NONE:
@@ -87,7 +113,18 @@ class RestEndpoint(CommandEndpoint):
             else:
                 raise CommandEndpointConfigException("invalid REST auth type")
 
-            return request("POST", self.url, auth=basic, data=data, headers=headers, json=jsondata, timeout=(1, 30))
+            request = self.client.post(self.url, auth=basic, content=data, headers=headers, json=jsondata)
+            return await asyncio.wait_for(request, self.timeout)
 
+        except asyncio.TimeoutError:
+            raise CommandEndpointTimeoutException(f"no response from {self.name} within {self.timeout}s")
         except Exception as e:
             raise CommandEndpointRuntimeException(e)
+        finally:
+            self.requests -= 1
+
+    def stop(self):
+        self.log.info(f"stopping {self.name}")
+        task = asyncio.ensure_future(self.client.aclose())
+        close_tasks.add(task)
+        task.add_done_callback(close_tasks.discard)
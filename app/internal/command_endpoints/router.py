@@ -0,0 +1,183 @@
+import asyncio
+import time
+
+from collections import deque
+from enum import Enum
+
+from app.internal.stats import percentile
+
+from . import CommandEndpoint, CommandEndpointRuntimeException
+
+
+class RoutingPolicy(str, Enum):
+    failover = "failover"
+    hedge = "hedge"
+
+
+class RoutedEndpointStats:
+    __slots__ = ("errors", "latency", "requests", "wins")
+
+    def __init__(self, history):
+        self.errors = 0
+        self.latency = deque(maxlen=history)
+        self.requests = 0
+        self.wins = 0
+
+    def model_dump(self):
+        return {
+            'errors': self.errors,
+            'latency_p50_ms': percentile(self.latency, 50),
+            'latency_p95_ms': percentile(self.latency, 95),
+            'requests': self.requests,
+            'wins': self.wins,
+        }
+
+
+class RoutedEndpoint(CommandEndpoint):
+    """Send commands to an ordered list of command endpoints
+
+    failover: try the endpoints in order, moving on to the next one when an endpoint fails or times out.
+    Endpoints that are known to be disconnected are skipped, unless all of them are.
+
+    hedge: send to the first endpoint, and also to the next one when there is no answer within the
+    hedge delay, or as soon as the previous one failed. The first answer wins, the others are cancelled.
+    The hedge delay is the p95 latency of the endpoint we're waiting for, so hedging only kicks in when
+    it is slower than usual. Hedged commands can be executed by more than one endpoint.
+    """
+
+    name = "WAS Routed Endpoint"
+
+    hedge_delay_default = 1.0
+    hedge_delay_max = 5.0
+    hedge_delay_min = 0.1
+    # latency samples needed before the p95 is trusted
+    hedge_min_samples = 10
+
+    def __init__(self, endpoints, policy=RoutingPolicy.failover, history=100):
+        self.endpoints = endpoints
+        self.policy = RoutingPolicy(policy)
+        self.stats = [RoutedEndpointStats(history) for _ in endpoints]
+        self.hedged = 0
+        self.timeout = max(getattr(endpoint, "timeout", 0) for endpoint in endpoints)
+
+    @property
+    def link_up(self):
+        return self.endpoints[0].link_up
+
+    def hedge_delay(self, i):
+        latency = self.stats[i].latency
+        if len(latency) < self.hedge_min_samples:
+            return self.hedge_delay_default
+        delay = percentile(latency, 95) / 1000
+        return min(self.hedge_delay_max, max(self.hedge_delay_min, delay))
+
+    def is_up(self, endpoint):
+        return endpoint.link_up is None or endpoint.link_up.is_set()
+
+    async def send_one(self, i, jsondata, ws, client):
+        endpoint = self.endpoints[i]
+        stats = self.stats[i]
+        stats.requests += 1
+        start = time.monotonic()
+        try:
+            # endpoints might modify the command
+            response = await endpoint.send(jsondata=dict(jsondata), ws=ws, client=client)
+        except CommandEndpointRuntimeException:
+            stats.errors += 1
+            raise
+        stats.latency.append((time.monotonic() - start) * 1000)
+        return endpoint, response
+
+    async def send_failover(self, jsondata, ws, client):
+        order = [i for i, endpoint in enumerate(self.endpoints) if self.is_up(endpoint)]
+        if len(order) == 0:
+            order = list(range(len(self.endpoints)))
+
+        error = None
+        for i in order:
+            try:
+                response = await self.send_one(i, jsondata, ws, client)
+                self.stats[i].wins += 1
+                return response
+            except CommandEndpointRuntimeException as e:
+                self.log.info(f"{self.endpoints[i].name} failed, trying next endpoint: {e}")
+                error = e
+        raise error
+
+    async def send_hedge(self, jsondata, ws, client):
+        tasks = {}
+        error = None
+        upcoming = 0
+        try:
+            while True:
+                if upcoming < len(self.endpoints):
+                    tasks[asyncio.ensure_future(self.send_one(upcoming, jsondata, ws, client))] = upcoming
+                    upcoming += 1
+
+                # once all endpoints were sent to, there is nothing to hedge to and we wait for the first answer
+                delay = None
+                if upcoming < len(self.endpoints):
+                    delay = self.hedge_delay(upcoming - 1)
+
+                if len(tasks) == 0:
+                    raise error
+
+                done, _ = await asyncio.wait(tasks, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+                if len(done) == 0:
+                    self.hedged += 1
+                    self.log.info(f"no answer within {delay:.3f}s, hedging to {self.endpoints[upcoming].name}")
+                    continue
+
+                for task in done:
+                    i = tasks.pop(task)
+                    try:
+                        response = task.result()
+                    except CommandEndpointRuntimeException as e:
+                        self.log.info(f"{self.endpoints[i].name} failed: {e}")
+                        error = e
+                        continue
+                    self.stats[i].wins += 1
+                    return response
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def send(self, jsondata=None, ws=None, client=None):
+        if self.policy == RoutingPolicy.hedge:
+            return await self.send_hedge(jsondata, ws, client)
+        return await self.send_failover(jsondata, ws, client)
+
+    def outstanding(self):
+        return sum(endpoint.outstanding() for endpoint in self.endpoints)
+
+    def responder(self, response):
+        # send returns the winning endpoint with its response
+        return response[0].name
+
+    def parse_response(self, response):
+        endpoint, response = response
+        # e.g. MQTT without waiting for a reply
+        if response is None:
+            return None
+        return endpoint.parse_response(response)
+
+    async def probe(self, timeout):
+        for endpoint in self.endpoints:
+            if await endpoint.probe(timeout):
+                return True
+        return False
+
+    def status(self):
+        return {
+            'name': self.name,
+            'policy': self.policy.value,
+            'hedged': self.hedged,
+            'endpoints': [
+                endpoint.status() | {'routing': stats.model_dump()}
+                for endpoint, stats in zip(self.endpoints, self.stats)
+            ],
+        }
+
+    def stop(self):
+        for endpoint in self.endpoints:
+            endpoint.stop()
@@ -1,7 +1,7 @@
 from enum import Enum
 from typing import Optional
 
-from pydantic import BaseModel, ConfigDict
+from pydantic import BaseModel, ConfigDict, field_validator
 
 
 class WillowAudioCodec(str, Enum):
@@ -22,6 +22,11 @@ class WillowCommandEndpoint(str, Enum):
     REST = 'REST'
 
 
+class WillowCommandEndpointRouting(str, Enum):
+    failover = 'failover'
+    hedge = 'hedge'
+
+
 class WillowMqttAuthType(str, Enum):
     none = 'none'
     userpw = 'userpw'
@@ -63,6 +68,9 @@ class WillowConfig(BaseModel, validate_assignment=True):
     audio_response_type: WillowAudioResponseType = None
     bss: bool = None
     command_endpoint: WillowCommandEndpoint = None
+    # comma separated list of endpoints to use after command_endpoint, e.g. "REST" or "MQTT,REST"
+    command_endpoint_fallback: Optional[str] = None
+    command_endpoint_routing: Optional[WillowCommandEndpointRouting] = None
     display_timeout: int = None
     hass_host: Optional[str] = None
     hass_port: Optional[int] = None
@@ -77,6 +85,7 @@ class WillowConfig(BaseModel, validate_assignment=True):
     mqtt_tls: Optional[bool] = None
     mqtt_topic: Optional[str] = None
     mqtt_username: Optional[str] = None
+    mqtt_wait_response: Optional[bool] = None
     multiwake: bool = None
     ntp_config: WillowNtpConfig = None
     ntp_host: Optional[str] = None
@@ -107,6 +116,14 @@ class WillowConfig(BaseModel, validate_assignment=True):
     # use Enum strings instead of e.g. WillowAudioCodec.PCM
     model_config = ConfigDict(use_enum_values=True)
 
+    @field_validator('command_endpoint_fallback')
+    @classmethod
+    def validate_command_endpoint_fallback(cls, value):
+        if value:
+            for endpoint in value.split(","):
+                WillowCommandEndpoint(endpoint.strip())
+        return value
+
 
 class WillowNvsWas(BaseModel):
     URL: str = None
@@ -0,0 +1,106 @@
+import asyncio
+import hashlib
+import json
+
+from collections import OrderedDict
+from logging import getLogger
+
+from app.const import CONFIG_VERSION_HISTORY
+from app.db.main import run_db, save_config_version_to_db
+
+
+log = getLogger("WAS")
+
+
+class ConfigVersions:
+    """Monotonically increasing versions of the config, to push only what changed to devices
+
+    Every config with a new content hash gets the next version number.
+    Devices that report config_version and config_hash in hello are version aware: they get
+    {"config": ..., "config_hash": H, "config_version": N} for a full config, or
+    {"config_delta": {"from": M, "hash": H, "to": N, "set": {...}, "unset": [...]}} when WAS still knows
+    the version they have, and acknowledge with {"config_ack": {"hash": H, "version": N}}.
+    Version numbers start over after a database reset, so a version only counts as known when its hash matches.
+    Devices without a version, e.g. older firmware, always get the full config without version.
+    """
+
+    def __init__(self, history=CONFIG_VERSION_HISTORY, persist=False):
+        self.data = {}
+        # delta messages to the current version, by version of the device
+        self.deltas = {}
+        self.full = None
+        self.hash = None
+        self.history = OrderedDict()
+        self.keep = history
+        self.lock = asyncio.Lock()
+        self.persist = persist
+        self.version = 0
+
+    def add(self, version, hash, data):
+        self.history[version] = (hash, data)
+        while len(self.history) > self.keep:
+            self.history.popitem(last=False)
+
+        self.data = data
+        self.deltas = {}
+        self.full = json.dumps({"config": data, "config_hash": hash, "config_version": version}, sort_keys=True)
+        self.hash = hash
+        self.version = version
+
+    def load(self, records):
+        """ Restore versions saved by save_config_version_to_db """
+        for record in records:
+            self.add(record["version"], record["hash"], json.loads(record["data"]))
+
+    async def update(self, data):
+        """ Make data the current config, returns True if it differs from the current version """
+        serialized = json.dumps(data, sort_keys=True)
+        hash = hashlib.sha256(serialized.encode()).hexdigest()
+
+        # concurrent updates would get the same version number
+        async with self.lock:
+            if hash == self.hash:
+                return False
+
+            version = self.version + 1
+            if self.persist:
+                await run_db(save_config_version_to_db, version, hash, serialized, self.keep)
+            self.add(version, hash, data)
+
+        log.info(f"config version {version} ({hash[:12]})")
+        return True
+
+    def get_msg(self, version, hash):
+        """ Message that brings a device from version to the current version, None if it is current
+
+        Unknown versions, e.g. older than the kept history, and versions with a different hash,
+        e.g. from before a database reset, get the full config.
+        """
+        if version == self.version and hash == self.hash:
+            return None
+
+        known = self.history.get(version)
+        if known is None or known[0] != hash:
+            return self.full
+
+        msg = self.deltas.get(version)
+        if msg is not None:
+            return msg
+
+        old = known[1]
+        delta = {
+            "from": version,
+            "hash": self.hash,
+            "set": {k: v for k, v in self.data.items() if old.get(k) != v},
+            "to": self.version,
+            "unset": [k for k in old if k not in self.data],
+        }
+        msg = self.deltas[version] = json.dumps({"config_delta": delta}, sort_keys=True)
+        return msg
+
+    def stats(self):
+        return {
+            'hash': self.hash,
+            'history': list(self.history),
+            'version': self.version,
+        }
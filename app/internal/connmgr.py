@@ -1,23 +1,57 @@
+import asyncio
 import logging
 
+from enum import Enum
 from fastapi import (
     WebSocket,
     WebSocketException,
 )
-from pydantic import BaseModel, ConfigDict, FieldSerializationInfo, SerializerFunctionWrapHandler, field_serializer
-from typing import Dict
+from pydantic import BaseModel, ConfigDict, Field, FieldSerializationInfo, SerializerFunctionWrapHandler, field_serializer
+from typing import Callable, Dict, List, Optional, Union
+
+from app.internal.metrics import WS_MESSAGES_SENT, message_type
 
 from .client import Client
+from .sendqueue import SendQueue, SendQueuePolicy
 
 
 log = logging.getLogger("WAS")
 
 
+class BroadcastStatus(str, Enum):
+    ok = "ok"
+    timeout = "timeout"
+    error = "error"
+    disconnected = "disconnected"
+    skipped = "skipped"
+
+
+class BroadcastDelivery(BaseModel):
+    hostname: str
+    mac_addr: str
+    remote: str
+    status: BroadcastStatus
+
+
 class ConnMgr(BaseModel):
     model_config = ConfigDict(arbitrary_types_allowed=True)
 
     connected_clients: Dict[WebSocket, Client] = {}
 
+    # per client send deadline for broadcasts, in seconds
+    broadcast_timeout: float = Field(default=2.0, exclude=True)
+    # disconnect clients after missing this many consecutive broadcast deadlines
+    broadcast_max_missed: int = Field(default=3, exclude=True)
+    send_queue_policy: SendQueuePolicy = Field(default=SendQueuePolicy.drop_oldest, exclude=True)
+    send_queue_size: int = Field(default=64, exclude=True)
+    send_queues: Dict[WebSocket, SendQueue] = Field(default={}, exclude=True)
+
+    # secondary indexes for O(1) lookups, kept in sync by accept, disconnect and update_client
+    # each key maps to an insertion ordered dict used as set, as hostnames and MACs are not guaranteed to be unique
+    # e.g. when a device reconnects before the old connection timed out
+    hostname_index: Dict[str, Dict[WebSocket, None]] = Field(default={}, exclude=True)
+    mac_index: Dict[str, Dict[WebSocket, None]] = Field(default={}, exclude=True)
+
     @field_serializer('connected_clients', mode='wrap')
     def serialize_connected_clients(self, value: Dict[WebSocket, Client], nxt: SerializerFunctionWrapHandler, info: FieldSerializationInfo) -> Dict[str, Client]:
         serialized_dict = {}
@@ -26,47 +60,144 @@ class ConnMgr(BaseModel):
             serialized_dict[remote] = client
         return nxt(serialized_dict)
 
+    def _index_add(self, index, key, ws):
+        if key in index:
+            index[key][ws] = None
+        else:
+            index[key] = {ws: None}
+
+    def _index_remove(self, index, key, ws):
+        entries = index.get(key)
+        if entries is None:
+            return
+        entries.pop(ws, None)
+        if len(entries) == 0:
+            del index[key]
+
+    def _index_latest(self, index, key):
+        # prefer the most recently registered connection, older ones are likely stale
+        entries = index.get(key)
+        if entries:
+            return next(reversed(entries))
+        return None
+
     async def accept(self, ws: WebSocket, client: Client):
         try:
             await ws.accept()
             self.connected_clients[ws] = client
+            send_queue = SendQueue(ws, self.send_queue_size, self.send_queue_policy, on_overflow=self.close)
+            send_queue.start()
+            self.send_queues[ws] = send_queue
+            self._index_add(self.hostname_index, client.hostname, ws)
+            self._index_add(self.mac_index, client.mac_addr, ws)
         except WebSocketException as e:
             log.error(f"Failed to accept websocket connection: {e}")
 
-    async def broadcast(self, msg: str):
-        for client in self.connected_clients:
-            try:
-                await client.send_text(msg)
-            except Exception as e:
-                log.error(f"Failed to broadcast message: {e}")
+    async def broadcast(self, msg: Union[str, Callable[[Client], Optional[str]]]) -> List[BroadcastDelivery]:
+        """ Send msg to all clients
+
+        msg can be a function that builds the message for a client, clients it returns None for are skipped.
+        """
+        clients = list(self.connected_clients.items())
+        results = await asyncio.gather(*[self._broadcast_one(ws, client, msg) for ws, client in clients])
+
+        report = []
+        for (ws, client), status in zip(clients, results):
+            report.append(BroadcastDelivery(
+                hostname=client.hostname,
+                mac_addr=client.mac_addr,
+                remote=f"{ws.client.host}:{ws.client.port}",
+                status=status,
+            ))
+
+        return report
+
+    async def _broadcast_one(self, ws, client, msg):
+        if callable(msg):
+            msg = msg(client)
+            if msg is None:
+                return BroadcastStatus.skipped
+        try:
+            if not await asyncio.wait_for(self.send(ws, msg), self.broadcast_timeout):
+                return BroadcastStatus.error
+            client.record_deadline(True)
+            return BroadcastStatus.ok
+        except asyncio.TimeoutError:
+            client.record_deadline(False)
+            log.warning(f"broadcast to {client.hostname} missed deadline ({client.missed_deadlines} consecutive)")
+            if client.missed_deadlines >= self.broadcast_max_missed:
+                await self.close(ws)
+                return BroadcastStatus.disconnected
+            return BroadcastStatus.timeout
+        except Exception as e:
+            log.error(f"Failed to broadcast message to {client.hostname}: {e}")
+            return BroadcastStatus.error
+
+    async def close(self, ws: WebSocket):
+        client = self.connected_clients.get(ws)
+        hostname = client.hostname if client is not None else "unknown"
+        log.warning(f"closing connection to slow client {hostname}")
+        self.disconnect(ws)
+        try:
+            await asyncio.wait_for(ws.close(), self.broadcast_timeout)
+        except Exception as e:
+            log.debug(f"failed to close connection to {hostname}: {e}")
 
     def disconnect(self, ws: WebSocket):
         if ws in self.connected_clients:
-            self.connected_clients.pop(ws)
+            client = self.connected_clients.pop(ws)
+            self._index_remove(self.hostname_index, client.hostname, ws)
+            self._index_remove(self.mac_index, client.mac_addr, ws)
+
+        send_queue = self.send_queues.pop(ws, None)
+        if send_queue is not None:
+            send_queue.stop()
+
+    def send(self, ws: WebSocket, msg: str) -> asyncio.Future:
+        """ Queue msg on the outbound queue of ws
+
+        Returns a future that resolves to True once the message was sent,
+        or False if it was dropped or could not be sent.
+        The future can be ignored for fire-and-forget messages.
+        """
+        send_queue = self.send_queues.get(ws)
+        if send_queue is None:
+            log.debug("send: connection not found, dropping message")
+            fut = asyncio.get_event_loop().create_future()
+            fut.set_result(False)
+            return fut
+
+        WS_MESSAGES_SENT.inc(message_type(msg))
+        return send_queue.put(msg)
+
+    def get_send_queue_stats(self):
+        stats = {}
+        for ws, send_queue in self.send_queues.items():
+            client = self.connected_clients.get(ws)
+            stats[f"{ws.client.host}:{ws.client.port}"] = {
+                'hostname': client.hostname if client is not None else "unknown",
+                **send_queue.stats.model_dump(),
+            }
+        return stats
 
     def get_client_by_hostname(self, hostname):
-        for k, v in self.connected_clients.items():
-            if v.hostname == hostname:
-                return k
+        return self._index_latest(self.hostname_index, hostname)
 
     def get_client_by_ws(self, ws):
         return self.connected_clients[ws]
 
     def get_mac_by_hostname(self, hostname):
-        for k, v in self.connected_clients.items():
-            if v.hostname == hostname:
-                return v.mac_addr
+        ws = self._index_latest(self.hostname_index, hostname)
+        if ws is None:
+            return None
 
-        return None
+        return self.connected_clients[ws].mac_addr
 
     def get_ws_by_mac(self, mac):
-        for k, v in self.connected_clients.items():
-            # log.debug(f"get_ws_by_mac: {k} {v.mac_addr}")
-            if v.mac_addr == mac:
-                return k
-
-        log.debug("get_ws_by_mac: returning None")
-        return None
+        ws = self._index_latest(self.mac_index, mac)
+        if ws is None:
+            log.debug("get_ws_by_mac: returning None")
+        return ws
 
     def is_notification_active(self, ws):
         return self.connected_clients[ws].is_notification_active()
@@ -75,9 +206,17 @@ class ConnMgr(BaseModel):
         self.connected_clients[ws].set_notification_active(id)
 
     def update_client(self, ws, key, value):
-        if key == "hostname":
-            self.connected_clients[ws].set_hostname(value)
+        client = self.connected_clients[ws]
+        if key == "config_version":
+            # (version, hash)
+            client.set_config_version(*value)
+        elif key == "hostname":
+            self._index_remove(self.hostname_index, client.hostname, ws)
+            client.set_hostname(value)
+            self._index_add(self.hostname_index, client.hostname, ws)
         elif key == "platform":
-            self.connected_clients[ws].set_platform(value)
+            client.set_platform(value)
         elif key == "mac_addr":
-            self.connected_clients[ws].set_mac_addr(value)
+            self._index_remove(self.mac_index, client.mac_addr, ws)
+            client.set_mac_addr(value)
+            self._index_add(self.mac_index, client.mac_addr, ws)
@@ -0,0 +1,106 @@
+from bisect import bisect_left
+from logging import getLogger
+from time import perf_counter_ns
+
+from app.internal.metrics import WS_HANDLER_DURATION, WS_MESSAGES_RECEIVED
+
+log = getLogger("WAS")
+
+# histogram buckets of WS_HANDLER_DURATION in ns, so record() doesn't convert every duration
+BUCKETS_NS = tuple(int(bound * 1e9) for bound in WS_HANDLER_DURATION.buckets)
+
+
+class HandlerStats:
+    """Per message type handler stats, also the source of the WebSocket Prometheus metrics
+
+    Plain class instead of a pydantic model, record() is called for every message.
+    The histogram is collected into WS_HANDLER_DURATION at scrape time instead of updating it per message.
+    """
+
+    __slots__ = ("buckets", "count", "errors", "max_ns", "total_ns")
+
+    def __init__(self):
+        # per bucket counts, the last one is +Inf
+        self.buckets = [0] * (len(BUCKETS_NS) + 1)
+        self.count = 0
+        self.errors = 0
+        self.max_ns = 0
+        self.total_ns = 0
+
+    def record(self, duration_ns, error=False):
+        self.buckets[bisect_left(BUCKETS_NS, duration_ns)] += 1
+        self.count += 1
+        if error:
+            self.errors += 1
+        self.total_ns += duration_ns
+        if duration_ns > self.max_ns:
+            self.max_ns = duration_ns
+
+    def model_dump(self):
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "total_ms": self.total_ns / 1e6,
+            "avg_ms": self.total_ns / 1e6 / self.count if self.count else 0.0,
+            "max_ms": self.max_ns / 1e6,
+        }
+
+
+class MessageDispatcher:
+    """Route decoded WebSocket messages to registered handlers
+
+    Willow messages are identified by their top level key, e.g. {"hello": {...}}.
+    Command messages are identified by the value of the cmd key, and registered as cmd/<command>.
+    """
+
+    def __init__(self):
+        self.handlers = {}
+        self.stats = {}
+        # messages without handler, counted as one type so arbitrary commands can't grow the metric labels
+        self.unknown = 0
+
+    def register(self, msg_type):
+        def decorator(handler):
+            self.handlers[msg_type] = handler
+            self.stats[msg_type] = HandlerStats()
+            return handler
+        return decorator
+
+    def message_type(self, msg):
+        for key in msg:
+            if key == "cmd":
+                return f"cmd/{msg['cmd']}"
+            if key in self.handlers:
+                return key
+        return None
+
+    async def dispatch(self, ws, client, msg):
+        msg_type = self.message_type(msg)
+        handler = self.handlers.get(msg_type)
+        if handler is None:
+            self.unknown += 1
+            log.debug(f"no handler for message type {msg_type}")
+            return
+
+        stats = self.stats[msg_type]
+        start = perf_counter_ns()
+        try:
+            await handler(ws, client, msg)
+        except Exception:
+            stats.record(perf_counter_ns() - start, error=True)
+            raise
+        stats.record(perf_counter_ns() - start)
+
+    def get_stats(self):
+        return {msg_type: stats.model_dump() for msg_type, stats in self.stats.items()}
+
+    def collect_metrics(self):
+        """ Copy the handler stats into the WebSocket Prometheus metrics, called when they are scraped """
+        received = {("unknown",): self.unknown}
+        durations = {}
+        for msg_type, stats in self.stats.items():
+            received[(msg_type,)] = stats.count
+            if stats.count:
+                durations[(msg_type,)] = stats.buckets + [stats.total_ns / 1e9]
+        WS_MESSAGES_RECEIVED.collect(received)
+        WS_HANDLER_DURATION.collect(durations)
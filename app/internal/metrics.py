@@ -0,0 +1,166 @@
+from bisect import bisect_left
+
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names, values, extra=""):
+    labels = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """Minimal Prometheus metric, label values are passed positionally in the order of labelnames
+
+    Everything runs on the event loop, so updates are plain dict operations without locking.
+    """
+
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.name = name
+        self.values = {}
+
+    def clear(self):
+        self.values = {}
+
+    def collect(self, values):
+        """ Replace all values, for metrics that are kept elsewhere and collected at scrape time """
+        self.values = values
+
+    def samples(self):
+        for labels, value in self.values.items():
+            yield self.name, format_labels(self.labelnames, labels), value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{labels} {format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value, *labels):
+        self.values[labels] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        state = self.values.get(labels)
+        if state is None:
+            # per bucket counts, the last one is +Inf, then sum
+            state = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        state[bisect_left(self.buckets, value)] += 1
+        state[-1] += value
+
+    def samples(self):
+        for labels, state in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), state):
+                cumulative += count
+                le = f'le="{format_value(bound)}"'
+                yield f"{self.name}_bucket", format_labels(self.labelnames, labels, le), cumulative
+            yield f"{self.name}_sum", format_labels(self.labelnames, labels), state[-1]
+            yield f"{self.name}_count", format_labels(self.labelnames, labels), cumulative
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """ Prometheus text exposition format """
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+def message_type(msg):
+    """ Type of an outgoing WebSocket message, its first key or the command for cmd messages
+
+    String operations instead of parsing the JSON again, this is called for every message sent.
+    """
+    if not msg.startswith('{"'):
+        return "unknown"
+    end = msg.find('"', 2)
+    key = msg[2:end]
+    if key == "cmd":
+        start = msg.find('"', end + 1) + 1
+        if start > 0:
+            return "cmd/" + msg[start:msg.find('"', start)]
+    return key
+
+
+REGISTRY = MetricsRegistry()
+
+COMMAND_ENDPOINT_DURATION = REGISTRY.add(Histogram(
+    "was_command_endpoint_duration_seconds", "Voice command duration, from receiving it until the response was sent",
+    ["endpoint"],
+))
+COMMAND_ENDPOINT_REQUESTS = REGISTRY.add(Counter(
+    "was_command_endpoint_requests_total", "Voice commands by endpoint and result", ["endpoint", "status"],
+))
+CONNECTED_CLIENTS = REGISTRY.add(Gauge(
+    "was_connected_clients", "Connected clients by platform and version", ["platform", "version"],
+))
+DB_CALL_DURATION = REGISTRY.add(Histogram(
+    "was_db_call_duration_seconds", "Database call duration on a database worker, by function", ["function"],
+))
+DB_WAIT = REGISTRY.add(Histogram(
+    "was_db_wait_seconds", "Time database calls waited for a free database worker",
+))
+NOTIFY_DISPATCH_LAG = REGISTRY.add(Histogram(
+    "was_notify_dispatch_lag_seconds", "Time between a notification being due and sending it to a client",
+))
+NOTIFY_QUEUE_DEPTH = REGISTRY.add(Gauge(
+    "was_notify_queue_depth", "Notifications waiting to be sent or completed",
+))
+OTA_BYTES_SERVED = REGISTRY.add(Counter(
+    "was_ota_bytes_served_total", "OTA firmware bytes served by platform", ["platform"],
+))
+WAKE_DECISION_DURATION = REGISTRY.add(Histogram(
+    "was_wake_decision_duration_seconds", "Time from the first wake event until the wake arbitration decision",
+))
+WS_HANDLER_DURATION = REGISTRY.add(Histogram(
+    "was_ws_handler_duration_seconds", "WebSocket message handler duration by message type", ["type"],
+))
+WS_MESSAGES_RECEIVED = REGISTRY.add(Counter(
+    "was_ws_messages_received_total", "WebSocket messages received by type", ["type"],
+))
+WS_MESSAGES_SENT = REGISTRY.add(Counter(
+    "was_ws_messages_sent_total", "WebSocket messages queued for sending by type", ["type"],
+))
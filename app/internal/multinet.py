@@ -0,0 +1,151 @@
+import json
+import os
+
+from hashlib import sha256
+from logging import getLogger
+
+from app.const import HA_ONOFF_DOMAINS, MULTINET_MAX_COMMANDS, STORAGE_USER_MULTINET
+from app.internal.was import get_ha_commands_for_entity, get_json_from_file, save_json_to_file
+
+
+log = getLogger("WAS")
+
+
+class MultinetCompiler:
+    """Compile Home Assistant entities into multinet commands
+
+    Commands are memoized per entity_id and only recomputed when the friendly name changed,
+    the fast path matcher shares the memo for its phrases.
+    Duplicate phrases are only included once, and entities that don't fit in max_commands are skipped,
+    get_ha_commands_for_entity already skips phrases over the ESP-SR phrase length limit.
+    """
+
+    def __init__(self, max_commands=MULTINET_MAX_COMMANDS, path=STORAGE_USER_MULTINET):
+        self.aliases = {}
+        self.cache = {}
+        self.max_commands = max_commands
+        self.path = path
+
+        self.collisions = 0
+        self.compiled = 0
+        self.hits = 0
+        self.misses = 0
+        self.skipped = 0
+        self.version = None
+        self.writes = 0
+
+    def get_commands(self, entity):
+        entity_id = entity["entity_id"]
+        name = entity["attributes"].get("friendly_name") or entity_id.split(".", 1)[1]
+
+        cached = self.cache.get(entity_id)
+        if cached is not None and cached[0] == name:
+            self.hits += 1
+            return cached[1]
+
+        self.misses += 1
+        commands = get_ha_commands_for_entity(name)
+        self.cache[entity_id] = (name, commands)
+        return commands
+
+    def get_alias_commands(self, entity):
+        """ Commands for the object ID of an entity, it only changes with the entity_id """
+        entity_id = entity["entity_id"]
+        commands = self.aliases.get(entity_id)
+        if commands is not None:
+            self.hits += 1
+            return commands
+
+        self.misses += 1
+        commands = self.aliases[entity_id] = get_ha_commands_for_entity(entity_id.split(".", 1)[1])
+        return commands
+
+    def forget(self, entity_ids):
+        """ Drop memoized commands of entities that are no longer in entity_ids """
+        for entity_id in self.cache.keys() - entity_ids:
+            del self.cache[entity_id]
+        for entity_id in self.aliases.keys() - entity_ids:
+            del self.aliases[entity_id]
+
+    def compile(self, entities):
+        """ Compile entities, as returned by HomeAssistantIndex.get_entities(), into a list of commands """
+        commands = []
+        seen = set()
+        collisions = 0
+        skipped = 0
+        entity_ids = set()
+
+        for entity in entities:
+            entity_id = entity["entity_id"]
+            if entity_id.split(".", 1)[0] not in HA_ONOFF_DOMAINS:
+                continue
+            entity_ids.add(entity_id)
+
+            new = []
+            for command in self.get_commands(entity):
+                if command in seen:
+                    collisions += 1
+                    continue
+                new.append(command)
+
+            # keep the ON and OFF command of an entity together
+            if len(commands) + len(new) > self.max_commands:
+                skipped += 1
+                continue
+
+            commands.extend(new)
+            seen.update(new)
+
+        # forget removed entities
+        self.forget(entity_ids)
+
+        if skipped > 0:
+            log.warning(f"multinet: {skipped} entities skipped, command limit of {self.max_commands} reached")
+
+        self.collisions = collisions
+        self.compiled = len(commands)
+        self.skipped = skipped
+        return commands
+
+    def owned(self):
+        """ The multinet file doesn't exist or was written by us, a file without version is user provided """
+        if not os.path.isfile(self.path):
+            return True
+        return "version" in get_json_from_file(self.path)
+
+    def write(self, commands):
+        """ Write commands to the multinet file, returns False when the file already has the same commands """
+        version = sha256(json.dumps(commands).encode()).hexdigest()
+        if self.version is None:
+            current = get_json_from_file(self.path)
+            self.version = current.get("version") if isinstance(current, dict) else None
+        if version == self.version:
+            log.debug("multinet commands unchanged, not writing")
+            return False
+
+        # check every time, the user can replace the file while we're running
+        if not self.owned():
+            log.warning(f"multinet: {self.path} was not generated by WAS, not overwriting it")
+            self.version = None
+            return False
+
+        save_json_to_file(self.path, json.dumps({'commands': commands, 'version': version}))
+        self.version = version
+        self.writes += 1
+        log.info(f"multinet: wrote {len(commands)} commands, version {version[:12]}")
+        return True
+
+    def update(self, entities):
+        return self.write(self.compile(entities))
+
+    def stats(self):
+        return {
+            'cached': len(self.cache),
+            'collisions': self.collisions,
+            'commands': self.compiled,
+            'hits': self.hits,
+            'misses': self.misses,
+            'skipped': self.skipped,
+            'version': self.version,
+            'writes': self.writes,
+        }
@@ -1,16 +1,25 @@
 import asyncio
+import heapq
 import json
 import time
 
 from logging import getLogger
-from pydantic import BaseModel, ConfigDict, Field
-from typing import Annotated, Dict, List, Optional
+from pydantic import BaseModel, ConfigDict, Field, PrivateAttr
+from typing import Annotated, Dict, List, Optional, Set, Tuple
 
-from .connmgr import ConnMgr
+from app.db.main import run_db, save_notifications_to_db
+from app.db.models import WillowNotificationState
+from app.internal.metrics import NOTIFY_DISPATCH_LAG
+
+from .connmgr import BroadcastStatus, ConnMgr
 
 
 log = getLogger("WAS")
 
+# TODO should we make this configurable ?
+# or at least reject notifications with old ID in the API
+NOTIFY_EXPIRE_MS = 3600 * 1000
+
 
 class NotifyData(BaseModel):
     model_config = ConfigDict(extra="forbid")
@@ -22,7 +31,16 @@ class NotifyData(BaseModel):
     repeat: int = 1
     strobe_period_ms: Optional[int] = 0
     text: Optional[str] = None
-    volume: Optional[int] = Optional[Annotated[int, Field(ge=0, le=100)]]
+    volume: Optional[Annotated[int, Field(ge=0, le=100)]] = None
+
+    # the same notification is usually sent to many devices, only serialize it once
+    _payload: Optional[str] = PrivateAttr(default=None)
+
+    def payload(self):
+        if self._payload is None:
+            msg = NotifyMsg(data=self)
+            self._payload = msg.model_dump_json(exclude={'hostname'}, exclude_none=True)
+        return self._payload
 
 
 class NotifyMsg(BaseModel):
@@ -40,9 +58,59 @@ class NotifyQueue(BaseModel):
     notifications: Dict[str, List[NotifyData]] = {}
     task: asyncio.Task = None
 
+    # min-heap of (due time in ms, MAC address), a notification ID is its due time
+    schedule: List[Tuple[int, str]] = Field(default=[], exclude=True)
+    # MAC addresses that need to be checked on the next dispatch run
+    ready: Set[str] = Field(default=set(), exclude=True)
+    wakeup: asyncio.Event = Field(default_factory=asyncio.Event, exclude=True)
+
+    # write-behind persistence, state changes are coalesced and saved in batches
+    persist: bool = Field(default=False, exclude=True)
+    persist_interval: float = Field(default=0.5, exclude=True)
+    persist_task: asyncio.Task = Field(default=None, exclude=True)
+    changes: Dict[Tuple[int, str], Dict] = Field(default={}, exclude=True)
+
     def start(self):
         loop = asyncio.get_event_loop()
         self.task = loop.create_task(self.dequeue())
+        if self.persist:
+            self.persist_task = loop.create_task(self.writer())
+
+    def load(self, records):
+        """ Restore pending and active notifications saved by save_notifications_to_db """
+        for record in records:
+            msg = NotifyMsg.model_validate_json(record["data"])
+            self.enqueue(record["mac_addr"], msg.data, record=False)
+        log.info(f"restored {len(records)} notifications")
+        self.wakeup.set()
+
+    def record(self, mac_addr, data, state):
+        if not self.persist:
+            return
+        self.changes[(data.id, mac_addr)] = {
+            'notification_id': data.id,
+            'mac_addr': mac_addr,
+            'data': data.payload(),
+            'state': state,
+        }
+
+    async def flush(self):
+        if not self.changes:
+            return
+
+        changes, self.changes = self.changes, {}
+        try:
+            await run_db(save_notifications_to_db, list(changes.values()))
+        except Exception as e:
+            log.error(f"failed to save notifications: {e}")
+            # retry on next flush, unless the notification changed state in the meantime
+            for key, change in changes.items():
+                self.changes.setdefault(key, change)
+
+    async def writer(self):
+        while True:
+            await asyncio.sleep(self.persist_interval)
+            await self.flush()
 
     def add(self, msg):
         msg = NotifyMsg.model_validate_json(json.dumps(msg))
@@ -50,72 +118,128 @@ class NotifyQueue(BaseModel):
             msg.data.id = int(time.time() * 1000)
 
         log.debug(msg)
+        # serialize before queueing, the payload is cached and shared by all devices
+        msg.data.payload()
 
         if msg.hostname is not None:
             mac_addr = self.connmgr.get_mac_by_hostname(msg.hostname)
-            if mac_addr == "unknown":
-                log.warn(f"no MAC address found for {msg.hostname}, skipping notification")
+            if mac_addr is None or mac_addr == "unknown":
+                log.warning(f"no MAC address found for {msg.hostname}, skipping notification")
                 return
-            if mac_addr in self.notifications:
-                self.notifications[mac_addr].append(msg.data)
-            else:
-                self.notifications.update({mac_addr: [msg.data]})
+            self.enqueue(mac_addr, msg.data)
 
         else:
             for _, client in self.connmgr.connected_clients.items():
                 if client.mac_addr == "unknown":
-                    log.warn(f"no MAC address found for {client.hostname}, skipping")
+                    log.warning(f"no MAC address found for {client.hostname}, skipping")
                     continue
-                if client.mac_addr in self.notifications:
-                    self.notifications[client.mac_addr].append(msg.data)
-                else:
-                    self.notifications.update({client.mac_addr: [msg.data]})
+                self.enqueue(client.mac_addr, msg.data)
+
+        self.wakeup.set()
+
+    def enqueue(self, mac_addr, data, record=True):
+        if mac_addr in self.notifications:
+            self.notifications[mac_addr].append(data)
+        else:
+            self.notifications.update({mac_addr: [data]})
+        heapq.heappush(self.schedule, (data.id, mac_addr))
+        if record:
+            self.record(mac_addr, data, WillowNotificationState.pending)
+
+    def kick(self, mac_addr):
+        """ Check pending notifications for mac_addr, e.g. after it (re)connected """
+        if mac_addr in self.notifications:
+            self.ready.add(mac_addr)
+            self.wakeup.set()
 
     def done(self, ws, id):
         client = self.connmgr.get_client_by_ws(ws)
-        for i, notification in enumerate(self.notifications[client.mac_addr]):
+        for i, notification in enumerate(self.notifications.get(client.mac_addr, [])):
             if notification.id == id:
                 self.connmgr.set_notification_active(ws, 0)
                 self.notifications[client.mac_addr].pop(i)
+                self.record(client.mac_addr, notification, WillowNotificationState.done)
                 break
 
+        # the next notification for this device might be due already
+        self.kick(client.mac_addr)
+
         data = NotifyData(id=id, cancel=True)
         # explicitly set cmd so we can use exclude_unset
         msg_cancel = NotifyMsg(cmd="notify", data=data)
         log.info(msg_cancel)
-        asyncio.ensure_future(self.connmgr.broadcast(msg_cancel.model_dump_json(exclude_unset=True)))
+        asyncio.ensure_future(self.cancel(msg_cancel))
+
+    async def cancel(self, msg_cancel):
+        report = await self.connmgr.broadcast(msg_cancel.model_dump_json(exclude_unset=True))
+        for delivery in report:
+            if delivery.status != BroadcastStatus.ok:
+                log.warning(f"notification cancel not delivered to {delivery.hostname}: {delivery.status.value}")
+
+    def dispatch(self, mac_addr, now):
+        notifications = self.notifications.get(mac_addr)
+        if not notifications:
+            return
+
+        # not connected, or busy with another notification
+        # we get kicked again when the device says hello or completes the active notification
+        ws = self.connmgr.get_ws_by_mac(mac_addr)
+        if ws is None:
+            return
+        if self.connmgr.is_notification_active(ws):
+            log.debug(f"{mac_addr} has active notification")
+            return
+
+        i = 0
+        while i < len(notifications):
+            notification = notifications[i]
+            if notification.id > now:
+                i += 1
+                continue
+            elif notification.id < now - NOTIFY_EXPIRE_MS:
+                log.warning("expiring notification older than 1h")
+                notifications.pop(i)
+                self.record(mac_addr, notification, WillowNotificationState.expired)
+                continue
+
+            # serialize before marking the device busy, a notification that can't be sent would block it
+            try:
+                payload = notification.payload()
+            except Exception as e:
+                log.error(f"dropping notification {notification.id} for {mac_addr}: {e}")
+                notifications.pop(i)
+                continue
+
+            self.connmgr.set_notification_active(ws, notification.id)
+            self.record(mac_addr, notification, WillowNotificationState.active)
+            # lazy formatting, the notification repr is expensive and this runs for every device
+            log.debug("dequeueing notification for %s: %s", mac_addr, notification)
+            self.connmgr.send(ws, payload)
+            NOTIFY_DISPATCH_LAG.observe(max(0, now - notification.id) / 1000)
+            # don't send more than one notification at once
+            break
 
     async def dequeue(self):
         while True:
             try:
-                for mac_addr, notifications in self.notifications.items():
-                    # log.debug(f"dequeueing notifications for {mac_addr}: {notifications} (len={len(notifications)})")
-                    if len(notifications) > 0:
-                        ws = self.connmgr.get_ws_by_mac(mac_addr)
-                        if ws is None:
-                            continue
-                        if self.connmgr.is_notification_active(ws):
-                            log.debug(f"{mac_addr} has active notification")
-                            continue
-
-                        for i, notification in enumerate(notifications):
-                            if notification.id > int(time.time() * 1000):
-                                continue
-                            elif notification.id < int((time.time() - 3600) * 1000):
-                                # TODO should we make this configurable ?
-                                # or at least use a constant and reject notifications with old ID in the API
-                                log.warning("expiring notification older than 1h")
-                                notifications.pop(i)
-
-                            self.connmgr.set_notification_active(ws, notification.id)
-                            log.debug(f"dequeueing notification for {mac_addr}: {notification}")
-                            msg = NotifyMsg(data=notification)
-                            asyncio.ensure_future(ws.send_text(
-                                msg.model_dump_json(exclude={'hostname'}, exclude_none=True))
-                            )
-                            # don't send more than one notification at once
-                            break
+                now = int(time.time() * 1000)
+                while self.schedule and self.schedule[0][0] <= now:
+                    _, mac_addr = heapq.heappop(self.schedule)
+                    self.ready.add(mac_addr)
+
+                ready, self.ready = self.ready, set()
+                for mac_addr in ready:
+                    self.dispatch(mac_addr, now)
             except Exception as e:
-                log.debug(f"exception during dequeue: {e}")
+                log.error(f"exception during dequeue: {e}")
 
-            await asyncio.sleep(1)
+            # sleep until the next notification is due, or until we get woken up by add, done or kick
+            timeout = None
+            if self.schedule:
+                timeout = max(0, self.schedule[0][0] - int(time.time() * 1000)) / 1000
+
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,126 @@
+import asyncio
+import time
+
+from collections import deque
+from enum import Enum
+from logging import getLogger
+
+
+log = getLogger("WAS")
+
+# keep a reference to overflow tasks so they aren't garbage collected, the queue itself goes away on disconnect
+overflow_tasks = set()
+
+
+class SendQueuePolicy(str, Enum):
+    # drop the oldest queued message to make room for the new one
+    drop_oldest = "drop_oldest"
+    # drop the new message
+    drop_newest = "drop_newest"
+    # close the connection, the client is not keeping up
+    close = "close"
+
+
+class SendQueueStats:
+    # plain class instead of a pydantic model, updated for every message sent
+    __slots__ = (
+        "depth", "max_depth", "sent", "dropped", "failed", "latency_last_ms", "latency_avg_ms", "latency_max_ms",
+    )
+
+    def __init__(self):
+        for field in self.__slots__:
+            setattr(self, field, 0)
+
+    def model_dump(self):
+        return {field: getattr(self, field) for field in self.__slots__}
+
+
+class SendQueue:
+    """Bounded outbound message queue for a single WebSocket connection
+
+    A single writer task sends queued messages in order.
+    Every queued message has a future that resolves to True when the message was written,
+    or False when it was dropped or the send failed.
+    """
+
+    def __init__(self, ws, maxsize=64, policy=SendQueuePolicy.drop_oldest, on_overflow=None):
+        self.ws = ws
+        self.maxsize = maxsize
+        self.policy = SendQueuePolicy(policy)
+        self.on_overflow = on_overflow
+        self.queue = deque()
+        self.stats = SendQueueStats()
+        self.wakeup = asyncio.Event()
+        self.latency_total_ms = 0.0
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.get_event_loop().create_task(self.writer())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+        while self.queue:
+            _, fut, _ = self.queue.popleft()
+            self._resolve(fut, False)
+        self.stats.depth = 0
+
+    def put(self, msg):
+        fut = asyncio.get_event_loop().create_future()
+
+        if len(self.queue) >= self.maxsize:
+            if self.policy == SendQueuePolicy.drop_oldest:
+                _, dropped, _ = self.queue.popleft()
+                self._resolve(dropped, False)
+                self.stats.dropped += 1
+            elif self.policy == SendQueuePolicy.drop_newest:
+                self.stats.dropped += 1
+                self._resolve(fut, False)
+                return fut
+            elif self.policy == SendQueuePolicy.close:
+                self.stats.dropped += 1
+                self._resolve(fut, False)
+                if self.on_overflow is not None:
+                    task = asyncio.ensure_future(self.on_overflow(self.ws))
+                    overflow_tasks.add(task)
+                    task.add_done_callback(overflow_tasks.discard)
+                return fut
+
+        self.queue.append((msg, fut, time.monotonic()))
+        self.stats.depth = len(self.queue)
+        self.stats.max_depth = max(self.stats.max_depth, self.stats.depth)
+        self.wakeup.set()
+        return fut
+
+    async def writer(self):
+        while True:
+            if not self.queue:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+
+            msg, fut, ts = self.queue.popleft()
+            self.stats.depth = len(self.queue)
+            try:
+                await self.ws.send_text(msg)
+            except asyncio.CancelledError:
+                self._resolve(fut, False)
+                raise
+            except Exception as e:
+                log.debug(f"failed to send message: {e}")
+                self.stats.failed += 1
+                self._resolve(fut, False)
+                continue
+
+            latency = (time.monotonic() - ts) * 1000
+            self.stats.sent += 1
+            self.latency_total_ms += latency
+            self.stats.latency_last_ms = latency
+            self.stats.latency_avg_ms = self.latency_total_ms / self.stats.sent
+            self.stats.latency_max_ms = max(self.stats.latency_max_ms, latency)
+            self._resolve(fut, True)
+
+    def _resolve(self, fut, result):
+        # the future may have been cancelled by a caller that stopped waiting
+        if not fut.done():
+            fut.set_result(result)
@@ -0,0 +1,7 @@
+def percentile(values, pct):
+    """ Nearest-rank percentile of values, None when there are no values """
+    if not values:
+        return None
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[idx]
@@ -0,0 +1,100 @@
+import itertools
+import time
+
+from collections import deque
+
+from app.internal.metrics import COMMAND_ENDPOINT_DURATION, COMMAND_ENDPOINT_REQUESTS
+from app.internal.stats import percentile
+
+
+class CommandTrace:
+    """Timestamps of the stages of a single voice command
+
+    mark(stage) records the end of a stage, its duration is the time since the previous mark.
+    Plain class with slots, a trace is created for every command.
+    """
+
+    __slots__ = ("endpoint", "hostname", "id", "marks", "start", "status", "wall")
+
+    def __init__(self, id, hostname, endpoint):
+        self.endpoint = endpoint
+        self.hostname = hostname
+        self.id = id
+        self.marks = []
+        self.start = time.monotonic()
+        self.status = None
+        self.wall = time.time()
+
+    def mark(self, stage):
+        self.marks.append((stage, time.monotonic()))
+
+    def durations(self):
+        prev = self.start
+        for stage, ts in self.marks:
+            yield stage, (ts - prev) * 1000
+            prev = ts
+
+    def model_dump(self):
+        stages = dict(self.durations())
+        return {
+            'id': self.id,
+            'endpoint': self.endpoint,
+            'hostname': self.hostname,
+            'stages_ms': stages,
+            'start': self.wall,
+            'status': self.status,
+            'total_ms': sum(stages.values()),
+        }
+
+
+def summarize(values):
+    return {
+        'count': len(values),
+        'p50_ms': percentile(values, 50),
+        'p95_ms': percentile(values, 95),
+        'p99_ms': percentile(values, 99),
+    }
+
+
+class CommandTracer:
+    """Keep the most recent command traces, and stage and endpoint latencies for percentiles
+
+    Percentiles are only calculated when the stats are requested.
+    """
+
+    def __init__(self, size=100, history=1000):
+        self.endpoints = {}
+        self.history = history
+        self.ids = itertools.count(1)
+        self.stages = {}
+        self.traces = deque(maxlen=size)
+
+    def start(self, client, endpoint):
+        return CommandTrace(next(self.ids), client.hostname, endpoint)
+
+    def finish(self, trace, status):
+        trace.status = status
+        self.traces.append(trace)
+
+        total = 0
+        for stage, duration in trace.durations():
+            stages = self.stages.get(stage)
+            if stages is None:
+                stages = self.stages[stage] = deque(maxlen=self.history)
+            stages.append(duration)
+            total += duration
+
+        endpoints = self.endpoints.get(trace.endpoint)
+        if endpoints is None:
+            endpoints = self.endpoints[trace.endpoint] = deque(maxlen=self.history)
+        endpoints.append(total)
+
+        COMMAND_ENDPOINT_DURATION.observe(total / 1000, trace.endpoint)
+        COMMAND_ENDPOINT_REQUESTS.inc(trace.endpoint, status)
+
+    def model_dump(self):
+        return {
+            'endpoints': {endpoint: summarize(values) for endpoint, values in self.endpoints.items()},
+            'stages': {stage: summarize(values) for stage, values in self.stages.items()},
+            'traces': [trace.model_dump() for trace in reversed(self.traces)],
+        }
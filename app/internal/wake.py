@@ -2,46 +2,235 @@ import asyncio
 import json
 import time
 
+from collections import deque
 from logging import getLogger
 from uuid import uuid4
 
+from .metrics import WAKE_DECISION_DURATION
+from .stats import percentile
+
 
 log = getLogger("WAS")
 
 
 class WakeEvent:
-    def __init__(self, client, volume):
+    def __init__(self, client, volume, device=None):
         self.client = client
+        self.device = device
         self.volume = volume
+        self.ts = time.monotonic()
+
+
+class WakeParticipation:
+    """Learn which devices usually take part in wake arbitration for a group of devices
+
+    A device is expected to take part when it reported a wake event in at least
+    `threshold` of the last `history` sessions of the group.
+    """
+
+    def __init__(self, history=20, threshold=0.5):
+        self.history = history
+        self.threshold = threshold
+        self.sessions = deque(maxlen=history)
+        # arrival offsets of wake events relative to the first event of their session, in ms
+        self.offsets = deque(maxlen=history * 4)
+
+    def expected(self):
+        if len(self.sessions) == 0:
+            return set()
+
+        counts = {}
+        for participants in self.sessions:
+            for device in participants:
+                counts[device] = counts.get(device, 0) + 1
+
+        return {device for device, count in counts.items() if count / len(self.sessions) >= self.threshold}
+
+    def deadline(self, window_ms, min_window_ms):
+        # wait 1.5 times the p95 arrival offset we've seen, bounded by the configured window
+        p95 = percentile(self.offsets, 95)
+        if p95 is None:
+            return window_ms
+        return max(min_window_ms, min(window_ms, p95 * 1.5))
+
+    def record(self, events):
+        if len(events) == 0:
+            return
+        first = events[0].ts
+        self.sessions.append({event.device for event in events})
+        for event in events[1:]:
+            self.offsets.append((event.ts - first) * 1000)
+
+
+class WakeStats:
+    def __init__(self, history=100):
+        self.decisions_early = 0
+        self.decisions_deadline = 0
+        self.latencies = deque(maxlen=history)
+
+    def record(self, latency_ms, early):
+        if early:
+            self.decisions_early += 1
+        else:
+            self.decisions_deadline += 1
+        self.latencies.append(latency_ms)
+
+    def model_dump(self):
+        return {
+            'decisions_early': self.decisions_early,
+            'decisions_deadline': self.decisions_deadline,
+            'latency_last_ms': self.latencies[-1] if self.latencies else None,
+            'latency_p50_ms': percentile(self.latencies, 50),
+            'latency_p95_ms': percentile(self.latencies, 95),
+        }
 
 
 class WakeSession:
-    def __init__(self):
+    def __init__(self, connmgr, participation=None, stats=None, window_ms=400, min_window_ms=50, zone=None):
+        self.connmgr = connmgr
+        self.decision_ms = None
         self.done = False
         self.events = []
         self.id = uuid4()
+        # events that arrived after an early decision, they lose but still count as participants
+        self.late = []
+        self.min_window_ms = min_window_ms
+        self.participation = participation if participation is not None else WakeParticipation()
+        self.expected = self.participation.expected()
+        self.reported = asyncio.Event()
+        self.stats = stats
         self.ts = time.time()
-        log.debug(f"WakeSession with ID {self.id} created")
+        self.window_ms = window_ms
+        self.winner = None
+        self.zone = zone
+        log.debug(f"WakeSession with ID {self.id} for zone {zone} created, expecting {self.expected}")
 
     def add_event(self, event):
         log.debug(f"WakeSession {self.id} adding event {event}")
+        if self.done:
+            log.debug(f"WakeSession {self.id} already decided, {event.device} loses")
+            self.late.append(event)
+            self.connmgr.send(event.client, json.dumps({'wake_result': {'won': False}}))
+            return
+
         self.events.append(event)
+        if self.expected and self.expected.issubset({event.device for event in self.events}):
+            self.reported.set()
+
+    async def decide(self):
+        timeout = self.participation.deadline(self.window_ms, self.min_window_ms)
+        start = time.monotonic()
+        early = True
+        try:
+            await asyncio.wait_for(self.reported.wait(), timeout / 1000)
+        except asyncio.TimeoutError:
+            early = False
 
-    async def cleanup(self, timeout=400):
-        await asyncio.sleep(timeout / 1000)
         max_volume = -1000.0
-        winner = None
         for event in self.events:
             if event.volume > max_volume:
                 max_volume = event.volume
-                winner = event.client
+                self.winner = event.client
 
-        # notify winner first
-        await winner.send_text(json.dumps({'wake_result': {'won': True}}))
+        first = self.events[0].ts if self.events else start
+        self.decision_ms = (time.monotonic() - first) * 1000
+        WAKE_DECISION_DURATION.observe(self.decision_ms / 1000)
+        if self.stats is not None:
+            self.stats.record(self.decision_ms, early)
 
+        log.debug(f"WakeSession with ID {self.id} decided after {self.decision_ms:.1f} ms "
+                  f"({'all expected devices reported' if early else 'deadline reached'}). Winner: {self.winner}")
+        self.done = True
+
+    async def notify(self):
+        if self.winner is None:
+            return
+
+        won = json.dumps({'wake_result': {'won': True}})
+        lost = json.dumps({'wake_result': {'won': False}})
+        # winner is queued first, then all results are delivered concurrently
+        results = [self.connmgr.send(self.winner, won)]
         for event in self.events:
-            if event.client != winner:
-                await event.client.send_text(json.dumps({'wake_result': {'won': False}}))
+            if event.client != self.winner:
+                results.append(self.connmgr.send(event.client, lost))
+        await asyncio.gather(*results)
 
-        log.debug(f"Marking WakeSession with ID {self.id} done. Winner: {winner}")
-        self.done = True
+    def close(self):
+        self.participation.record(self.events + self.late)
+
+    async def cleanup(self):
+        await self.decide()
+        await self.notify()
+        self.close()
+
+
+class WakeArbiter:
+    """Run independent wake arbitration sessions per zone
+
+    Devices without a zone share the default zone.
+    """
+
+    def __init__(self, connmgr, window_ms=400, min_window_ms=50):
+        self.connmgr = connmgr
+        self.min_window_ms = min_window_ms
+        self.participation = {}
+        self.sessions = {}
+        self.stats = WakeStats()
+        self.tasks = set()
+        self.window_ms = window_ms
+        self.zones = {}
+
+    def set_zone(self, mac_addr, zone):
+        if zone:
+            self.zones[mac_addr] = zone
+        else:
+            self.zones.pop(mac_addr, None)
+
+    def set_zones(self, devices):
+        self.zones = {device["mac_addr"]: device["zone"] for device in devices if device.get("zone")}
+        log.debug(f"wake arbitration zones: {self.zones}")
+
+    def add_event(self, event):
+        zone = self.zones.get(event.device)
+        session = self.sessions.get(zone)
+        if session is None:
+            if zone not in self.participation:
+                self.participation[zone] = WakeParticipation()
+            session = WakeSession(
+                self.connmgr,
+                participation=self.participation[zone],
+                stats=self.stats,
+                window_ms=self.window_ms,
+                min_window_ms=self.min_window_ms,
+                zone=zone,
+            )
+            self.sessions[zone] = session
+            task = asyncio.create_task(self.run(session))
+            # keep a reference so the task isn't garbage collected
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+        session.add_event(event)
+
+    async def run(self, session):
+        try:
+            await session.decide()
+            await session.notify()
+
+            # an early decision can be made before every device that heard the wake word reported,
+            # keep the session until the end of the window so late events lose instead of starting a new session
+            remaining = session.window_ms / 1000 - (time.monotonic() - session.events[0].ts)
+            if remaining > 0:
+                await asyncio.sleep(remaining)
+        finally:
+            # new wake events for this zone start a new session from here on
+            if self.sessions.get(session.zone) is session:
+                del self.sessions[session.zone]
+            session.close()
+
+    def model_dump(self):
+        return {
+            'active_sessions': [zone or "default" for zone in self.sessions],
+            'zones': self.zones,
+            **self.stats.model_dump(),
+        }
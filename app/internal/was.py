@@ -16,7 +16,7 @@ from logging import getLogger
 from num2words import num2words
 from websockets.sync.client import connect
 
-from app.db.main import get_config_db, get_nvs_db, save_config_to_db, save_nvs_to_db
+from app.db.main import get_config_db, get_config_msg, get_nvs_db, get_nvs_msg, run_db, save_config_to_db, save_nvs_to_db
 
 from ..const import (
     DIR_OTA,
@@ -81,7 +81,8 @@ async def device_command(connmgr, data, command):
     msg = json.dumps({'cmd': command})
     try:
         ws = connmgr.get_client_by_hostname(hostname)
-        await ws.send_text(msg)
+        if not await connmgr.send(ws, msg):
+            raise Exception("send failed")
         return "Success"
     except Exception as e:
         log.error(f"Failed to send restart command to {data['hostname']} ({e})")
@@ -125,19 +126,16 @@ def get_devices():
     return devices
 
 
-def get_ha_commands_for_entity(entity):
-    commands = []
-    pattern = r'[^A-Za-z- ]'
+def get_full_config_msg(config_versions):
+    """ Full config for version aware devices, without version when the config versions failed to load """
+    if config_versions.full is None:
+        return get_config_msg()
+    return config_versions.full
 
-    numbers = re.search(r'(\d{1,})', entity)
-    if numbers:
-        for number in numbers.groups():
-            entity = entity.replace(number, f" {num2words(int(number))} ")
 
-    entity = entity.replace('_', ' ')
-    entity = re.sub(pattern, '', entity)
-    entity = " ".join(entity.split())
-    entity = entity.upper()
+def get_ha_commands_for_entity(entity):
+    commands = []
+    entity = normalize_phrase(entity)
 
     on = f'TURN ON {entity}'
     off = f'TURN OFF {entity}'
@@ -284,10 +282,11 @@ def get_safe_path(basedir, path, follow_symlinks=True):
 
 def get_tz_config(refresh=False):
     if refresh:
-        tz = requests.get(URL_WILLOW_TZ).json()
-        with open(STORAGE_TZ, "w") as tz_file:
+        tz = requests.get(URL_WILLOW_TZ, timeout=10).json()
+        # replace atomically, the cached file is served while refreshing
+        with open(f"{STORAGE_TZ}.tmp", "w") as tz_file:
             json.dump(tz, tz_file)
-        tz_file.close()
+        os.replace(f"{STORAGE_TZ}.tmp", STORAGE_TZ)
 
     return get_json_from_file(STORAGE_TZ)
 
@@ -309,15 +308,27 @@ def merge_dict(dict_1, dict_2):
     return result
 
 
+def normalize_phrase(phrase):
+    pattern = r'[^A-Za-z- ]'
+
+    phrase = re.sub(r'\d+', lambda number: f" {num2words(int(number.group()))} ", phrase)
+    phrase = phrase.replace('_', ' ')
+    phrase = re.sub(pattern, '', phrase)
+    phrase = " ".join(phrase.split())
+    return phrase.upper()
+
+
 async def post_config(request, apply=False):
     data = await request.json()
     if 'hostname' in data:
         hostname = data["hostname"]
-        data = get_config_db()
-        msg = build_msg(data, "config")
         try:
             ws = request.app.connmgr.get_client_by_hostname(hostname)
-            await ws.send_text(msg)
+            msg = get_config_msg()
+            if request.app.connmgr.get_client_by_ws(ws).config_version is not None:
+                msg = get_full_config_msg(request.app.config_versions)
+            if not await request.app.connmgr.send(ws, msg):
+                raise Exception("send failed")
             return "Success"
         except Exception as e:
             log.error(f"Failed to apply config to {hostname} ({e})")
@@ -328,11 +339,19 @@ async def post_config(request, apply=False):
             del data["wis_tts_url"]
             log.debug(f"wis_tts_url_v2: {data['wis_tts_url_v2']}")
 
-        save_config_to_db(data)
+        await run_db(save_config_to_db, data)
+        config_versions = request.app.config_versions
+        await config_versions.update(get_config_db())
         msg = build_msg(data, "config")
         log.debug(str(msg))
         if apply:
-            await request.app.connmgr.broadcast(msg)
+            # only what changed for version aware devices, nothing if they are current
+            def build_client_msg(client):
+                if client.config_version is None or config_versions.full is None:
+                    return msg
+                return config_versions.get_msg(client.config_version, client.config_hash)
+
+            return await request.app.connmgr.broadcast(build_client_msg)
         return "Success"
 
 
@@ -340,21 +359,21 @@ async def post_nvs(request, apply=False):
     data = await request.json()
     if 'hostname' in data:
         hostname = data["hostname"]
-        data = get_nvs_db()
-        msg = build_msg(data, "nvs")
+        msg = get_nvs_msg()
         try:
             ws = request.app.connmgr.get_client_by_hostname(hostname)
-            await ws.send_text(msg)
+            if not await request.app.connmgr.send(ws, msg):
+                raise Exception("send failed")
             return "Success"
         except Exception as e:
             log.error(f"Failed to apply config to {hostname} ({e})")
             return "Error"
     else:
-        save_nvs_to_db(data)
+        await run_db(save_nvs_to_db, data)
         msg = build_msg(data, "nvs")
         log.debug(str(msg))
         if apply:
-            await request.app.connmgr.broadcast(msg)
+            return await request.app.connmgr.broadcast(msg)
         return "Success"
 
 
@@ -1,9 +1,12 @@
 import asyncio
-import json
 import os
+import time
+import ujson
 
 import alembic
 import alembic.config
+from alembic.runtime.migration import MigrationContext
+from alembic.script import ScriptDirectory
 from fastapi import (
     FastAPI,
     Header,
@@ -28,30 +31,46 @@ from app.const import (
     STORAGE_USER_NVS,
 )
 
-from app.db.main import get_config_db, migrate_user_client_config, migrate_user_config, migrate_user_nvs
+from app.db.main import (
+    engine,
+    get_config_db,
+    get_config_msg,
+    get_config_versions_db,
+    get_devices_db,
+    get_notifications_db,
+    get_nvs_db,
+    migrate_user_client_config,
+    migrate_user_config,
+    migrate_user_nvs,
+)
 from app.internal.command_endpoints import (
     CommandEndpointResponse,
     CommandEndpointResult,
-    CommandEndpointRuntimeException
+    CommandEndpointRuntimeException,
+    CommandEndpointTimeoutException,
 )
 from app.internal.command_endpoints.main import init_command_endpoint
 from app.internal.was import (
-    build_msg,
     get_config,
     get_devices,
+    get_full_config_msg,
     get_nvs,
     get_tz_config,
 )
 from app.settings import get_settings
 
 from .internal.client import Client
+from .internal.config_versions import ConfigVersions
 from .internal.connmgr import ConnMgr
+from .internal.dispatch import MessageDispatcher
 from .internal.notify import NotifyQueue
-from .internal.wake import WakeEvent, WakeSession
+from .internal.trace import CommandTracer
+from .internal.wake import WakeArbiter, WakeEvent
 from .routers import asset
 from .routers import client
 from .routers import config
 from .routers import info
+from .routers import metrics
 from .routers import ota
 from .routers import release
 from .routers import status
@@ -73,44 +92,95 @@ settings = get_settings()
 def db_migrations():
     cfg = alembic.config.Config(ALEMBIC_CONFIG)
     cfg.attributes['logger'] = log
+
+    # comparing revisions only reads the migration scripts and the alembic_version table
+    heads = set(ScriptDirectory.from_config(cfg).get_heads())
+    with engine.connect() as connection:
+        current = set(MigrationContext.configure(connection).get_current_heads())
+    if current == heads:
+        log.info(f"database schema at head {', '.join(heads)}, skipping migrations")
+        return
+
     alembic.command.upgrade(cfg, "head")
 
 
+async def refresh_tz_config():
+    try:
+        await asyncio.to_thread(get_tz_config, refresh=True)
+    except Exception as e:
+        log.warning(f"failed to refresh timezones, using cached ones: {e}")
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    app.first_connection = False
+    app.start = time.monotonic()
+
     # database schema migrations
     db_migrations()
 
     migrate_user_files()
-    get_tz_config(refresh=True)
-
-    user_config = get_config()
-    # skip migration if user_config is empty
-    if user_config:
-        try:
-            migrate_user_config(user_config)
-            os.remove(STORAGE_USER_CONFIG)
-        except Exception as e:
-            log.error(f"failed to migrate user config to database: {e}")
-
-    user_nvs = get_nvs()
-    # skip migration if user_nvs is empty
-    if user_nvs:
-        try:
-            migrate_user_nvs(user_nvs)
-            os.remove(STORAGE_USER_NVS)
-        except Exception as e:
-            log.error(f"failed to migrate user nvs to database: {e}")
-
-    devices = get_devices()
-    # skip migration if devices is empty
-    if devices:
-        try:
-            migrate_user_client_config(devices)
-            os.remove(STORAGE_USER_CLIENT_CONFIG)
-        except Exception as e:
-            log.error(f"failed to migrate user client config to database: {e}")
-    app.connmgr = ConnMgr()
+    # served from the cached file, don't wait for the network
+    app.tz_refresh = asyncio.get_running_loop().create_task(refresh_tz_config())
+
+    # legacy migrations, the files are removed after migrating to the database
+    if os.path.isfile(STORAGE_USER_CONFIG):
+        user_config = get_config()
+        # skip migration if user_config is empty
+        if user_config:
+            try:
+                migrate_user_config(user_config)
+                os.remove(STORAGE_USER_CONFIG)
+            except Exception as e:
+                log.error(f"failed to migrate user config to database: {e}")
+
+    if os.path.isfile(STORAGE_USER_NVS):
+        user_nvs = get_nvs()
+        # skip migration if user_nvs is empty
+        if user_nvs:
+            try:
+                migrate_user_nvs(user_nvs)
+                os.remove(STORAGE_USER_NVS)
+            except Exception as e:
+                log.error(f"failed to migrate user nvs to database: {e}")
+
+    if os.path.isfile(STORAGE_USER_CLIENT_CONFIG):
+        devices = get_devices()
+        # skip migration if devices is empty
+        if devices:
+            try:
+                migrate_user_client_config(devices)
+                os.remove(STORAGE_USER_CLIENT_CONFIG)
+            except Exception as e:
+                log.error(f"failed to migrate user client config to database: {e}")
+
+    app.connmgr = ConnMgr(
+        broadcast_max_missed=settings.broadcast_max_missed,
+        broadcast_timeout=settings.broadcast_timeout,
+        send_queue_policy=settings.send_queue_policy,
+        send_queue_size=settings.send_queue_size,
+    )
+
+    app.wake_arbiter = WakeArbiter(
+        app.connmgr,
+        window_ms=settings.wake_window_ms,
+        min_window_ms=settings.wake_window_min_ms,
+    )
+    app.wake_arbiter.set_zones(get_devices_db())
+
+    app.config_versions = ConfigVersions(persist=True)
+    try:
+        app.config_versions.load(get_config_versions_db())
+        # new version if the config was changed outside of post_config, e.g. by the user config migration
+        await app.config_versions.update(get_config_db())
+    except Exception as e:
+        log.error(f"failed to load config versions: {e}")
+
+    # the config is cached now, also cache the NVS so devices and the UI don't wait for the database
+    try:
+        get_nvs_db()
+    except Exception as e:
+        log.error(f"failed to load nvs: {e}")
 
     app.command_endpoint = None
     try:
@@ -118,11 +188,18 @@ async def lifespan(app: FastAPI):
     except Exception as e:
         log.error(f"failed to initialize command endpoint ({e})")
 
-    app.notify_queue = NotifyQueue(connmgr=app.connmgr)
+    app.notify_queue = NotifyQueue(connmgr=app.connmgr, persist=True)
+    try:
+        app.notify_queue.load(get_notifications_db())
+    except Exception as e:
+        log.error(f"failed to restore notifications: {e}")
     app.notify_queue.start()
 
+    log.info(f"startup completed in {(time.monotonic() - app.start) * 1000:.0f} ms")
     yield
     log.info("shutting down")
+    app.tz_refresh.cancel()
+    await app.notify_queue.flush()
 
 app = FastAPI(title="Willow Application Server",
               description="Willow Management API",
@@ -132,7 +209,6 @@ app = FastAPI(title="Willow Application Server",
               redoc_url="/redoc",
               version=settings.was_version)
 
-wake_session = None
 
 app.add_middleware(
     CORSMiddleware,
@@ -174,11 +250,164 @@ app.include_router(asset.router)
 app.include_router(client.router)
 app.include_router(config.router)
 app.include_router(info.router)
+app.include_router(metrics.router)
 app.include_router(ota.router)
 app.include_router(release.router)
 app.include_router(status.router)
 
 
+dispatcher = MessageDispatcher()
+app.dispatcher = dispatcher
+
+# keep references to running command endpoint requests so they aren't garbage collected
+command_tasks = set()
+
+tracer = CommandTracer()
+app.tracer = tracer
+
+
+@dispatcher.register("wake_start")
+async def handle_wake_start(websocket, client, msg):
+    if "wake_volume" in msg["wake_start"]:
+        device = client.mac_addr if client.mac_addr != "unknown" else client.hostname
+        wake_event = WakeEvent(websocket, msg["wake_start"]["wake_volume"], device=device)
+        app.wake_arbiter.add_event(wake_event)
+
+
+@dispatcher.register("wake_end")
+async def handle_wake_end(websocket, client, msg):
+    pass
+
+
+@dispatcher.register("notify_done")
+async def handle_notify_done(websocket, client, msg):
+    app.notify_queue.done(websocket, msg["notify_done"])
+
+
+def command_endpoint_unreachable(websocket):
+    command_endpoint_result = CommandEndpointResult(speech="WAS Command Endpoint unreachable")
+    command_endpoint_response = CommandEndpointResponse(result=command_endpoint_result)
+    return app.connmgr.send(websocket, command_endpoint_response.model_dump_json())
+
+
+def trace_sent(trace, future, status):
+    # the send queue resolves the future once the response is written to the WebSocket
+    def sent(future):
+        trace.mark("send")
+        tracer.finish(trace, status)
+    future.add_done_callback(sent)
+
+
+async def command_endpoint_request(websocket, client, data, trace):
+    trace.mark("schedule")
+    command_endpoint = app.command_endpoint
+    breaker = command_endpoint.breaker
+    if breaker is not None and not breaker.allow():
+        # the endpoint keeps failing, don't make the user wait for it
+        trace.mark("route")
+        trace_sent(trace, command_endpoint_unreachable(websocket), "rejected")
+        log.warning(f"WAS Command Endpoint circuit breaker {breaker.state.value}, not sending command")
+        return
+    trace.mark("route")
+
+    log.debug(f"Sending {data} to {command_endpoint.name}")
+    # recorded in the breaker whatever happens, a half open breaker waits for the outcome of its trial command
+    success = False
+    try:
+        resp = await command_endpoint.send(jsondata=data, ws=websocket, client=client)
+        trace.mark("upstream")
+        # routed endpoints record the endpoint that answered
+        trace.endpoint = command_endpoint.responder(resp)
+        success = True
+        if resp is not None:
+            resp = command_endpoint.parse_response(resp)
+            trace.mark("parse")
+            log.debug(f"Got response {resp} from endpoint")
+            if resp is not None:
+                trace_sent(trace, app.connmgr.send(websocket, resp), "ok")
+                return
+        tracer.finish(trace, "no_response")
+    except CommandEndpointTimeoutException as e:
+        trace.mark("upstream")
+        # a command that was delivered but not answered doesn't mean the endpoint is down
+        success = e.delivered
+        command_endpoint_result = CommandEndpointResult(speech="WAS Command Endpoint timed out")
+        command_endpoint_response = CommandEndpointResponse(result=command_endpoint_result)
+        trace_sent(trace, app.connmgr.send(websocket, command_endpoint_response.model_dump_json()), "timeout")
+        log.error(f"WAS Command Endpoint timed out: {e}")
+    except CommandEndpointRuntimeException as e:
+        trace.mark("upstream")
+        trace_sent(trace, command_endpoint_unreachable(websocket), "unreachable")
+        log.error(f"WAS Command Endpoint unreachable: {e}")
+    except Exception as e:
+        trace.mark("upstream")
+        trace_sent(trace, command_endpoint_unreachable(websocket), "error")
+        log.exception(f"WAS Command Endpoint request failed: {e}")
+    finally:
+        # also reached on cancellation, e.g. when the endpoint is replaced while the command is in flight
+        if breaker is not None:
+            if success:
+                breaker.success()
+            else:
+                breaker.failure()
+
+
+@dispatcher.register("cmd/endpoint")
+async def handle_cmd_endpoint(websocket, client, msg):
+    if app.command_endpoint is not None:
+        trace = tracer.start(client, app.command_endpoint.name)
+        # don't block the WebSocket route while waiting for the endpoint
+        task = asyncio.create_task(command_endpoint_request(websocket, client, msg["data"], trace))
+        command_tasks.add(task)
+        task.add_done_callback(command_tasks.discard)
+
+    else:
+        command_endpoint_result = CommandEndpointResult(speech="WAS Command Endpoint not active")
+        command_endpoint_response = CommandEndpointResponse(result=command_endpoint_result)
+        app.connmgr.send(websocket, command_endpoint_response.model_dump_json())
+        log.error("WAS Command Endpoint not active")
+
+
+@dispatcher.register("cmd/get_config")
+async def handle_cmd_get_config(websocket, client, msg):
+    if client.config_version is None:
+        app.connmgr.send(websocket, get_config_msg())
+    else:
+        app.connmgr.send(websocket, get_full_config_msg(app.config_versions))
+
+
+@dispatcher.register("config_ack")
+async def handle_config_ack(websocket, client, msg):
+    ack = msg["config_ack"]
+    app.connmgr.update_client(websocket, "config_version", (ack["version"], ack.get("hash")))
+
+
+@dispatcher.register("goodbye")
+async def handle_goodbye(websocket, client, msg):
+    app.connmgr.disconnect(websocket)
+
+
+@dispatcher.register("hello")
+async def handle_hello(websocket, client, msg):
+    if "hostname" in msg["hello"]:
+        app.connmgr.update_client(websocket, "hostname", msg["hello"]["hostname"])
+    if "hw_type" in msg["hello"]:
+        platform = msg["hello"]["hw_type"].upper()
+        app.connmgr.update_client(websocket, "platform", platform)
+    if "mac_addr" in msg["hello"]:
+        mac_addr = hex_mac(msg["hello"]["mac_addr"])
+        app.connmgr.update_client(websocket, "mac_addr", mac_addr)
+        app.notify_queue.kick(mac_addr)
+    # if the config versions failed to load, version aware devices are treated like older ones
+    if "config_version" in msg["hello"] and app.config_versions.full is not None:
+        # devices with an unknown version, or a known version with a different hash, get the full config
+        version = (msg["hello"]["config_version"], msg["hello"].get("config_hash"))
+        app.connmgr.update_client(websocket, "config_version", version)
+        config_msg = app.config_versions.get_msg(client.config_version, client.config_hash)
+        if config_msg is not None:
+            app.connmgr.send(websocket, config_msg)
+
+
 # WebSockets with params return 403 when done with APIRouter
 # https://github.com/tiangolo/fastapi/issues/98#issuecomment-1688632239
 @app.websocket("/ws")
@@ -188,77 +417,20 @@ async def websocket_endpoint(
     client = Client(ua=user_agent)
 
     await app.connmgr.accept(websocket, client)
+    if not app.first_connection:
+        app.first_connection = True
+        log.info(f"first WebSocket connection accepted {time.monotonic() - app.start:.3f} s after start")
     try:
         while True:
             data = await websocket.receive_text()
-            log.debug(str(data))
-            msg = json.loads(data)
-
-            # latency sensitive so handle first
-            if "wake_start" in msg:
-                global wake_session
-                if wake_session is not None:
-                    if wake_session.done:
-                        del wake_session
-                        wake_session = WakeSession()
-                        asyncio.create_task(wake_session.cleanup())
-                else:
-                    wake_session = WakeSession()
-                    asyncio.create_task(wake_session.cleanup())
-
-                if "wake_volume" in msg["wake_start"]:
-                    wake_event = WakeEvent(websocket, msg["wake_start"]["wake_volume"])
-                    wake_session.add_event(wake_event)
-
-            elif "wake_end" in msg:
-                pass
-
-            elif "notify_done" in msg:
-                app.notify_queue.done(websocket, msg["notify_done"])
-
-            elif "cmd" in msg:
-                if msg["cmd"] == "endpoint":
-                    if app.command_endpoint is not None:
-                        log.debug(f"Sending {msg['data']} to {app.command_endpoint.name}")
-                        try:
-                            resp = app.command_endpoint.send(jsondata=msg["data"], ws=websocket, client=client)
-                            if resp is not None:
-                                resp = app.command_endpoint.parse_response(resp)
-                                log.debug(f"Got response {resp} from endpoint")
-                                # HomeAssistantWebSocketEndpoint sends message via callback
-                                if resp is not None:
-                                    asyncio.ensure_future(websocket.send_text(resp))
-                        except CommandEndpointRuntimeException as e:
-                            command_endpoint_result = CommandEndpointResult(speech="WAS Command Endpoint unreachable")
-                            command_endpoint_response = CommandEndpointResponse(result=command_endpoint_result)
-                            asyncio.ensure_future(websocket.send_text(command_endpoint_response.model_dump_json()))
-                            log.error(f"WAS Command Endpoint unreachable: {e}")
-
-                    else:
-                        command_endpoint_result = CommandEndpointResult(speech="WAS Command Endpoint not active")
-                        command_endpoint_response = CommandEndpointResponse(result=command_endpoint_result)
-                        asyncio.ensure_future(websocket.send_text(command_endpoint_response.model_dump_json()))
-                        log.error("WAS Command Endpoint not active")
-
-                elif msg["cmd"] == "get_config":
-                    asyncio.ensure_future(websocket.send_text(build_msg(get_config_db(), "config")))
-
-            elif "goodbye" in msg:
-                app.connmgr.disconnect(websocket)
-
-            elif "hello" in msg:
-                if "hostname" in msg["hello"]:
-                    app.connmgr.update_client(websocket, "hostname", msg["hello"]["hostname"])
-                if "hw_type" in msg["hello"]:
-                    platform = msg["hello"]["hw_type"].upper()
-                    app.connmgr.update_client(websocket, "platform", platform)
-                if "mac_addr" in msg["hello"]:
-                    mac_addr = hex_mac(msg["hello"]["mac_addr"])
-                    app.connmgr.update_client(websocket, "mac_addr", mac_addr)
-
-    except WebSocketDisconnect:
-        app.connmgr.disconnect(websocket)
-    except ConnectionClosed:
-        app.connmgr.disconnect(websocket)
+            log.debug(data)
+            msg = ujson.loads(data)
+            await dispatcher.dispatch(websocket, client, msg)
+
+    except (ConnectionClosed, WebSocketDisconnect):
+        pass
     except Exception as e:
         log.error(f"unhandled exception in WebSocket route: {e}")
+    finally:
+        # stops the send queue writer of the connection
+        app.connmgr.disconnect(websocket)
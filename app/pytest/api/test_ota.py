@@ -1,10 +1,14 @@
 import json
+import os
+import shutil
 import unittest
 
 from unittest.mock import MagicMock, patch
 
 from fastapi.testclient import TestClient
 
+from app.const import DIR_OTA
+from app.internal.metrics import OTA_BYTES_SERVED
 from app.main import app
 from app.pytest.mock import mock_releases_willow
 
@@ -43,6 +47,25 @@ class TestOta(unittest.TestCase):
             assert response.status_code == 400
             assert json_response['detail'].startswith("invalid asset path")
 
+    def test_get_ota_range_bytes_served(self):
+        ota_dir = os.path.join(DIR_OTA, "0.0.0-mock.1")
+        os.makedirs(ota_dir, exist_ok=True)
+        with open(os.path.join(ota_dir, "ESP32-S3-BOX-3.bin"), "wb") as f:
+            f.write(b"0123456789")
+
+        try:
+            before = OTA_BYTES_SERVED.values.get(("ESP32-S3-BOX-3",), 0)
+            response = client.get(
+                "/api/ota?platform=ESP32-S3-BOX-3&version=0.0.0-mock.1", headers={"Range": "bytes=2-5"}
+            )
+
+            assert response.status_code == 206
+            assert response.content == b"2345"
+            # only the bytes in the requested range were sent, not the file size
+            assert OTA_BYTES_SERVED.values.get(("ESP32-S3-BOX-3",), 0) - before == 4
+        finally:
+            shutil.rmtree(ota_dir)
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -8,3 +8,24 @@ mock_releases_willow = [{
         }
     ]
 }]
+
+
+class MockWebSocketClient:
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+
+
+class MockWebSocket:
+    def __init__(self, host="127.0.0.1", port=0):
+        self.client = MockWebSocketClient(host, port)
+        self.sent = []
+
+    async def accept(self):
+        pass
+
+    async def close(self, code=1000, reason=None):
+        pass
+
+    async def send_text(self, data):
+        self.sent.append(data)
@@ -0,0 +1,106 @@
+import asyncio
+
+from app.internal.client import Client
+from app.internal.command_endpoints.breaker import BreakerState, CircuitBreaker
+from app.internal.connmgr import ConnMgr
+from app.main import app, command_endpoint_request, tracer
+from app.pytest.mock import MockWebSocket
+
+
+class Probe:
+    def __init__(self):
+        self.calls = 0
+        self.ok = False
+
+    async def __call__(self, timeout):
+        self.calls += 1
+        return self.ok
+
+
+def test_breaker_trip():
+    async def run():
+        probe = Probe()
+        breaker = CircuitBreaker(probe, failure_threshold=3, reset_timeout=0.01)
+        for _ in range(2):
+            assert breaker.allow()
+            breaker.failure()
+        assert breaker.state == BreakerState.closed
+
+        breaker.failure()
+        assert breaker.state == BreakerState.open
+        assert not breaker.allow()
+
+        # probing in the background while the endpoint is down
+        await asyncio.sleep(0.05)
+        assert breaker.state == BreakerState.open
+        assert probe.calls > 0
+
+        probe.ok = True
+        await asyncio.sleep(0.05)
+        assert breaker.state == BreakerState.half_open
+
+        # a single trial command, the rest is answered immediately
+        assert breaker.allow()
+        assert not breaker.allow()
+        breaker.success()
+        return breaker
+
+    breaker = asyncio.run(run())
+    assert breaker.state == BreakerState.closed
+    assert breaker.rejected == 2
+    assert breaker.transitions == {"closed->open": 1, "open->half_open": 1, "half_open->closed": 1}
+
+
+def test_breaker_trial_failure():
+    async def run():
+        probe = Probe()
+        probe.ok = True
+        breaker = CircuitBreaker(probe, failure_threshold=1, reset_timeout=0.01)
+        breaker.failure()
+        await asyncio.sleep(0.05)
+        assert breaker.allow()
+        breaker.failure()
+        state = breaker.state
+        breaker.stop()
+        return state
+
+    assert asyncio.run(run()) == BreakerState.open
+
+
+def test_breaker_success_resets():
+    breaker = CircuitBreaker(Probe(), failure_threshold=2)
+    breaker.failure()
+    breaker.success()
+    breaker.failure()
+    assert breaker.state == BreakerState.closed
+
+
+class BrokenEndpoint:
+    name = "broken"
+
+    def __init__(self, breaker, exception):
+        self.breaker = breaker
+        self.exception = exception
+
+    async def send(self, data=None, jsondata=None, ws=None, client=None):
+        raise self.exception
+
+
+def test_breaker_trial_unexpected_exception():
+    async def run():
+        breaker = CircuitBreaker(Probe(), failure_threshold=1)
+        breaker.state = BreakerState.half_open
+        app.connmgr = ConnMgr()
+        ws = MockWebSocket()
+        client = Client(ua="Willow/0.0.0")
+        await app.connmgr.accept(ws, client)
+
+        # the trial command fails with something else than a command endpoint exception
+        app.command_endpoint = BrokenEndpoint(breaker, IndexError("list index out of range"))
+        await command_endpoint_request(ws, client, {"text": "turn on light"}, tracer.start(client, "broken"))
+        assert breaker.state == BreakerState.open
+        assert not breaker.trial
+        breaker.stop()
+        app.command_endpoint = None
+
+    asyncio.run(run())
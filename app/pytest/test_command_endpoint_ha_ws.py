@@ -0,0 +1,328 @@
+import asyncio
+import json
+
+import pytest
+
+from app.internal.client import Client
+from app.internal.command_endpoints import CommandEndpointRuntimeException, CommandEndpointTimeoutException
+from app.internal.command_endpoints.fast_path import FastPathMatcher
+from app.internal.command_endpoints.ha_ws import HomeAssistantWebSocketEndpoint
+from app.internal.multinet import MultinetCompiler
+
+
+class MockHaws:
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, data):
+        self.sent.append(json.loads(data))
+
+
+def intent_end(id, speech):
+    return json.dumps({
+        "id": id,
+        "type": "event",
+        "event": {
+            "type": "intent-end",
+            "data": {
+                "intent_output": {
+                    "response": {
+                        "response_type": "action_done",
+                        "speech": {"plain": {"speech": speech}},
+                    },
+                },
+            },
+        },
+    })
+
+
+STATES = [
+    {"entity_id": "light.kitchen", "attributes": {"friendly_name": "Kitchen Light"}},
+    {"entity_id": "light.office_2", "attributes": {"friendly_name": "Office Light"}},
+    {"entity_id": "switch.office_light", "attributes": {"friendly_name": "Office Light"}},
+    {"entity_id": "sensor.kitchen_temperature", "attributes": {"friendly_name": "Kitchen Temperature"}},
+]
+
+EXPOSED = {
+    "light.kitchen": {"conversation": True},
+    "light.office_2": {"conversation": True},
+    "switch.office_light": {"conversation": True},
+}
+
+
+def exposed_result(id, exposed=EXPOSED):
+    return json.dumps({"id": id, "type": "result", "success": True, "result": {"exposed_entities": exposed}})
+
+
+async def endpoint(connected=True, fast_path=False):
+    endpoint = HomeAssistantWebSocketEndpoint(None, "127.0.0.1", 9, False, "token", fast_path=fast_path)
+    # we feed messages to the endpoint ourselves
+    endpoint.task.cancel()
+    if connected:
+        endpoint.haws = MockHaws()
+        endpoint.connected = True
+    return endpoint
+
+
+def test_ha_ws_response():
+    async def run():
+        ha = await endpoint()
+        request = asyncio.create_task(ha.send({"text": "turn on light", "language": "en"}, None, Client()))
+        await asyncio.sleep(0)
+        id = ha.haws.sent[0]["id"]
+        await ha.cb_msg(json.dumps({"id": id, "type": "result", "success": True, "result": None}))
+        await ha.cb_msg(intent_end(id, "Turned on the light"))
+        resp = json.loads(ha.parse_response(await request))
+        return ha, resp
+
+    ha, resp = asyncio.run(run())
+    assert resp == {"result": {"ok": True, "speech": "Turned on the light"}}
+    assert len(ha.pending) == 0
+    assert ha.pending.stats()["completed"] == 1
+
+
+def test_ha_ws_timeout():
+    async def run():
+        ha = await endpoint()
+        ha.pending.timeout = 0.05
+        await ha.send({"text": "turn on light"}, None, Client())
+
+    with pytest.raises(CommandEndpointTimeoutException):
+        asyncio.run(run())
+
+
+def test_ha_ws_reconnect():
+    async def run():
+        ha = await endpoint()
+        acked = asyncio.create_task(ha.send({"text": "turn on light"}, None, Client()))
+        unacked = asyncio.create_task(ha.send({"text": "turn off light"}, None, Client()))
+        await asyncio.sleep(0)
+        await ha.cb_msg(json.dumps({"id": ha.haws.sent[0]["id"], "type": "result", "success": True, "result": None}))
+
+        # HA connection drops and comes back
+        ha.link_lost()
+        with pytest.raises(CommandEndpointRuntimeException):
+            await acked
+
+        ha.haws = MockHaws()
+        await ha.cb_msg(json.dumps({"type": "auth_ok"}))
+        reissued = ha.haws.sent[-1]
+        assert reissued["input"] == {"text": "turn off light"}
+        await ha.cb_msg(intent_end(reissued["id"], "Turned off the light"))
+        return json.loads(ha.parse_response(await unacked))
+
+    assert asyncio.run(run())["result"]["speech"] == "Turned off the light"
+
+
+def test_ha_ws_buffer():
+    async def run():
+        ha = await endpoint(connected=False)
+        ha.buffer_size = 1
+        buffered = asyncio.create_task(ha.send({"text": "turn on light"}, None, Client()))
+        await asyncio.sleep(0)
+        assert ha.buffered() == 1
+
+        with pytest.raises(CommandEndpointRuntimeException):
+            await ha.send({"text": "turn off light"}, None, Client())
+
+        ha.haws = MockHaws()
+        await ha.cb_msg(json.dumps({"type": "auth_ok"}))
+        assert ha.connected
+        assert ha.buffered() == 0
+        flushed = ha.haws.sent[-1]
+        assert flushed["input"] == {"text": "turn on light"}
+
+        await ha.cb_msg(intent_end(flushed["id"], "Turned on the light"))
+        return json.loads(ha.parse_response(await buffered))
+
+    assert asyncio.run(run())["result"]["speech"] == "Turned on the light"
+
+
+def test_fast_path_matcher():
+    matcher = FastPathMatcher()
+    matcher.build(STATES)
+
+    assert matcher.entities == 3
+    assert matcher.match("Turn on the kitchen light.").entity_id == "light.kitchen"
+    assert matcher.match("turn off kitchen").service == "turn_off"
+    assert matcher.match("turn off office 2").entity_id == "light.office_2"
+    # two entities are called Office Light
+    assert matcher.match("turn on office light") is None
+    assert matcher.match("turn on kitchen temperature") is None
+    assert matcher.match("what is the kitchen temperature") is None
+
+
+def test_ha_ws_fast_path():
+    async def run():
+        ha = await endpoint(fast_path=True)
+        await ha.cb_msg(json.dumps({"type": "auth_ok"}))
+        assert ha.haws.sent[-1]["type"] == "get_states"
+        assert ha.haws.sent[-2]["type"] == "homeassistant/expose_entity/list"
+        await ha.cb_msg(exposed_result(ha.exposed_request_id))
+        await ha.cb_msg(json.dumps({"id": ha.states_request_id, "type": "result", "success": True, "result": STATES}))
+
+        request = asyncio.create_task(ha.send({"text": "Turn on the kitchen light", "language": "en"}, None, Client()))
+        await asyncio.sleep(0)
+        call = ha.haws.sent[-1]
+        await ha.cb_msg(json.dumps({"id": call["id"], "type": "result", "success": True, "result": None}))
+        resp = json.loads(ha.parse_response(await request))
+        return ha, call, resp
+
+    ha, call, resp = asyncio.run(run())
+    assert call["type"] == "call_service"
+    assert call["domain"] == "light"
+    assert call["service"] == "turn_on"
+    assert call["target"] == {"entity_id": "light.kitchen"}
+    assert resp == {"result": {"ok": True, "speech": "Turned on Kitchen Light"}}
+    assert ha.status()["fast_path"]["hits"] == 1
+    assert ha.status()["latency"]["fast_path"]["count"] == 1
+
+
+def test_ha_ws_fast_path_fallback():
+    async def run():
+        ha = await endpoint(fast_path=True)
+        ha.matcher.build(STATES)
+
+        # no match, straight to the pipeline
+        request = asyncio.create_task(ha.send({"text": "what is the kitchen temperature"}, None, Client()))
+        await asyncio.sleep(0)
+        assert ha.haws.sent[-1]["type"] == "assist_pipeline/run"
+        await ha.cb_msg(intent_end(ha.haws.sent[-1]["id"], "It is 21 degrees"))
+        first = json.loads(ha.parse_response(await request))
+
+        # HA refuses the service call, the pipeline gets a go
+        request = asyncio.create_task(ha.send({"text": "turn off kitchen light"}, None, Client()))
+        await asyncio.sleep(0)
+        call = ha.haws.sent[-1]
+        error = {"code": "not_found", "message": "entity unavailable"}
+        await ha.cb_msg(json.dumps({"id": call["id"], "type": "result", "success": False, "error": error}))
+        await asyncio.sleep(0)
+        assert ha.haws.sent[-1]["type"] == "assist_pipeline/run"
+        await ha.cb_msg(intent_end(ha.haws.sent[-1]["id"], "Kitchen Light is unavailable"))
+        second = json.loads(ha.parse_response(await request))
+        return ha, first, second
+
+    ha, first, second = asyncio.run(run())
+    assert first["result"]["speech"] == "It is 21 degrees"
+    assert second["result"]["speech"] == "Kitchen Light is unavailable"
+    assert ha.status()["fast_path"]["misses"] == 1
+    assert ha.status()["latency"]["pipeline"]["count"] == 2
+
+
+def state_changed(subscription_id, entity_id, friendly_name, state="on"):
+    new_state = None
+    if friendly_name is not None:
+        new_state = {"entity_id": entity_id, "state": state, "attributes": {"friendly_name": friendly_name}}
+    return json.dumps({
+        "id": subscription_id,
+        "type": "event",
+        "event": {
+            "event_type": "state_changed",
+            "data": {"entity_id": entity_id, "new_state": new_state},
+        },
+    })
+
+
+def test_ha_ws_index():
+    async def run():
+        ha = await endpoint(fast_path=True)
+        ha.rebuild_delay = 0
+        await ha.cb_msg(json.dumps({"type": "auth_ok"}))
+        subscriptions = [m["event_type"] for m in ha.haws.sent if m["type"] == "subscribe_events"]
+        assert subscriptions == ["device_registry_updated", "entity_registry_updated", "state_changed"]
+
+        await ha.cb_msg(exposed_result(ha.exposed_request_id, {**EXPOSED, "light.hallway": {"conversation": True}}))
+        await ha.cb_msg(json.dumps({"id": ha.states_request_id, "type": "result", "success": True, "result": STATES}))
+        version = ha.index.version
+
+        # state changes don't touch the names
+        await ha.cb_msg(state_changed(ha.states_subscription_id, "light.kitchen", "Kitchen Light", "off"))
+        assert ha.index.version == version
+        assert ha.index.entities["light.kitchen"]["state"] == "off"
+
+        # a new entity, a rename and a removal
+        await ha.cb_msg(state_changed(ha.states_subscription_id, "light.hallway", "Hallway"))
+        await ha.cb_msg(state_changed(ha.states_subscription_id, "light.kitchen", "Cooking Area"))
+        await ha.cb_msg(state_changed(ha.states_subscription_id, "switch.office_light", None))
+        await asyncio.sleep(0.01)
+
+        # a device registry update refreshes the willow devices
+        await ha.cb_msg(json.dumps({
+            "id": ha.registry_subscription_id,
+            "type": "event",
+            "event": {"event_type": "device_registry_updated", "data": {"action": "create", "device_id": "d1"}},
+        }))
+        assert ha.haws.sent[-1]["type"] == "config/device_registry/list"
+        devices = [{"id": "d1", "identifiers": [["willow", "aa:bb:cc:dd:ee:01"]]}]
+        await ha.cb_msg(json.dumps({
+            "id": ha.ha_willow_devices_request_id, "type": "result", "success": True, "result": devices,
+        }))
+        return ha
+
+    ha = asyncio.run(run())
+    assert ha.index.devices == {"aa:bb:cc:dd:ee:01": "d1"}
+    assert [e["entity_id"] for e in ha.index.get_entities()] == [
+        "light.hallway", "light.kitchen", "light.office_2", "sensor.kitchen_temperature",
+    ]
+    assert ha.matcher.match("turn on hallway").entity_id == "light.hallway"
+    assert ha.matcher.match("turn on cooking area").entity_id == "light.kitchen"
+    # no longer ambiguous
+    assert ha.matcher.match("turn on office light").entity_id == "light.office_2"
+
+
+def test_ha_ws_fast_path_exposed():
+    async def run():
+        ha = await endpoint(fast_path=True)
+        await ha.cb_msg(json.dumps({"type": "auth_ok"}))
+        exposed_request_id = ha.exposed_request_id
+        await ha.cb_msg(json.dumps({"id": ha.states_request_id, "type": "result", "success": True, "result": STATES}))
+        # nothing is matched until we know which entities are exposed to Assist
+        assert ha.matcher.match("turn on kitchen light") is None
+
+        await ha.cb_msg(exposed_result(exposed_request_id, {
+            "light.kitchen": {"conversation": False, "cloud.alexa": True},
+            "light.office_2": {"conversation": True},
+        }))
+        assert ha.matcher.match("turn on kitchen light") is None
+        assert ha.matcher.match("turn on office light").entity_id == "light.office_2"
+
+        # exposing an entity updates the entity registry, the exposed entities are fetched again
+        await ha.cb_msg(json.dumps({
+            "id": ha.entity_registry_subscription_id,
+            "type": "event",
+            "event": {"event_type": "entity_registry_updated", "data": {"action": "update", "entity_id": "light.kitchen"}},
+        }))
+        assert ha.haws.sent[-1]["type"] == "homeassistant/expose_entity/list"
+        await ha.cb_msg(exposed_result(ha.haws.sent[-1]["id"]))
+        return ha
+
+    ha = asyncio.run(run())
+    assert ha.matcher.match("turn on kitchen light").entity_id == "light.kitchen"
+    assert ha.status()["fast_path"]["exposed"] == 3
+
+
+def test_fast_path_matcher_memo():
+    compiler = MultinetCompiler()
+    matcher = FastPathMatcher(compiler)
+    matcher.build(STATES)
+    misses = compiler.misses
+
+    # a rebuild only compiles phrases for the renamed entity
+    states = STATES[1:] + [{"entity_id": "light.kitchen", "attributes": {"friendly_name": "Cooking Area"}}]
+    matcher.build(states)
+    assert compiler.misses == misses + 1
+    assert matcher.match("turn on cooking area").entity_id == "light.kitchen"
+    assert matcher.match("turn on kitchen light") is None
+
+
+def test_ha_ws_no_index():
+    async def run():
+        ha = await endpoint()
+        await ha.cb_msg(json.dumps({"type": "auth_ok"}))
+        return ha
+
+    ha = asyncio.run(run())
+    # without fast path and multinet only the willow devices are needed
+    assert [m["type"] for m in ha.haws.sent] == ["subscribe_events", "config/device_registry/list"]
+    assert ha.haws.sent[0]["event_type"] == "device_registry_updated"
+    assert ha.states_subscription_id is None
@@ -0,0 +1,153 @@
+import asyncio
+import json
+
+import paho.mqtt.client as mqtt
+import pytest
+
+from app.internal.client import Client
+from app.internal.command_endpoints import CommandEndpointRuntimeException, CommandEndpointTimeoutException
+from app.internal.command_endpoints.mqtt import MqttConfig, MqttEndpoint
+
+
+class MockMessageInfo:
+    def __init__(self, mid, rc=mqtt.MQTT_ERR_SUCCESS):
+        self.mid = mid
+        self.rc = rc
+
+
+class MockMqttClient:
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic, payload=None, qos=0):
+        self.published.append((topic, json.loads(payload), qos))
+        return MockMessageInfo(len(self.published))
+
+
+class MockMqttMessage:
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = json.dumps(payload).encode()
+
+
+async def endpoint(wait_response=True):
+    config = MqttConfig()
+    config.set_hostname("127.0.0.1")
+    config.set_topic("willow/command")
+    config.set_wait_response(wait_response)
+    endpoint = MqttEndpoint(config)
+    # we feed callbacks to the endpoint ourselves
+    endpoint.task.cancel()
+    endpoint.mqtt_client = MockMqttClient()
+    endpoint.connected = True
+    return endpoint
+
+
+def test_mqtt_response():
+    async def run():
+        ep = await endpoint()
+        request = asyncio.create_task(ep.send(jsondata={"text": "turn on light"}, ws=None, client=Client()))
+        await asyncio.sleep(0.01)
+        topic, payload, qos = ep.mqtt_client.published[0]
+        ep.cb_publish(ep.mqtt_client, None, 1, None, None)
+        await asyncio.sleep(0)
+        assert ep.pending.get(payload["id"]).acked
+
+        response = {"id": payload["id"], "ok": True, "speech": "Turned on the light"}
+        ep.cb_message(ep.mqtt_client, None, MockMqttMessage(payload["response_topic"], response))
+        return ep, topic, payload, qos, json.loads(ep.parse_response(await request))
+
+    ep, topic, payload, qos, resp = asyncio.run(run())
+    assert topic == "willow/command"
+    assert qos == 1
+    assert payload["response_topic"] == "willow/command/response"
+    assert payload["text"] == "turn on light"
+    assert resp == {"result": {"ok": True, "speech": "Turned on the light"}}
+    assert len(ep.pending) == 0
+    assert len(ep.publishing) == 0
+
+
+def test_mqtt_publish_only():
+    async def run():
+        ep = await endpoint(wait_response=False)
+        request = asyncio.create_task(ep.send(jsondata={"text": "turn on light"}, ws=None, client=Client()))
+        await asyncio.sleep(0.01)
+        assert not request.done()
+        ep.cb_publish(ep.mqtt_client, None, 1, None, None)
+        return ep, await request
+
+    ep, resp = asyncio.run(run())
+    # published as is, done on PUBACK
+    assert resp is None
+    assert ep.mqtt_client.published == [("willow/command", {"text": "turn on light"}, 1)]
+
+
+def test_mqtt_publish_only_timeout():
+    async def run():
+        ep = await endpoint(wait_response=False)
+        ep.timeout = 0.05
+        # the broker never acknowledges the publish
+        await ep.send(jsondata={"text": "turn on light"}, ws=None, client=Client())
+
+    with pytest.raises(CommandEndpointTimeoutException) as e:
+        asyncio.run(run())
+    assert not e.value.delivered
+
+
+def test_mqtt_timeout():
+    async def run():
+        ep = await endpoint()
+        ep.pending.timeout = 0.05
+        await ep.send(jsondata={"text": "turn on light"}, ws=None, client=Client())
+
+    with pytest.raises(CommandEndpointTimeoutException) as e:
+        asyncio.run(run())
+    assert not e.value.delivered
+
+
+def test_mqtt_timeout_delivered():
+    async def run():
+        ep = await endpoint()
+        ep.pending.timeout = 0.05
+        request = asyncio.create_task(ep.send(jsondata={"text": "turn on light"}, ws=None, client=Client()))
+        await asyncio.sleep(0.01)
+        ep.cb_publish(ep.mqtt_client, None, 1, None, None)
+        await request
+
+    # the broker acknowledged the command, only the reply is missing
+    with pytest.raises(CommandEndpointTimeoutException) as e:
+        asyncio.run(run())
+    assert e.value.delivered
+
+
+def test_mqtt_inflight_limit():
+    async def run():
+        ep = await endpoint()
+        ep.inflight = asyncio.Semaphore(1)
+        first = asyncio.create_task(ep.send(jsondata={"text": "turn on light"}, ws=None, client=Client()))
+        second = asyncio.create_task(ep.send(jsondata={"text": "turn off light"}, ws=None, client=Client()))
+        await asyncio.sleep(0.01)
+        # the broker did not acknowledge the first publish yet
+        assert len(ep.mqtt_client.published) == 1
+
+        ep.cb_publish(ep.mqtt_client, None, 1, None, None)
+        await asyncio.sleep(0.01)
+        assert len(ep.mqtt_client.published) == 2
+
+        for _, payload, _ in ep.mqtt_client.published:
+            ep.cb_message(ep.mqtt_client, None, MockMqttMessage("willow/command/response", {"id": payload["id"], "ok": True}))
+        return json.loads(ep.parse_response(await first)), json.loads(ep.parse_response(await second))
+
+    first, second = asyncio.run(run())
+    assert first == {"result": {"ok": True, "speech": "Success!"}}
+    assert second == first
+
+
+def test_mqtt_not_connected():
+    async def run():
+        ep = await endpoint()
+        ep.connected = False
+        await ep.send(jsondata={"text": "turn on light"}, ws=None, client=Client())
+
+    with pytest.raises(CommandEndpointRuntimeException):
+        asyncio.run(run())
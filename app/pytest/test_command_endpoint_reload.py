@@ -0,0 +1,136 @@
+import asyncio
+
+from types import SimpleNamespace
+
+import httpx
+
+import app.internal.command_endpoints.main as command_endpoints
+
+from app.internal.command_endpoints.ha_ws import HomeAssistantWebSocketEndpoint
+from app.internal.command_endpoints.main import drain_command_endpoint, init_command_endpoint
+from app.internal.command_endpoints.rest import RestEndpoint
+
+
+def rest_config(**kwargs):
+    return {
+        "command_endpoint": "REST",
+        "lcd_brightness": 500,
+        "rest_url": "http://127.0.0.1:9/api",
+        "was_mode": True,
+    } | kwargs
+
+
+def hass_config(**kwargs):
+    return {
+        "command_endpoint": "Home Assistant",
+        "hass_host": "127.0.0.1",
+        "hass_port": 9,
+        "hass_tls": False,
+        "hass_token": "token",
+        "was_mode": True,
+    } | kwargs
+
+
+def reload(monkeypatch, app, config):
+    monkeypatch.setattr(command_endpoints, "get_config_db", lambda: config)
+    init_command_endpoint(app)
+
+
+def test_reload_unchanged(monkeypatch):
+    async def run():
+        app = SimpleNamespace(command_endpoint=None)
+        reload(monkeypatch, app, rest_config())
+        endpoint = app.command_endpoint
+
+        reload(monkeypatch, app, rest_config(lcd_brightness=100, speaker_volume=80))
+        return endpoint, app
+
+    endpoint, app = asyncio.run(run())
+    assert isinstance(endpoint, RestEndpoint)
+    assert app.command_endpoint is endpoint
+
+
+def test_reload_changed(monkeypatch):
+    async def run():
+        app = SimpleNamespace(command_endpoint=None)
+        reload(monkeypatch, app, rest_config())
+        old = app.command_endpoint
+
+        reload(monkeypatch, app, rest_config(rest_url="http://127.0.0.1:9/other"))
+        await app.command_endpoint_reload
+        return old, app.command_endpoint
+
+    old, new = asyncio.run(run())
+    assert new is not old
+    assert new.url == "http://127.0.0.1:9/other"
+
+
+def test_reload_swap_after_connect(monkeypatch):
+    async def run():
+        app = SimpleNamespace(command_endpoint=None)
+        reload(monkeypatch, app, rest_config())
+        old = app.command_endpoint
+
+        reload(monkeypatch, app, hass_config())
+        new = app.command_endpoint_next
+        await asyncio.sleep(0.01)
+        # the running endpoint keeps handling commands until Home Assistant is connected
+        assert app.command_endpoint is old
+
+        new.set_link_state("connected")
+        await app.command_endpoint_reload
+        new.stop()
+        return old, new, app.command_endpoint
+
+    old, new, current = asyncio.run(run())
+    assert isinstance(new, HomeAssistantWebSocketEndpoint)
+    assert current is new
+
+
+def test_reload_was_mode_disabled(monkeypatch):
+    async def run():
+        app = SimpleNamespace(command_endpoint=None)
+        reload(monkeypatch, app, rest_config())
+        reload(monkeypatch, app, rest_config(was_mode=False))
+        return app.command_endpoint
+
+    assert asyncio.run(run()) is None
+
+
+def test_drain_rest():
+    closed = []
+
+    async def run():
+        endpoint = RestEndpoint("http://127.0.0.1:9/api")
+
+        async def handler(request):
+            await asyncio.sleep(0.2)
+            closed.append(endpoint.client.is_closed)
+            return httpx.Response(200, text="Turned on the light")
+
+        endpoint.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        request = asyncio.create_task(endpoint.send(jsondata={"text": "turn on light"}))
+        await asyncio.sleep(0.01)
+        assert endpoint.outstanding() == 1
+
+        await drain_command_endpoint(endpoint)
+        response = await request
+        await asyncio.sleep(0)
+        return endpoint, response
+
+    endpoint, response = asyncio.run(run())
+    assert response.status_code == 200
+    # the request in flight completed before the client was closed
+    assert closed == [False]
+    assert endpoint.outstanding() == 0
+    assert endpoint.client.is_closed
+
+
+def test_reload_unknown_fallback(monkeypatch):
+    async def run():
+        app = SimpleNamespace(command_endpoint=None)
+        reload(monkeypatch, app, rest_config(command_endpoint_fallback="Carrier Pigeon"))
+        return app.command_endpoint
+
+    # unknown endpoints are skipped, a single endpoint left isn't routed
+    assert isinstance(asyncio.run(run()), RestEndpoint)
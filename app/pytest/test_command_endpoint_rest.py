@@ -0,0 +1,57 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+from app.internal.command_endpoints import CommandEndpointRuntimeException
+from app.internal.command_endpoints.openhab import OpenhabEndpoint
+from app.internal.command_endpoints.rest import RestEndpoint
+
+
+def mock_client(handler):
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+
+def test_rest_endpoint():
+    async def handler(request):
+        assert json.loads(request.content) == {"text": "turn on light"}
+        return httpx.Response(200, text="turned on light")
+
+    async def run():
+        endpoint = RestEndpoint("http://rest.local/api")
+        endpoint.client = mock_client(handler)
+        resp = await endpoint.send(jsondata={"text": "turn on light"})
+        return json.loads(endpoint.parse_response(resp))
+
+    assert asyncio.run(run()) == {"result": {"ok": True, "speech": "turned on light"}}
+
+
+def test_openhab_endpoint():
+    async def handler(request):
+        assert request.url == "http://openhab.local/rest/voice/interpreters"
+        assert request.content == b"turn on light"
+        return httpx.Response(500)
+
+    async def run():
+        endpoint = OpenhabEndpoint("http://openhab.local", "token")
+        endpoint.client = mock_client(handler)
+        resp = await endpoint.send(jsondata={"text": "turn on light"})
+        return json.loads(endpoint.parse_response(resp))
+
+    assert asyncio.run(run())["result"]["ok"] is False
+
+
+def test_rest_endpoint_deadline():
+    async def handler(request):
+        await asyncio.sleep(1)
+        return httpx.Response(200)
+
+    async def run():
+        endpoint = RestEndpoint("http://rest.local/api")
+        endpoint.client = mock_client(handler)
+        endpoint.timeout = 0.05
+        await endpoint.send(jsondata={"text": "turn on light"})
+
+    with pytest.raises(CommandEndpointRuntimeException):
+        asyncio.run(run())
@@ -0,0 +1,143 @@
+import asyncio
+
+import pytest
+
+from app.internal.client import Client
+from app.internal.command_endpoints import CommandEndpoint, CommandEndpointRuntimeException
+from app.internal.command_endpoints.router import RoutedEndpoint, RoutingPolicy
+from app.internal.connmgr import ConnMgr
+from app.main import app, command_endpoint_request, tracer
+from app.pytest.mock import MockWebSocket
+
+
+class FakeEndpoint(CommandEndpoint):
+    def __init__(self, name, delay=0, fail=False, response=True):
+        self.name = name
+        self.cancelled = 0
+        self.delay = delay
+        self.fail = fail
+        self.response = response
+        self.sent = []
+
+    async def send(self, jsondata=None, ws=None, client=None):
+        self.sent.append(jsondata)
+        try:
+            await asyncio.sleep(self.delay)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        if self.fail:
+            raise CommandEndpointRuntimeException(f"{self.name} failed")
+        return self.name if self.response else None
+
+    def parse_response(self, response):
+        return f"parsed by {self.name}: {response}"
+
+
+def test_router_failover():
+    async def run():
+        primary = FakeEndpoint("primary", fail=True)
+        secondary = FakeEndpoint("secondary")
+        router = RoutedEndpoint([primary, secondary])
+        resp = router.parse_response(await router.send({"text": "turn on light"}))
+        return router, resp
+
+    router, resp = asyncio.run(run())
+    assert resp == "parsed by secondary: secondary"
+    assert router.status()["endpoints"][0]["routing"]["errors"] == 1
+    assert router.status()["endpoints"][1]["routing"]["wins"] == 1
+
+
+def test_router_no_response():
+    async def run():
+        # e.g. MQTT without waiting for a reply
+        router = RoutedEndpoint([FakeEndpoint("primary", response=False), FakeEndpoint("secondary")])
+        return router.parse_response(await router.send({"text": "turn on light"}))
+
+    assert asyncio.run(run()) is None
+
+
+def test_router_failover_skips_disconnected():
+    async def run():
+        primary = FakeEndpoint("primary")
+        primary.link_up = asyncio.Event()
+        secondary = FakeEndpoint("secondary")
+        router = RoutedEndpoint([primary, secondary])
+        resp = await router.send({"text": "turn on light"})
+        return primary, resp
+
+    primary, resp = asyncio.run(run())
+    assert resp[1] == "secondary"
+    assert primary.sent == []
+
+
+def test_router_all_fail():
+    async def run():
+        router = RoutedEndpoint([FakeEndpoint("primary", fail=True), FakeEndpoint("secondary", fail=True)])
+        await router.send({"text": "turn on light"})
+
+    with pytest.raises(CommandEndpointRuntimeException):
+        asyncio.run(run())
+
+
+def test_router_hedge():
+    async def run():
+        primary = FakeEndpoint("primary", delay=1)
+        secondary = FakeEndpoint("secondary", delay=0.01)
+        router = RoutedEndpoint([primary, secondary], policy=RoutingPolicy.hedge)
+        router.hedge_delay_default = 0.05
+        resp = await router.send({"text": "turn on light"})
+        await asyncio.sleep(0)
+        return router, primary, resp
+
+    router, primary, resp = asyncio.run(run())
+    assert resp[1] == "secondary"
+    assert router.hedged == 1
+    # the slow request is cancelled
+    assert primary.cancelled == 1
+
+
+def test_router_hedge_all_slow():
+    async def run():
+        primary = FakeEndpoint("primary", delay=0.5)
+        secondary = FakeEndpoint("secondary", delay=0.5)
+        router = RoutedEndpoint([primary, secondary], policy=RoutingPolicy.hedge)
+        router.hedge_delay_default = 0.1
+        resp = await router.send({"text": "turn on light"})
+        return router, resp
+
+    # neither answers within the hedge delay, wait for the first one after all were sent to
+    router, resp = asyncio.run(run())
+    assert resp[1] == "primary"
+    assert router.hedged == 1
+
+
+def test_router_hedge_delay():
+    router = RoutedEndpoint([FakeEndpoint("primary"), FakeEndpoint("secondary")], policy=RoutingPolicy.hedge)
+    assert router.hedge_delay(0) == router.hedge_delay_default
+    router.stats[0].latency.extend([200] * 18 + [400] * 2)
+    assert router.hedge_delay(0) == pytest.approx(0.4, abs=0.05)
+
+
+def test_router_trace_endpoint():
+    async def run():
+        app.connmgr = ConnMgr()
+        ws = MockWebSocket()
+        client = Client(ua="Willow/0.0.0")
+        await app.connmgr.accept(ws, client)
+
+        app.command_endpoint = RoutedEndpoint([FakeEndpoint("primary", fail=True), FakeEndpoint("secondary")])
+        trace = tracer.start(client, app.command_endpoint.name)
+        await command_endpoint_request(ws, client, {"text": "turn on light"}, trace)
+        for _ in range(100):
+            if trace.status is not None:
+                break
+            await asyncio.sleep(0.01)
+        app.command_endpoint = None
+        return trace
+
+    trace = asyncio.run(run())
+    assert trace.status == "ok"
+    # keyed by the endpoint that answered, not the router
+    assert trace.endpoint == "secondary"
+    assert "secondary" in tracer.model_dump()["endpoints"]
@@ -0,0 +1,29 @@
+import json
+
+from app.db.main import ConfigCache
+from app.db.models import WillowConfigType
+
+
+def test_config_cache():
+    cache = ConfigCache()
+    loads = []
+
+    def load():
+        loads.append(1)
+        return {"wake_word": "alexa", "aec": True}
+
+    data, msg = cache.get(WillowConfigType.config, load)
+    assert json.loads(msg) == {"config": data}
+    cache.get(WillowConfigType.config, load)
+    assert len(loads) == 1
+    assert cache.stats() == {'entries': ['config'], 'hits': 1, 'misses': 1}
+
+    # write-through replaces the entry without loading
+    cache.set(WillowConfigType.config, {"wake_word": "hiesp"})
+    data, msg = cache.get(WillowConfigType.config, load)
+    assert msg == '{"config": {"wake_word": "hiesp"}}'
+    assert len(loads) == 1
+
+    cache.invalidate(WillowConfigType.config)
+    cache.get(WillowConfigType.config, load)
+    assert len(loads) == 2
@@ -0,0 +1,86 @@
+import asyncio
+import json
+
+import app.internal.was as was
+
+from app.internal.client import Client
+from app.internal.config_versions import ConfigVersions
+from app.internal.connmgr import BroadcastStatus, ConnMgr
+from app.pytest.mock import MockWebSocket
+
+
+def test_config_versions():
+    versions = ConfigVersions(history=2)
+    assert asyncio.run(versions.update({"aec": True, "speaker_volume": 50}))
+    assert asyncio.run(versions.update({"aec": True, "speaker_volume": 60, "wake_word": "alexa"}))
+    # same content, same version
+    assert not asyncio.run(versions.update({"speaker_volume": 60, "wake_word": "alexa", "aec": True}))
+    assert versions.version == 2
+    hashes = {version: hash for version, (hash, _) in versions.history.items()}
+
+    assert versions.get_msg(2, hashes[2]) is None
+    assert json.loads(versions.get_msg(1, hashes[1])) == {"config_delta": {
+        "from": 1, "hash": hashes[2], "to": 2, "set": {"speaker_volume": 60, "wake_word": "alexa"}, "unset": [],
+    }}
+
+    assert asyncio.run(versions.update({"aec": True, "speaker_volume": 60}))
+    assert json.loads(versions.get_msg(2, hashes[2]))["config_delta"]["unset"] == ["wake_word"]
+    # version 1 dropped out of the history, unknown versions get the full config
+    assert json.loads(versions.get_msg(1, hashes[1])) == {
+        "config": {"aec": True, "speaker_volume": 60}, "config_hash": versions.hash, "config_version": 3,
+    }
+    assert json.loads(versions.get_msg(42, None))["config_version"] == 3
+
+
+def test_config_versions_reset():
+    # the device has version 1 from before a database reset, WAS numbers a different config as 1 again
+    old = ConfigVersions()
+    asyncio.run(old.update({"speaker_volume": 50}))
+    versions = ConfigVersions()
+    asyncio.run(versions.update({"speaker_volume": 60}))
+    assert versions.version == old.version
+
+    assert json.loads(versions.get_msg(old.version, old.hash))["config"] == {"speaker_volume": 60}
+    assert json.loads(versions.get_msg(old.version, None))["config"] == {"speaker_volume": 60}
+    assert versions.get_msg(versions.version, versions.hash) is None
+
+
+def test_config_versions_broadcast():
+    async def run():
+        versions = ConfigVersions()
+        await versions.update({"speaker_volume": 50})
+        hashes = {1: versions.hash}
+        await versions.update({"speaker_volume": 60})
+        hashes[2] = versions.hash
+
+        connmgr = ConnMgr()
+        clients = {}
+        for i, config_version in enumerate([None, 1, 2]):
+            ws = MockWebSocket(port=i)
+            await connmgr.accept(ws, Client(ua="Willow/0.0.0"))
+            connmgr.update_client(ws, "hostname", f"willow-{i}")
+            connmgr.update_client(ws, "config_version", (config_version, hashes.get(config_version)))
+            clients[i] = ws
+
+        def build_client_msg(client):
+            if client.config_version is None:
+                return '{"config": {"speaker_volume": 60}}'
+            return versions.get_msg(client.config_version, client.config_hash)
+
+        report = await connmgr.broadcast(build_client_msg)
+        assert [delivery.status for delivery in report] == [BroadcastStatus.ok, BroadcastStatus.ok, BroadcastStatus.skipped]
+        assert json.loads(clients[0].sent[0]) == {"config": {"speaker_volume": 60}}
+        assert json.loads(clients[1].sent[0])["config_delta"]["set"] == {"speaker_volume": 60}
+        assert clients[2].sent == []
+
+    asyncio.run(run())
+
+
+def test_full_config_msg_without_versions(monkeypatch):
+    monkeypatch.setattr(was, "get_config_msg", lambda: '{"config": {"speaker_volume": 60}}')
+    versions = ConfigVersions()
+    # e.g. loading the config versions failed at startup
+    assert was.get_full_config_msg(versions) == '{"config": {"speaker_volume": 60}}'
+
+    asyncio.run(versions.update({"speaker_volume": 60}))
+    assert was.get_full_config_msg(versions) == versions.full
@@ -0,0 +1,68 @@
+import asyncio
+
+from app.internal.client import Client
+from app.internal.connmgr import BroadcastStatus, ConnMgr
+from app.pytest.mock import MockWebSocket
+
+
+def test_connmgr_index():
+    connmgr = ConnMgr()
+    ws1 = MockWebSocket(port=1)
+    ws2 = MockWebSocket(port=2)
+
+    asyncio.run(connmgr.accept(ws1, Client(ua="Willow/0.0.0")))
+    connmgr.update_client(ws1, "hostname", "willow-1")
+    connmgr.update_client(ws1, "mac_addr", "aa:bb:cc:dd:ee:01")
+
+    assert connmgr.get_client_by_hostname("willow-1") == ws1
+    assert connmgr.get_mac_by_hostname("willow-1") == "aa:bb:cc:dd:ee:01"
+    assert connmgr.get_ws_by_mac("aa:bb:cc:dd:ee:01") == ws1
+    assert connmgr.get_client_by_hostname("unknown") is None
+
+    # device reconnects before the old connection is gone
+    asyncio.run(connmgr.accept(ws2, Client(ua="Willow/0.0.0")))
+    connmgr.update_client(ws2, "hostname", "willow-1")
+    connmgr.update_client(ws2, "mac_addr", "aa:bb:cc:dd:ee:01")
+
+    assert connmgr.get_client_by_hostname("willow-1") == ws2
+    assert connmgr.get_ws_by_mac("aa:bb:cc:dd:ee:01") == ws2
+
+    connmgr.disconnect(ws2)
+    assert connmgr.get_client_by_hostname("willow-1") == ws1
+
+    # MAC changes must not leave stale index entries behind
+    connmgr.update_client(ws1, "mac_addr", "aa:bb:cc:dd:ee:02")
+    assert connmgr.get_ws_by_mac("aa:bb:cc:dd:ee:01") is None
+    assert connmgr.get_ws_by_mac("aa:bb:cc:dd:ee:02") == ws1
+
+    connmgr.disconnect(ws1)
+    assert connmgr.get_client_by_hostname("willow-1") is None
+    assert connmgr.get_mac_by_hostname("willow-1") is None
+    assert connmgr.get_ws_by_mac("aa:bb:cc:dd:ee:02") is None
+
+
+class StalledWebSocket(MockWebSocket):
+    async def send_text(self, data):
+        await asyncio.sleep(10)
+
+
+def test_connmgr_broadcast():
+    async def run():
+        connmgr = ConnMgr(broadcast_timeout=0.05, broadcast_max_missed=2)
+        ws_ok = MockWebSocket(port=1)
+        ws_stalled = StalledWebSocket(port=2)
+        await connmgr.accept(ws_ok, Client(hostname="willow-ok", ua="Willow/0.0.0"))
+        await connmgr.accept(ws_stalled, Client(hostname="willow-stalled", ua="Willow/0.0.0"))
+
+        report = await connmgr.broadcast("msg")
+        statuses = {delivery.hostname: delivery.status for delivery in report}
+        assert statuses == {"willow-ok": BroadcastStatus.ok, "willow-stalled": BroadcastStatus.timeout}
+        assert ws_ok.sent == ["msg"]
+        assert connmgr.get_client_by_ws(ws_stalled).slow
+
+        report = await connmgr.broadcast("msg")
+        statuses = {delivery.hostname: delivery.status for delivery in report}
+        assert statuses["willow-stalled"] == BroadcastStatus.disconnected
+        assert ws_stalled not in connmgr.connected_clients
+
+    asyncio.run(run())
@@ -0,0 +1,28 @@
+import asyncio
+import threading
+import time
+
+from app.db.main import DbExecutor
+from app.internal.metrics import DB_CALL_DURATION, DB_WAIT
+
+
+def test_db_executor():
+    async def run():
+        executor = DbExecutor(workers=1)
+        loop_thread = threading.get_ident()
+
+        def query(value):
+            assert threading.get_ident() != loop_thread
+            time.sleep(0.02)
+            return value
+
+        waits = DB_WAIT.values.get((), [0])[-1]
+        # the loop keeps running while the query blocks a worker
+        results = await asyncio.gather(executor.run(query, 1), executor.run(query, 2), asyncio.sleep(0.01))
+        assert results[:2] == [1, 2]
+        assert executor.pending == 0
+        # the second call waited for the only worker
+        assert DB_WAIT.values[()][-1] - waits >= 0.02
+        assert sum(DB_CALL_DURATION.values[("query",)][:-1]) >= 2
+
+    asyncio.run(run())
@@ -0,0 +1,53 @@
+import asyncio
+
+from app.internal.dispatch import MessageDispatcher
+from app.internal.metrics import WS_HANDLER_DURATION, WS_MESSAGES_RECEIVED
+
+
+def test_dispatch():
+    dispatcher = MessageDispatcher()
+    calls = []
+
+    @dispatcher.register("hello")
+    async def handle_hello(ws, client, msg):
+        calls.append(("hello", msg["hello"]))
+
+    @dispatcher.register("cmd/get_config")
+    async def handle_get_config(ws, client, msg):
+        calls.append(("get_config", None))
+
+    async def run():
+        await dispatcher.dispatch(None, None, {"hello": {"hostname": "willow-1"}})
+        await dispatcher.dispatch(None, None, {"cmd": "get_config"})
+        await dispatcher.dispatch(None, None, {"cmd": "unknown"})
+        await dispatcher.dispatch(None, None, {"unknown": {}})
+
+    asyncio.run(run())
+
+    assert calls == [("hello", {"hostname": "willow-1"}), ("get_config", None)]
+    stats = dispatcher.get_stats()
+    assert stats["hello"]["count"] == 1
+    assert stats["cmd/get_config"]["count"] == 1
+
+
+def test_dispatch_metrics():
+    dispatcher = MessageDispatcher()
+
+    @dispatcher.register("hello")
+    async def handle_hello(ws, client, msg):
+        pass
+
+    async def run():
+        await dispatcher.dispatch(None, None, {"hello": {}})
+        await dispatcher.dispatch(None, None, {"hello": {}})
+        for i in range(10):
+            await dispatcher.dispatch(None, None, {"cmd": f"bogus{i}"})
+
+    asyncio.run(run())
+    dispatcher.collect_metrics()
+
+    # unregistered types are all counted as unknown
+    assert WS_MESSAGES_RECEIVED.values == {("hello",): 2, ("unknown",): 10}
+    assert list(WS_HANDLER_DURATION.values) == [("hello",)]
+    lines = WS_HANDLER_DURATION.render()
+    assert 'was_ws_handler_duration_seconds_count{type="hello"} 2' in lines
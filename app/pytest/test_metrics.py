@@ -0,0 +1,33 @@
+from app.internal.metrics import Counter, Histogram, MetricsRegistry, message_type
+
+
+def test_metrics_render():
+    registry = MetricsRegistry()
+    counter = registry.add(Counter("test_messages_total", "Messages", ["type"]))
+    histogram = registry.add(Histogram("test_duration_seconds", "Duration", buckets=(0.1, 1.0)))
+
+    counter.inc("hello")
+    counter.inc("hello")
+    counter.inc('say "hi"', amount=3)
+    histogram.observe(0.1)
+    histogram.observe(0.5)
+    histogram.observe(5)
+
+    lines = registry.render().splitlines()
+    assert "# TYPE test_messages_total counter" in lines
+    assert 'test_messages_total{type="hello"} 2' in lines
+    assert 'test_messages_total{type="say \\"hi\\""} 3' in lines
+    # buckets are cumulative and inclusive
+    assert 'test_duration_seconds_bucket{le="0.1"} 1' in lines
+    assert 'test_duration_seconds_bucket{le="1.0"} 2' in lines
+    assert 'test_duration_seconds_bucket{le="+Inf"} 3' in lines
+    assert "test_duration_seconds_sum 5.6" in lines
+    assert "test_duration_seconds_count 3" in lines
+
+
+def test_message_type():
+    assert message_type('{"cmd":"notify","data":{}}') == "cmd/notify"
+    assert message_type('{"config":{"a":1}}') == "config"
+    assert message_type('{"cmd": "restart"}') == "cmd/restart"
+    assert message_type('{"result": {"ok": true}}') == "result"
+    assert message_type('[]') == "unknown"
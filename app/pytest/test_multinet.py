@@ -0,0 +1,63 @@
+import json
+
+from app.internal.multinet import MultinetCompiler
+from app.internal.was import get_ha_commands_for_entity
+
+
+def entity(entity_id, friendly_name):
+    return {"entity_id": entity_id, "state": "on", "attributes": {"friendly_name": friendly_name}}
+
+
+def test_ha_commands_all_numbers():
+    assert get_ha_commands_for_entity("Room 2 Lamp 3") == ["TURN ON ROOM TWO LAMP THREE", "TURN OFF ROOM TWO LAMP THREE"]
+
+
+def test_multinet_compile(tmp_path):
+    compiler = MultinetCompiler(max_commands=4, path=tmp_path / "multinet.json")
+    entities = [
+        entity("light.kitchen", "Kitchen"),
+        entity("sensor.kitchen", "Kitchen Temperature"),
+        entity("switch.kitchen", "Kitchen"),
+        entity("light.long", "A light with a name that is much too long for the multinet phrase limit"),
+        entity("light.office", "Office"),
+        entity("light.hallway", "Hallway"),
+    ]
+
+    commands = compiler.compile(entities)
+    assert commands == ["TURN ON KITCHEN", "TURN OFF KITCHEN", "TURN ON OFFICE", "TURN OFF OFFICE"]
+    assert compiler.collisions == 2
+    assert compiler.skipped == 1
+    assert compiler.misses == 5
+
+    # only the renamed entity is recomputed
+    entities[4] = entity("light.office", "Study")
+    commands = compiler.compile(entities)
+    assert commands == ["TURN ON KITCHEN", "TURN OFF KITCHEN", "TURN ON STUDY", "TURN OFF STUDY"]
+    assert compiler.misses == 6
+    assert compiler.hits == 4
+
+
+def test_multinet_write(tmp_path):
+    path = tmp_path / "multinet.json"
+    compiler = MultinetCompiler(path=path)
+    entities = [entity("light.kitchen", "Kitchen")]
+
+    assert compiler.update(entities)
+    written = json.loads(path.read_text())
+    assert written["commands"] == ["TURN ON KITCHEN", "TURN OFF KITCHEN"]
+    assert not compiler.update(entities)
+
+    # the version is read back from the file after a restart
+    assert not MultinetCompiler(path=path).update(entities)
+    assert MultinetCompiler(path=path).update(entities + [entity("light.office", "Office")])
+
+
+def test_multinet_user_file(tmp_path):
+    path = tmp_path / "multinet.json"
+    path.write_text(json.dumps({"commands": ["TURN ON THE COFFEE MACHINE"]}))
+
+    # a multinet file without version is user provided, it's never overwritten
+    compiler = MultinetCompiler(path=path)
+    assert not compiler.update([entity("light.kitchen", "Kitchen")])
+    assert json.loads(path.read_text()) == {"commands": ["TURN ON THE COFFEE MACHINE"]}
+    assert compiler.writes == 0
@@ -0,0 +1,129 @@
+import asyncio
+import json
+import time
+
+from app.internal.client import Client
+from app.internal.connmgr import ConnMgr
+from app.internal.notify import NotifyData, NotifyQueue
+from app.pytest.mock import MockWebSocket
+
+
+async def setup():
+    connmgr = ConnMgr()
+    ws = MockWebSocket()
+    await connmgr.accept(ws, Client(ua="Willow/0.0.0"))
+    connmgr.update_client(ws, "hostname", "willow-1")
+    connmgr.update_client(ws, "mac_addr", "aa:bb:cc:dd:ee:01")
+
+    notify_queue = NotifyQueue(connmgr=connmgr)
+    notify_queue.start()
+    return connmgr, ws, notify_queue
+
+
+def test_notify_dispatch():
+    async def run():
+        connmgr, ws, notify_queue = await setup()
+
+        now = int(time.time() * 1000)
+        notify_queue.add({"cmd": "notify", "hostname": "willow-1", "data": {"id": now, "text": "first", "volume": 50}})
+        notify_queue.add({"cmd": "notify", "hostname": "willow-1", "data": {"id": now + 1, "text": "second", "volume": 50}})
+        await asyncio.sleep(0.01)
+
+        # only one notification is active at a time
+        assert len(ws.sent) == 1
+        assert json.loads(ws.sent[0])["data"]["text"] == "first"
+
+        notify_queue.done(ws, now)
+        await asyncio.sleep(0.01)
+        assert json.loads(ws.sent[-2])["data"]["text"] == "second"
+        assert json.loads(ws.sent[-1])["data"] == {"cancel": True, "id": now}
+
+        notify_queue.task.cancel()
+
+    asyncio.run(run())
+
+
+def test_notify_scheduled():
+    async def run():
+        connmgr, ws, notify_queue = await setup()
+
+        due = int(time.time() * 1000) + 100
+        notify_queue.add({"cmd": "notify", "hostname": "willow-1", "data": {"id": due, "text": "later", "volume": 50}})
+        await asyncio.sleep(0.05)
+        assert ws.sent == []
+
+        await asyncio.sleep(0.1)
+        assert len(ws.sent) == 1
+        assert json.loads(ws.sent[0])["data"]["text"] == "later"
+
+        notify_queue.task.cancel()
+
+    asyncio.run(run())
+
+
+def test_notify_offline():
+    async def run():
+        connmgr, ws, notify_queue = await setup()
+        connmgr.disconnect(ws)
+
+        ws = MockWebSocket()
+        await connmgr.accept(ws, Client(ua="Willow/0.0.0"))
+        connmgr.update_client(ws, "hostname", "willow-1")
+        data = NotifyData(id=int(time.time() * 1000), text="offline", volume=50)
+        notify_queue.enqueue("aa:bb:cc:dd:ee:01", data)
+        notify_queue.wakeup.set()
+        await asyncio.sleep(0.01)
+        assert ws.sent == []
+
+        # delivered once the device reports its MAC address
+        connmgr.update_client(ws, "mac_addr", "aa:bb:cc:dd:ee:01")
+        notify_queue.kick("aa:bb:cc:dd:ee:01")
+        await asyncio.sleep(0.01)
+        assert len(ws.sent) == 1
+
+        notify_queue.task.cancel()
+
+    asyncio.run(run())
+
+
+
+def test_notify_without_volume():
+    async def run():
+        connmgr, ws, notify_queue = await setup()
+        notify_queue.persist = True
+
+        now = int(time.time() * 1000)
+        notify_queue.add({"cmd": "notify", "hostname": "willow-1", "data": {"id": now, "text": "no volume"}})
+        await asyncio.sleep(0.01)
+        notify_queue.task.cancel()
+        return ws, notify_queue
+
+    ws, notify_queue = asyncio.run(run())
+    data = json.loads(ws.sent[0])["data"]
+    assert data["text"] == "no volume"
+    assert "volume" not in data
+    assert len(notify_queue.changes) == 1
+
+
+def test_notify_payload_failure():
+    async def run():
+        connmgr, ws, notify_queue = await setup()
+
+        now = int(time.time() * 1000)
+        broken = NotifyData(id=now, text="broken")
+        # e.g. a notification restored from an older version that no longer serializes
+        broken.strobe_period_ms = object()
+        notify_queue.enqueue("aa:bb:cc:dd:ee:01", broken)
+        notify_queue.enqueue("aa:bb:cc:dd:ee:01", NotifyData(id=now + 1, text="next"))
+        notify_queue.wakeup.set()
+        for _ in range(100):
+            if ws.sent:
+                break
+            await asyncio.sleep(0.01)
+        notify_queue.task.cancel()
+        return connmgr, ws
+
+    connmgr, ws = asyncio.run(run())
+    # the broken notification is dropped without blocking the device
+    assert len(ws.sent) == 1
+    assert json.loads(ws.sent[0])["data"]["text"] == "next"
@@ -0,0 +1,71 @@
+import asyncio
+
+from app.internal.sendqueue import SendQueue, SendQueuePolicy, overflow_tasks
+from app.pytest.mock import MockWebSocket
+
+
+def test_sendqueue_order():
+    async def run():
+        ws = MockWebSocket()
+        send_queue = SendQueue(ws, maxsize=8)
+        send_queue.start()
+        futures = [send_queue.put(f"msg{i}") for i in range(5)]
+        assert await asyncio.gather(*futures) == [True] * 5
+        assert ws.sent == [f"msg{i}" for i in range(5)]
+        assert send_queue.stats.sent == 5
+        assert send_queue.stats.depth == 0
+        send_queue.stop()
+
+    asyncio.run(run())
+
+
+def test_sendqueue_drop_oldest():
+    async def run():
+        ws = MockWebSocket()
+        # writer not started, so the queue fills up
+        send_queue = SendQueue(ws, maxsize=2, policy=SendQueuePolicy.drop_oldest)
+        first = send_queue.put("msg0")
+        send_queue.put("msg1")
+        send_queue.put("msg2")
+        assert await first is False
+        assert send_queue.stats.dropped == 1
+
+        send_queue.start()
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        assert ws.sent == ["msg1", "msg2"]
+        send_queue.stop()
+
+    asyncio.run(run())
+
+
+def test_sendqueue_drop_newest():
+    async def run():
+        send_queue = SendQueue(MockWebSocket(), maxsize=1, policy=SendQueuePolicy.drop_newest)
+        send_queue.put("msg0")
+        assert await send_queue.put("msg1") is False
+        assert send_queue.stats.depth == 1
+        send_queue.stop()
+
+    asyncio.run(run())
+
+
+def test_sendqueue_close():
+    async def run():
+        closed = []
+
+        async def on_overflow(ws):
+            closed.append(ws)
+
+        ws = MockWebSocket()
+        send_queue = SendQueue(ws, maxsize=1, policy=SendQueuePolicy.close, on_overflow=on_overflow)
+        send_queue.put("msg0")
+        assert await send_queue.put("msg1") is False
+        # the overflow task is referenced until it is done
+        assert len(overflow_tasks) == 1
+        await asyncio.sleep(0)
+        assert closed == [ws]
+        await asyncio.sleep(0)
+        assert len(overflow_tasks) == 0
+
+    asyncio.run(run())
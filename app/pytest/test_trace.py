@@ -0,0 +1,31 @@
+import time
+
+from app.internal.client import Client
+from app.internal.trace import CommandTracer
+
+
+def test_trace():
+    tracer = CommandTracer(size=2)
+    client = Client()
+    client.hostname = "willow-1"
+
+    for endpoint in ["REST", "REST", "MQTT"]:
+        trace = tracer.start(client, endpoint)
+        trace.mark("route")
+        time.sleep(0.01)
+        trace.mark("upstream")
+        tracer.finish(trace, "ok")
+
+    stats = tracer.model_dump()
+    # ring buffer, most recent first
+    assert [trace["id"] for trace in stats["traces"]] == [3, 2]
+    trace = stats["traces"][0]
+    assert trace["endpoint"] == "MQTT"
+    assert trace["hostname"] == "willow-1"
+    assert list(trace["stages_ms"]) == ["route", "upstream"]
+    assert trace["stages_ms"]["upstream"] >= 10
+    assert trace["total_ms"] == sum(trace["stages_ms"].values())
+
+    assert stats["endpoints"]["REST"]["count"] == 2
+    assert stats["stages"]["upstream"]["count"] == 3
+    assert stats["stages"]["upstream"]["p99_ms"] >= 10
@@ -0,0 +1,98 @@
+import asyncio
+import json
+
+from app.internal.client import Client
+from app.internal.connmgr import ConnMgr
+from app.internal.wake import WakeArbiter, WakeEvent, WakeParticipation, WakeSession, WakeStats
+from app.pytest.mock import MockWebSocket
+
+
+def test_wake_session_adaptive():
+    async def run():
+        connmgr = ConnMgr()
+        ws1 = MockWebSocket(port=1)
+        ws2 = MockWebSocket(port=2)
+        await connmgr.accept(ws1, Client(ua="Willow/0.0.0"))
+        await connmgr.accept(ws2, Client(ua="Willow/0.0.0"))
+
+        participation = WakeParticipation()
+        stats = WakeStats()
+
+        # first session has no history, so it waits for the full window
+        session = WakeSession(connmgr, participation=participation, stats=stats, window_ms=100)
+        task = asyncio.create_task(session.cleanup())
+        session.add_event(WakeEvent(ws1, -20.0, device="dev1"))
+        session.add_event(WakeEvent(ws2, -10.0, device="dev2"))
+        await task
+        assert session.decision_ms >= 100
+        assert stats.decisions_deadline == 1
+
+        # both devices are now expected, decide as soon as both reported
+        session = WakeSession(connmgr, participation=participation, stats=stats, window_ms=10000)
+        task = asyncio.create_task(session.cleanup())
+        session.add_event(WakeEvent(ws1, -5.0, device="dev1"))
+        session.add_event(WakeEvent(ws2, -10.0, device="dev2"))
+        await asyncio.wait_for(task, 1)
+        assert stats.decisions_early == 1
+
+        await asyncio.sleep(0)
+        assert json.loads(ws1.sent[-1]) == {'wake_result': {'won': True}}
+        assert json.loads(ws2.sent[-1]) == {'wake_result': {'won': False}}
+
+    asyncio.run(run())
+
+
+def test_wake_arbiter_zones():
+    async def run():
+        connmgr = ConnMgr()
+        ws_kitchen = MockWebSocket(port=1)
+        ws_office = MockWebSocket(port=2)
+        await connmgr.accept(ws_kitchen, Client(ua="Willow/0.0.0"))
+        await connmgr.accept(ws_office, Client(ua="Willow/0.0.0"))
+
+        arbiter = WakeArbiter(connmgr, window_ms=50)
+        arbiter.set_zones([
+            {"mac_addr": "dev1", "label": "kitchen", "zone": "kitchen"},
+            {"mac_addr": "dev2", "label": "office", "zone": "office"},
+        ])
+
+        # the office device is louder, but it doesn't compete with the kitchen
+        arbiter.add_event(WakeEvent(ws_kitchen, -30.0, device="dev1"))
+        arbiter.add_event(WakeEvent(ws_office, -5.0, device="dev2"))
+        assert len(arbiter.sessions) == 2
+
+        await asyncio.gather(*arbiter.tasks)
+        assert arbiter.sessions == {}
+        assert json.loads(ws_kitchen.sent[-1]) == {'wake_result': {'won': True}}
+        assert json.loads(ws_office.sent[-1]) == {'wake_result': {'won': True}}
+
+    asyncio.run(run())
+
+
+def test_wake_arbiter_late_event():
+    async def run():
+        connmgr = ConnMgr()
+        ws1 = MockWebSocket(port=1)
+        ws2 = MockWebSocket(port=2)
+        await connmgr.accept(ws1, Client(ua="Willow/0.0.0"))
+        await connmgr.accept(ws2, Client(ua="Willow/0.0.0"))
+
+        arbiter = WakeArbiter(connmgr, window_ms=100)
+        for _ in range(3):
+            arbiter.add_event(WakeEvent(ws1, -30.0, device="dev1"))
+            await asyncio.gather(*arbiter.tasks)
+
+        # only dev1 is expected, the session is decided on its event
+        arbiter.add_event(WakeEvent(ws1, -30.0, device="dev1"))
+        await asyncio.sleep(0.02)
+        arbiter.add_event(WakeEvent(ws2, -5.0, device="dev2"))
+        await asyncio.gather(*arbiter.tasks)
+        await asyncio.sleep(0)
+
+        assert json.loads(ws1.sent[-1]) == {'wake_result': {'won': True}}
+        assert json.loads(ws2.sent[-1]) == {'wake_result': {'won': False}}
+        # the late device is still learned as participant
+        assert arbiter.participation[None].sessions[-1] == {"dev1", "dev2"}
+        assert len(arbiter.participation[None].offsets) == 1
+
+    asyncio.run(run())
@@ -7,7 +7,7 @@ from fastapi import APIRouter, Depends, Query, Request
 from fastapi.responses import JSONResponse
 from pydantic import BaseModel, Field
 
-from app.db.main import get_devices_db, save_client_config_to_db
+from app.db.main import get_devices_db, run_db, save_client_to_db
 
 from ..internal.was import device_command, warm_tts
 
@@ -21,7 +21,7 @@ router = APIRouter(
 @router.get("/client")
 async def api_get_client(request: Request):
     log.debug('API GET CLIENT: Request')
-    devices = get_devices_db()
+    devices = await run_db(get_devices_db)
     clients = []
     macs = []
     labels = {}
@@ -71,25 +71,17 @@ async def api_post_client(request: Request, device: PostClient = Depends()):
         msg = json.dumps({'cmd': 'ota_start', 'ota_url': data["ota_url"]})
         try:
             ws = request.app.connmgr.get_client_by_hostname(data["hostname"])
-            await ws.send_text(msg)
+            if not await request.app.connmgr.send(ws, msg):
+                raise Exception("send failed")
         except Exception as e:
             log.error(f"Failed to trigger OTA ({e})")
         finally:
             return
     elif device.action == "config":
-        devices = get_devices_db()
-        new = True
-
-        for i, device in enumerate(devices):
-            if device.get("mac_addr") == data['mac_addr']:
-                new = False
-                devices[i] = data
-                break
-
-        if new and len(data['mac_addr']) > 0:
-            devices.append(data)
-
-        save_client_config_to_db(devices)
+        if len(data['mac_addr']) > 0:
+            await run_db(save_client_to_db, data)
+            if "zone" in data:
+                request.app.wake_arbiter.set_zone(data["mac_addr"], data["zone"])
     elif device.action == 'notify':
         log.debug(f"received notify command on API: {data}")
         warm_tts(data["data"])
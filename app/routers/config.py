@@ -81,10 +81,12 @@ class PostConfig(BaseModel):
 @router.post("/config")
 async def api_post_config(request: Request, config: PostConfig = Depends()):
     log.debug('API POST CONFIG: Request')
+    # with apply=true, post_config and post_nvs return the per client delivery report
     if config.type == "config":
-        await post_config(request, config.apply)
+        res = await post_config(request, config.apply)
         init_command_endpoint(request.app)
+        return res
     elif config.type == "nvs":
-        await post_nvs(request, config.apply)
+        return await post_nvs(request, config.apply)
     elif config.type == "was":
-        await post_was(request, config.apply)
+        return await post_was(request, config.apply)
@@ -0,0 +1,34 @@
+from logging import getLogger
+
+from fastapi import APIRouter, Request
+from fastapi.responses import PlainTextResponse
+
+from ..internal.metrics import CONNECTED_CLIENTS, NOTIFY_QUEUE_DEPTH, REGISTRY
+
+
+log = getLogger("WAS")
+
+# no /api prefix, Prometheus scrapes /metrics by default
+router = APIRouter()
+
+
+def update_metrics(app):
+    clients = {}
+    for client in app.connmgr.connected_clients.values():
+        version = client.ua.replace("Willow/", "") if client.ua else "unknown"
+        key = (client.platform, version)
+        clients[key] = clients.get(key, 0) + 1
+
+    CONNECTED_CLIENTS.clear()
+    for (platform, version), count in clients.items():
+        CONNECTED_CLIENTS.set(count, platform, version)
+
+    NOTIFY_QUEUE_DEPTH.set(sum(len(notifications) for notifications in app.notify_queue.notifications.values()))
+    app.dispatcher.collect_metrics()
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def api_get_metrics(request: Request):
+    log.debug('API GET METRICS: Request')
+    update_metrics(request.app)
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
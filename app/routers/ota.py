@@ -9,6 +9,7 @@ from pydantic import BaseModel, Field
 from requests import get
 
 from ..const import DIR_OTA
+from ..internal.metrics import OTA_BYTES_SERVED
 from ..internal.was import get_releases_willow, get_safe_path
 
 
@@ -16,6 +17,29 @@ log = getLogger("WAS")
 router = APIRouter(prefix="/api")
 
 
+class OtaFileResponse(FileResponse):
+    """FileResponse that counts the body bytes actually sent, so Range requests and aborted downloads aren't
+    counted as the full firmware size"""
+
+    def __init__(self, path, platform, **kwargs):
+        super().__init__(path, **kwargs)
+        self.platform = platform
+
+    async def __call__(self, scope, receive, send):
+        sent = 0
+
+        async def counting_send(message):
+            nonlocal sent
+            await send(message)
+            if message["type"] == "http.response.body":
+                sent += len(message.get("body", b""))
+
+        try:
+            await super().__call__(scope, receive, counting_send)
+        finally:
+            OTA_BYTES_SERVED.inc(self.platform, amount=sent)
+
+
 class GetOta(BaseModel):
     version: str = Field(Query(..., description='OTA Version'))
     platform: str = Field(Query(..., description='OTA Platform'))
@@ -44,4 +68,4 @@ async def api_get_ota(ota: GetOta = Depends()):
     if not os.path.isfile(ota_file):
         raise HTTPException(status_code=404, detail="OTA File Not Found")
 
-    return FileResponse(ota_file)
+    return OtaFileResponse(ota_file, ota.platform)
@@ -7,6 +7,8 @@ from fastapi import APIRouter, Depends, Query, Request
 from fastapi.responses import JSONResponse
 from pydantic import BaseModel, Field
 
+from app.db.main import config_cache, db_executor
+
 
 log = getLogger("WAS")
 
@@ -16,7 +18,10 @@ router = APIRouter(
 
 
 class GetStatus(BaseModel):
-    type: Literal['asyncio_tasks', 'connmgr', 'notify_queue'] = Field(Query(..., description='Status type'))
+    type: Literal[
+        'asyncio_tasks', 'command_endpoint', 'command_traces', 'config_cache', 'config_versions', 'connmgr',
+        'db', 'notify_queue', 'send_queues', 'wake', 'ws_handlers'
+    ] = Field(Query(..., description='Status type'))
 
 
 @router.get("/status")
@@ -29,10 +34,39 @@ async def api_get_status(request: Request, status: GetStatus = Depends()):
         for task in tasks:
             res.append(f"{task.get_name()}: {task.get_coro()}")
 
+    elif status.type == "command_endpoint":
+        command_endpoint = request.app.command_endpoint
+        if command_endpoint is not None:
+            res = command_endpoint.status()
+            if command_endpoint.breaker is not None:
+                res['breaker'] = command_endpoint.breaker.stats()
+            return JSONResponse(res)
+
+    elif status.type == "command_traces":
+        return JSONResponse(request.app.tracer.model_dump())
+
+    elif status.type == "config_cache":
+        return JSONResponse(config_cache.stats())
+
+    elif status.type == "config_versions":
+        return JSONResponse(request.app.config_versions.stats())
+
     elif status.type == "connmgr":
         return JSONResponse(request.app.connmgr.model_dump(exclude={}))
 
+    elif status.type == "db":
+        return JSONResponse(db_executor.stats())
+
     elif status.type == "notify_queue":
         return JSONResponse(request.app.notify_queue.model_dump(exclude={'connmgr', 'task'}))
 
+    elif status.type == "send_queues":
+        return JSONResponse(request.app.connmgr.get_send_queue_stats())
+
+    elif status.type == "wake":
+        return JSONResponse(request.app.wake_arbiter.model_dump())
+
+    elif status.type == "ws_handlers":
+        return JSONResponse(request.app.dispatcher.get_stats())
+
     return JSONResponse(res)
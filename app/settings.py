@@ -6,7 +6,22 @@ from app.const import DB_URL
 
 
 class Settings(BaseSettings):
+    broadcast_max_missed: int = 3
+    broadcast_timeout: float = 2.0
+    command_endpoint_failure_threshold: int = 3
+    command_endpoint_reset_timeout: float = 10.0
+    db_max_overflow: int = 10
+    db_pool_recycle: int = 3600
+    db_pool_size: int = 5
+    db_pool_timeout: float = 30.0
     db_url: str = DB_URL
+    db_workers: int = 4
+    ha_fast_path: bool = False
+    ha_multinet: bool = False
+    send_queue_policy: str = "drop_oldest"
+    send_queue_size: int = 64
+    wake_window_min_ms: int = 50
+    wake_window_ms: int = 400
     was_version: str = "unknown"
 
 
@@ -0,0 +1,133 @@
+"""Compare saving config, NVS and clients with a SELECT per row against a batched upsert
+
+Usage: PYTHONPATH=. python misc/benchmark/config_store.py
+"""
+import json
+import os
+import tempfile
+import time
+
+db_dir = tempfile.mkdtemp()
+os.environ["DB_URL"] = f"sqlite:///{db_dir}/was.db"
+
+from sqlmodel import Session, SQLModel, delete, select  # noqa: E402
+
+from app.db.main import (  # noqa: E402
+    convert_str_or_none,
+    engine,
+    save_client_config_to_db,
+    save_client_to_db,
+    save_config_to_db,
+    save_nvs_to_db,
+)
+from app.db.models import (  # noqa: E402
+    WillowClientTable,
+    WillowConfigNamespaceType,
+    WillowConfigTable,
+    WillowConfigType,
+)
+from app.internal.config import WillowConfig, WillowNvsConfig  # noqa: E402
+
+
+CLIENTS = 100
+ROUNDS = 50
+
+
+def select_per_row_config(config):
+    config = WillowConfig.model_validate(config)
+    with Session(engine) as session:
+        for name, value in iter(config):
+            stmt = select(WillowConfigTable).where(
+                WillowConfigTable.config_type == WillowConfigType.config,
+                WillowConfigTable.config_name == name,
+            )
+            record = session.exec(stmt).first()
+            if record is None:
+                record = WillowConfigTable(
+                    config_type=WillowConfigType.config, config_name=name, config_value=convert_str_or_none(value)
+                )
+            elif record.config_value == convert_str_or_none(value):
+                continue
+            record.config_value = convert_str_or_none(value)
+            session.add(record)
+        session.commit()
+
+
+def select_per_row_nvs(config):
+    config = WillowNvsConfig.model_validate(config)
+    with Session(engine) as session:
+        for namespace, values in [(WillowConfigNamespaceType.WAS, config.WAS), (WillowConfigNamespaceType.WIFI, config.WIFI)]:
+            for name, value in iter(values):
+                stmt = select(WillowConfigTable).where(
+                    WillowConfigTable.config_type == WillowConfigType.nvs,
+                    WillowConfigTable.config_name == name,
+                    WillowConfigTable.config_namespace == namespace,
+                )
+                record = session.exec(stmt).first()
+                if record is None:
+                    record = WillowConfigTable(
+                        config_type=WillowConfigType.nvs, config_name=name, config_namespace=namespace,
+                    )
+                elif record.config_value == str(value):
+                    continue
+                record.config_value = str(value)
+                session.add(record)
+        session.commit()
+
+
+def select_per_row_clients(clients):
+    with Session(engine) as session:
+        for client in clients:
+            stmt = select(WillowClientTable).where(WillowClientTable.mac_addr == client["mac_addr"])
+            record = session.exec(stmt).first()
+            if record is None:
+                record = WillowClientTable(mac_addr=client["mac_addr"])
+            elif record.label == client["label"] and record.zone == client.get("zone"):
+                continue
+            record.label = client["label"]
+            record.zone = client.get("zone")
+            session.add(record)
+        session.commit()
+
+
+def reset():
+    with Session(engine) as session:
+        session.exec(delete(WillowConfigTable))
+        session.exec(delete(WillowClientTable))
+        session.commit()
+
+
+def measure(name, save, payloads):
+    reset()
+    start = time.perf_counter()
+    for payload in payloads:
+        save(payload)
+    elapsed = (time.perf_counter() - start) / len(payloads) * 1000
+    print(f"{name:>34}: {elapsed:7.2f} ms per save")
+
+
+def main():
+    SQLModel.metadata.create_all(engine)
+
+    config = json.load(open("default_config.json")) | {"was_mode": True}
+    # one key changed per save, like the usual edit in the UI
+    configs = [config | {"speaker_volume": i % 100} for i in range(ROUNDS)]
+    nvs = [{"WAS": {"URL": f"ws://was:8502/ws?{i}"}, "WIFI": {"PSK": "psk", "SSID": "ssid"}} for i in range(ROUNDS)]
+    clients = [
+        [{"label": f"Willow {i}{'*' if i == n % CLIENTS else ''}", "mac_addr": f"00:00:00:00:00:{i:02x}"} for i in range(CLIENTS)]
+        for n in range(ROUNDS)
+    ]
+    client = [{"label": f"Willow {n}", "mac_addr": f"00:00:00:00:00:{n % CLIENTS:02x}"} for n in range(ROUNDS)]
+
+    print(f"{ROUNDS} saves each, {CLIENTS} clients")
+    measure("config, select per row", select_per_row_config, configs)
+    measure("config, upsert", save_config_to_db, configs)
+    measure("nvs, select per row", select_per_row_nvs, nvs)
+    measure("nvs, upsert", save_nvs_to_db, nvs)
+    measure("client list, select per row", select_per_row_clients, clients)
+    measure("client list, upsert", save_client_config_to_db, clients)
+    measure("single client, upsert", save_client_to_db, client)
+
+
+if __name__ == "__main__":
+    main()
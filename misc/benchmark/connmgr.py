@@ -0,0 +1,61 @@
+"""Compare ConnMgr lookup cost of the indexed lookups against the previous linear scan.
+
+Usage: PYTHONPATH=. python misc/benchmark/connmgr.py
+"""
+import asyncio
+import timeit
+
+from app.internal.client import Client
+from app.internal.connmgr import ConnMgr
+from app.pytest.mock import MockWebSocket
+
+
+LOOKUPS = 1000
+
+
+def linear_get_ws_by_mac(connmgr, mac):
+    for k, v in connmgr.connected_clients.items():
+        if v.mac_addr == mac:
+            return k
+    return None
+
+
+def linear_get_client_by_hostname(connmgr, hostname):
+    for k, v in connmgr.connected_clients.items():
+        if v.hostname == hostname:
+            return k
+    return None
+
+
+async def populate(connmgr, count):
+    for i in range(count):
+        ws = MockWebSocket(port=i)
+        await connmgr.accept(ws, Client(ua="Willow/0.0.0"))
+        connmgr.update_client(ws, "hostname", f"willow-{i}")
+        connmgr.update_client(ws, "mac_addr", f"00:00:00:00:{i // 256:02x}:{i % 256:02x}")
+
+
+def main():
+    print(f"{'clients':>8} {'lookup':>22} {'linear (us)':>12} {'indexed (us)':>13}")
+    for count in [10, 1000, 10000]:
+        connmgr = ConnMgr()
+        asyncio.run(populate(connmgr, count))
+        # worst case for the linear scan: the last connected client
+        last = count - 1
+        mac = f"00:00:00:00:{last // 256:02x}:{last % 256:02x}"
+        hostname = f"willow-{last}"
+
+        cases = [
+            ("get_ws_by_mac", lambda: linear_get_ws_by_mac(connmgr, mac), lambda: connmgr.get_ws_by_mac(mac)),
+            ("get_client_by_hostname",
+             lambda: linear_get_client_by_hostname(connmgr, hostname),
+             lambda: connmgr.get_client_by_hostname(hostname)),
+        ]
+        for name, linear, indexed in cases:
+            t_linear = timeit.timeit(linear, number=LOOKUPS) / LOOKUPS * 1e6
+            t_indexed = timeit.timeit(indexed, number=LOOKUPS) / LOOKUPS * 1e6
+            print(f"{count:>8} {name:>22} {t_linear:>12.3f} {t_indexed:>13.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""Compare compiling multinet commands from scratch against the memoized MultinetCompiler
+
+Usage: PYTHONPATH=. python misc/benchmark/multinet.py
+"""
+import os
+import tempfile
+import time
+
+from app.internal.multinet import MultinetCompiler
+from app.internal.was import get_ha_commands_for_entity
+
+
+ENTITIES = 5000
+ROUNDS = 10
+
+
+def entities():
+    return [
+        {
+            'entity_id': f"light.room_{i}_lamp",
+            'state': "off",
+            'attributes': {'friendly_name': f"Room {i} Lamp {i % 7}"},
+        }
+        for i in range(ENTITIES)
+    ]
+
+
+def from_scratch(states):
+    commands = []
+    for state in states:
+        commands.extend(get_ha_commands_for_entity(state["attributes"]["friendly_name"]))
+    return commands
+
+
+def main():
+    states = entities()
+    compiler = MultinetCompiler(max_commands=ENTITIES * 2, path=os.path.join(tempfile.mkdtemp(), "multinet.json"))
+    compiler.update(states)
+
+    print(f"{ENTITIES} entities, one renamed per round")
+    for name, compile in [("from scratch", from_scratch), ("memoized", compiler.update)]:
+        start = time.perf_counter()
+        for i in range(ROUNDS):
+            states[i]["attributes"]["friendly_name"] = f"{name} {i}"
+            compile(states)
+        elapsed = time.perf_counter() - start
+        print(f"{name:>13}: {elapsed / ROUNDS * 1000:8.2f} ms per compile")
+    print(compiler.stats())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""Measure NotifyQueue dispatch lag: time between a notification becoming due and being sent
+
+Usage: PYTHONPATH=. python misc/benchmark/notify.py
+"""
+import asyncio
+import statistics
+import time
+
+from app.internal.client import Client
+from app.internal.connmgr import ConnMgr
+from app.internal.notify import NotifyQueue
+from app.pytest.mock import MockWebSocket
+
+
+ROUNDS = 20
+
+
+class TimedWebSocket(MockWebSocket):
+    async def send_text(self, data):
+        self.sent.append(time.time())
+
+
+async def run(clients):
+    connmgr = ConnMgr()
+    sockets = []
+    for i in range(clients):
+        ws = TimedWebSocket(port=i)
+        await connmgr.accept(ws, Client(ua="Willow/0.0.0"))
+        connmgr.update_client(ws, "hostname", f"willow-{i}")
+        connmgr.update_client(ws, "mac_addr", f"00:00:00:00:{i // 256:02x}:{i % 256:02x}")
+        sockets.append(ws)
+
+    notify_queue = NotifyQueue(connmgr=connmgr)
+    notify_queue.start()
+
+    lags = []
+    for _ in range(ROUNDS):
+        due = int(time.time() * 1000) + 50
+        notify_queue.add({"cmd": "notify", "data": {"id": due, "text": "benchmark", "volume": 50}})
+        await asyncio.sleep(0.1)
+        for ws in sockets:
+            lags.append((ws.sent[-1] - due / 1000) * 1000)
+            # what done() does, without broadcasting a cancel to every client
+            connmgr.set_notification_active(ws, 0)
+        notify_queue.notifications.clear()
+
+    notify_queue.task.cancel()
+    return lags
+
+
+def main():
+    print(f"{'clients':>8} {'p50 (ms)':>9} {'p99 (ms)':>9} {'max (ms)':>9}")
+    for clients in [1, 100, 1000]:
+        lags = sorted(asyncio.run(run(clients)))
+        p99 = lags[int(len(lags) * 0.99) - 1]
+        print(f"{clients:>8} {statistics.median(lags):>9.2f} {p99:>9.2f} {lags[-1]:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""Compare saving notification state changes with a commit per row against batched write-behind
+
+Usage: PYTHONPATH=. python misc/benchmark/notify_store.py
+"""
+import os
+import tempfile
+import time
+
+db_dir = tempfile.mkdtemp()
+os.environ["DB_URL"] = f"sqlite:///{db_dir}/was.db"
+
+from sqlmodel import Session, SQLModel, delete  # noqa: E402
+
+from app.db.main import engine, save_notifications_to_db, upsert  # noqa: E402
+from app.db.models import WillowNotificationState, WillowNotificationTable  # noqa: E402
+
+
+NOTIFICATIONS = 200
+DEVICES = 10
+
+
+def changes(state):
+    rows = []
+    for notification_id in range(NOTIFICATIONS):
+        for device in range(DEVICES):
+            rows.append({
+                'notification_id': 1700000000000 + notification_id,
+                'mac_addr': f"00:00:00:00:00:{device:02x}",
+                'data': '{"cmd":"notify","data":{"text":"benchmark"}}',
+                'state': state,
+            })
+    return rows
+
+
+def per_row(rows):
+    for row in rows:
+        with Session(engine) as session:
+            upsert(session, WillowNotificationTable, [row], ["notification_id", "mac_addr"], ["data", "state"])
+            session.commit()
+
+
+def batched(rows):
+    save_notifications_to_db(rows)
+
+
+def main():
+    SQLModel.metadata.create_all(engine)
+    print(f"{NOTIFICATIONS} notifications x {DEVICES} devices, pending -> active -> done")
+    for name, save in [("per row commit", per_row), ("batched", batched)]:
+        with Session(engine) as session:
+            session.exec(delete(WillowNotificationTable))
+            session.commit()
+
+        start = time.perf_counter()
+        for state in WillowNotificationState.pending, WillowNotificationState.active, WillowNotificationState.done:
+            save(changes(state))
+        elapsed = time.perf_counter() - start
+        total = NOTIFICATIONS * DEVICES * 3
+        print(f"{name:>15}: {elapsed:7.3f} s, {total / elapsed:10.0f} state changes/sec")
+
+
+if __name__ == "__main__":
+    main()
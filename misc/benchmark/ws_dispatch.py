@@ -0,0 +1,87 @@
+"""Compare WebSocket message decoding and routing throughput
+
+The legacy loop decodes with json.loads and routes through an if/elif chain,
+the new loop decodes with ujson and routes through MessageDispatcher.
+Handlers do nothing, so this measures decode and routing overhead only.
+
+Usage: PYTHONPATH=. python misc/benchmark/ws_dispatch.py
+"""
+import asyncio
+import json
+import logging
+import time
+
+import ujson
+
+from app.internal.dispatch import MessageDispatcher
+
+
+MESSAGES = 200000
+REPEAT = 5
+
+log = logging.getLogger("WAS")
+log.setLevel(logging.INFO)
+
+frames = [
+    json.dumps({"wake_start": {"wake_volume": -19.5}}),
+    json.dumps({"wake_end": {}}),
+    json.dumps({"cmd": "endpoint", "data": {"text": "turn on kitchen light", "language": "en"}}),
+    json.dumps({"cmd": "get_config"}),
+    json.dumps({"notify_done": 1700000000000}),
+    json.dumps({"hello": {"hostname": "willow-1", "hw_type": "esp32-s3-box-3", "mac_addr": [1, 2, 3, 4, 5, 6]}}),
+]
+
+
+async def noop(*args):
+    pass
+
+
+async def legacy(frames):
+    for data in frames:
+        log.debug(str(data))
+        msg = json.loads(data)
+        if "wake_start" in msg:
+            await noop(msg)
+        elif "wake_end" in msg:
+            pass
+        elif "notify_done" in msg:
+            await noop(msg)
+        elif "cmd" in msg:
+            if msg["cmd"] == "endpoint":
+                await noop(msg)
+            elif msg["cmd"] == "get_config":
+                await noop(msg)
+        elif "goodbye" in msg:
+            await noop(msg)
+        elif "hello" in msg:
+            await noop(msg)
+
+
+async def dispatched(frames):
+    dispatcher = MessageDispatcher()
+    for msg_type in ["wake_start", "wake_end", "notify_done", "cmd/endpoint", "cmd/get_config", "goodbye", "hello"]:
+        dispatcher.register(msg_type)(noop)
+
+    for data in frames:
+        log.debug(data)
+        msg = ujson.loads(data)
+        await dispatcher.dispatch(None, None, msg)
+
+
+def run(loop):
+    stream = [frames[i % len(frames)] for i in range(MESSAGES)]
+    best = 0
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        asyncio.run(loop(stream))
+        best = max(best, MESSAGES / (time.perf_counter() - start))
+    return best
+
+
+def main():
+    for name, loop in [("legacy", legacy), ("dispatcher", dispatched)]:
+        print(f"{name:>10}: {run(loop):>10.0f} messages/sec")
+
+
+if __name__ == "__main__":
+    main()